@@ -0,0 +1,133 @@
+"""Benchmark for asking all of an entry's questions in one request.
+
+Runs every entry in a processed dataset one question per request and
+then all questions per request, and reports the requests made, the
+prompt tokens sent, the time per question and the computational
+accuracy.
+
+By default the LLM is simulated by a client that knows the expected
+answers, leaves out a fraction of the answer lines in each batched
+response (so that the per-question fallback is exercised) and takes a
+fixed time per request plus a time per token. Pass a model and
+HuggingFace token to use a real LLM instead.
+
+Usage:
+    python benchmarks/bench_batch_prompting.py [processed_json_path] [model token]
+"""
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from analyser import Analyser
+from client import Client
+from data import load_data
+from progress import ProgressReporter
+from run_store import RunStore
+from scheduler import estimate_tokens
+from tester import Tester
+
+QUESTION_LINE = re.compile(r"^Q(\d+): (.*)$", re.MULTILINE)
+
+class AnswerKeyClient:
+    """A simulated LLM that answers with the expected answers.
+
+    Args:
+        entries (Entries): The entries being run.
+        drop_rate (float): The probability of leaving an answer out of
+            a response to several questions.
+        seconds_per_request (float): The simulated time taken by each
+            request regardless of its size, e.g. network latency and
+            queueing.
+        seconds_per_1k_tokens (float): The simulated time to process
+            each thousand prompt tokens.
+        seed (int): The seed for choosing which answers to leave out.
+    """
+
+    def __init__(
+        self,
+        entries,
+        drop_rate=0.1,
+        seconds_per_request=0.05,
+        seconds_per_1k_tokens=0.02,
+        seed=0,
+    ):
+        self.drop_rate = drop_rate
+        self.seconds_per_request = seconds_per_request
+        self.seconds_per_1k_tokens = seconds_per_1k_tokens
+        self.requests = 0
+        self.prompt_tokens = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._answers = {}
+        for entry in entries.values():
+            for i, (question, answer) in enumerate(zip(entry.questions, entry.answers)):
+                self._answers[(i, question)] = answer
+
+    def generate(self, messages, max_tokens=500):
+        tokens = estimate_tokens(messages)
+        questions = QUESTION_LINE.findall(messages[-1]["content"])
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += tokens
+            dropped = [
+                len(questions) > 1 and self._random.random() < self.drop_rate
+                for _ in questions
+            ]
+        time.sleep(self.seconds_per_request + tokens / 1000 * self.seconds_per_1k_tokens)
+        return "\n".join(
+            f"ANS{i} = {self._answers.get((int(i), question), 0)}"
+            for (i, question), drop in zip(questions, dropped)
+            if not drop
+        )
+
+
+def run(entries, client, batch):
+    # Keep the progress output out of the results table
+    with tempfile.TemporaryDirectory() as tmp_dir, open(os.devnull, "w") as devnull:
+        store_path = os.path.join(tmp_dir, "run.jsonl")
+        tester = Tester(
+            client, entries, batch=batch, progress=ProgressReporter(out=devnull)
+        )
+        start = time.perf_counter()
+        tester.run(max_workers=8, store=RunStore(store_path, sync=False))
+        elapsed = time.perf_counter() - start
+        accuracy = Analyser(entries, run_store_path=store_path).computational_accuracy()
+    return elapsed, accuracy
+
+def main(file_path, model=None, token=None):
+    entries = load_data(file_path)
+    questions = sum(len(entry.questions) for entry in entries.values())
+    results = []
+    for batch in (False, True):
+        if model is None:
+            client = AnswerKeyClient(entries)
+        else:
+            client = Client(model, token)
+        elapsed, accuracy = run(entries, client, batch)
+        requests = getattr(client, "requests", None)
+        if requests is None:
+            requests = client.stats.requests
+        prompt_tokens = getattr(client, "prompt_tokens", None)
+        results.append((batch, requests, prompt_tokens, elapsed, accuracy))
+
+    print(f"\n{'mode':<12}{'requests':>10}{'tokens/q':>10}{'s/q':>8}{'q/s':>8}{'accuracy':>10}")
+    for batch, requests, prompt_tokens, elapsed, accuracy in results:
+        tokens = f"{prompt_tokens / questions:.0f}" if prompt_tokens is not None else "-"
+        print(
+            f"{'batched' if batch else 'sequential':<12}{requests:>10}{tokens:>10}"
+            f"{elapsed / questions:>8.3f}{questions / elapsed:>8.1f}"
+            f"{accuracy.accuracy:>10.3f}"
+        )
+
+if __name__ == "__main__":
+    file_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+        os.path.dirname(__file__), "..", "data", "processed", "train3.json"
+    )
+    model, token = (sys.argv[2], sys.argv[3]) if len(sys.argv) > 3 else (None, None)
+    main(file_path, model, token)
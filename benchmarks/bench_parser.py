@@ -0,0 +1,63 @@
+"""Micro-benchmark for parsing and executing answers.
+
+Compares executing every answer in a processed dataset with an empty
+program cache (so each answer is parsed on every call, as before the
+cache existed) against executing them with a warm cache.
+
+Usage:
+    python benchmarks/bench_parser.py [processed_json_path] [repeats]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from data import load_data
+from utils import clear_program_cache, execute_answer
+
+def main(file_path, repeats):
+    entries = load_data(file_path)
+    # Include typical single-step LLM answers alongside the expected
+    # answers, which are often multi-step programs
+    answers = [
+        (answer, entry.exe_answers)
+        for entry in entries.values()
+        for answer in entry.answers
+    ]
+    answers += [
+        (f"{op}({i}.5, ANS0)", [float(i)])
+        for op in ("add", "subtract", "multiply", "divide")
+        for i in range(50)
+    ]
+
+    def execute_all():
+        for answer, exe_answers in answers:
+            try:
+                execute_answer(answer, exe_answers)
+            except Exception:
+                pass
+
+    def execute_all_cold():
+        for answer, exe_answers in answers:
+            clear_program_cache()
+            try:
+                execute_answer(answer, exe_answers)
+            except Exception:
+                pass
+
+    execute_all()
+    cold = min(timeit.repeat(execute_all_cold, number=1, repeat=repeats))
+    warm = min(timeit.repeat(execute_all, number=1, repeat=repeats))
+    per_answer = 1e6 / len(answers)
+    print(f"answers:  {len(answers)}")
+    print(f"uncached: {cold * per_answer:.2f} us/answer")
+    print(f"cached:   {warm * per_answer:.2f} us/answer")
+    print(f"speedup:  {cold / warm:.1f}x")
+
+if __name__ == "__main__":
+    file_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+        os.path.dirname(__file__), "..", "data", "processed", "train3.json"
+    )
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    main(file_path, repeats)
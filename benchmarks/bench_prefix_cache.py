@@ -0,0 +1,52 @@
+"""Benchmark for reusing the backend's prefix cache between questions.
+
+Runs every entry in a processed dataset against a stub backend that
+simulates a server with a prefix (KV) cache, with and without prefix
+caching, and reports the prompt tokens processed, the simulated prefill
+time, the prefill time the cache saved and the wall time per question.
+
+Usage:
+    python benchmarks/bench_prefix_cache.py [processed_json_path]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from backends import StubBackend
+from client import Client
+from data import load_data
+from progress import ProgressReporter
+from tester import Tester
+
+def run(entries, prefix_caching, max_workers=8):
+    backend = StubBackend(prefix_caching=prefix_caching, cache_size=max_workers)
+    client = Client("stub", backend=backend)
+    start = time.perf_counter()
+    # Keep the progress output out of the results table
+    with open(os.devnull, "w") as devnull:
+        tester = Tester(client, entries, progress=ProgressReporter(out=devnull))
+        tester.run(max_workers=max_workers)
+    return client.stats, time.perf_counter() - start
+
+def main(file_path):
+    entries = load_data(file_path)
+    questions = sum(len(entry.questions) for entry in entries.values())
+    print(
+        f"\n{'prefix caching':<16}{'prompt tok/q':>14}{'cached':>8}"
+        f"{'prefill s':>11}{'saved s':>9}{'s/q':>8}"
+    )
+    for prefix_caching in (False, True):
+        stats, elapsed = run(entries, prefix_caching)
+        print(
+            f"{str(prefix_caching):<16}{stats.prompt_tokens / questions:>14.0f}"
+            f"{stats.cache_hit_rate():>8.1%}{stats.prefill_time:>11.2f}"
+            f"{stats.prefill_time_saved():>9.2f}{elapsed / questions:>8.3f}"
+        )
+
+if __name__ == "__main__":
+    file_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+        os.path.dirname(__file__), "..", "data", "processed", "train3.json"
+    )
+    main(file_path)
@@ -0,0 +1,128 @@
+"""Benchmark for sending retrieved context spans instead of full contexts.
+
+Runs every entry in a processed dataset with the full context, the
+encoded context, and retrieval over each, and reports the prompt tokens
+sent, the mean latency per question and the computational accuracy.
+
+By default the LLM is simulated by an oracle that answers correctly if
+and only if every number its answer needs is in the context it was
+sent, and takes longer the longer the prompt is, so the accuracy only
+measures what is left out of the context. Pass a model
+and HuggingFace token to use a real LLM instead.
+
+Usage:
+    python benchmarks/bench_retrieval.py [processed_json_path] [model token]
+"""
+import functools
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from analyser import Analyser
+from client import Client
+from context_encoder import encode_context
+from data import load_data
+from progress import ProgressReporter
+from retrieval import ContextRetriever, literal_numbers, numbers_in
+from run_store import RunStore
+from scheduler import estimate_tokens
+from tester import Tester
+from _consts import INIT_MESSAGES
+
+QUESTION_PATTERN = re.compile(r"Q(\d+): (.*)\n", re.DOTALL)
+
+class OracleClient:
+    """A simulated LLM that knows the expected answers, but can only give
+    them if the numbers they need are in the context it was sent.
+
+    Args:
+        entries (Entries): The entries being run.
+        seconds_per_1k_tokens (float): The simulated time to process
+            each thousand prompt tokens.
+    """
+
+    def __init__(self, entries, seconds_per_1k_tokens=0.02):
+        self.seconds_per_1k_tokens = seconds_per_1k_tokens
+        self.prompt_tokens = 0
+        self._lock = threading.Lock()
+        self._answers = {}
+        for entry in entries.values():
+            for i, (question, answer) in enumerate(zip(entry.questions, entry.answers)):
+                self._answers[(i, question)] = answer
+
+    def generate(self, messages, max_tokens=500):
+        tokens = estimate_tokens(messages)
+        with self._lock:
+            self.prompt_tokens += tokens
+        time.sleep(tokens / 1000 * self.seconds_per_1k_tokens)
+        match = QUESTION_PATTERN.search(messages[-1]["content"])
+        i = int(match.group(1))
+        answer = self._answers.get((i, match.group(2)))
+        # Negative numbers are written as e.g. "-9 ( 9 )" in processed
+        # contexts but just "-9" in encoded ones, and answers often use
+        # the positive value
+        context = numbers_in(messages[len(INIT_MESSAGES)]["content"])
+        context |= {abs(number) for number in context}
+        if answer is None or not literal_numbers(answer) <= context:
+            return f"ANS{i} = 0"
+        return f"ANS{i} = {answer}"
+
+
+def run(entries, client, context_encoder=None, retriever=None):
+    # Keep the progress output out of the results table
+    with tempfile.TemporaryDirectory() as tmp_dir, open(os.devnull, "w") as devnull:
+        store_path = os.path.join(tmp_dir, "run.jsonl")
+        tester = Tester(
+            client, entries, context_encoder, retriever,
+            progress=ProgressReporter(out=devnull),
+        )
+        start = time.perf_counter()
+        tester.run(max_workers=8, store=RunStore(store_path, sync=False))
+        elapsed = time.perf_counter() - start
+        accuracy = Analyser(entries, run_store_path=store_path).computational_accuracy()
+    fallbacks = sum(
+        ch.retriever.fallbacks for ch in tester.conversations.values() if ch.retriever
+    )
+    return elapsed, accuracy, fallbacks
+
+def main(file_path, model=None, token=None):
+    entries = load_data(file_path)
+    questions = sum(len(entry.questions) for entry in entries.values())
+    configurations = {
+        "full": {},
+        "encoded": {"context_encoder": encode_context},
+        "retrieval": {"retriever": ContextRetriever},
+        "retrieval k=2": {"retriever": functools.partial(ContextRetriever, k=2)},
+        "encoded + retrieval": {
+            "context_encoder": encode_context, "retriever": ContextRetriever,
+        },
+    }
+    results = []
+    for name, options in configurations.items():
+        if model is None:
+            client = OracleClient(entries)
+        else:
+            client = Client(model, token)
+        elapsed, accuracy, fallbacks = run(entries, client, **options)
+        prompt_tokens = getattr(client, "prompt_tokens", None)
+        results.append((name, prompt_tokens, elapsed, accuracy, fallbacks))
+
+    print(f"\n{'configuration':<22}{'tokens/q':>10}{'s/q':>8}{'accuracy':>10}{'fallbacks':>11}")
+    for name, prompt_tokens, elapsed, accuracy, fallbacks in results:
+        tokens = f"{prompt_tokens / questions:.0f}" if prompt_tokens is not None else "-"
+        print(
+            f"{name:<22}{tokens:>10}{elapsed / questions:>8.3f}"
+            f"{accuracy.accuracy:>10.3f}{fallbacks:>11}"
+        )
+
+if __name__ == "__main__":
+    file_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+        os.path.dirname(__file__), "..", "data", "processed", "train3.json"
+    )
+    model, token = (sys.argv[2], sys.argv[3]) if len(sys.argv) > 3 else (None, None)
+    main(file_path, model, token)
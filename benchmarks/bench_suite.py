@@ -0,0 +1,450 @@
+"""Benchmark suite for parsing, execution, analysis and whole runs.
+
+Times extracting and executing answers, loading and processing
+datasets, building the run table and every `Analyser` metric, and
+`Tester.run` against a client that simulates the latency of an LLM.
+The cases use the shipped data (the processed train3 entries, the raw
+test entries and the responses in run1.pickle) and a synthetic run
+that repeats the train3 entries until it has `--questions` questions,
+with a mix of correct, wrong and malformed answers.
+
+Each case's best time per item is written to a JSON file and compared
+with a baseline saved by an earlier run on the same machine. Cases
+more than `--threshold` slower than the baseline are flagged, and the
+script exits with status 1 if there are any. Baselines are kept per
+machine, since timings from different machines can't be compared.
+
+Usage:
+    # Save a baseline before making a change
+    python benchmarks/bench_suite.py --save
+    # Then check the change for regressions
+    python benchmarks/bench_suite.py [--questions N] [--only PREFIX ...]
+"""
+import argparse
+import json
+import os
+import pickle
+import platform
+import random
+import sys
+import tempfile
+import time
+from functools import cached_property
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from analyser import Analyser
+from batch import rescore_run
+from build_datasets import iter_raw_records, process_record
+from conversation_handler import ConversationHandler
+from data import load_data
+from evaluation import build_run_table
+from progress import ProgressReporter
+from replay import ReplayClient, constant_latency
+from tester import Tester
+from utils import clear_program_cache, execute_answer, extract_raw_answer
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), "baselines")
+
+# Fast cases are run repeatedly until each measurement takes at least
+# this long, so that the timer's resolution doesn't matter
+MIN_MEASUREMENT = 0.1
+
+ANALYSER_METRICS = [
+    "computational_accuracy",
+    "computational_accuracy_by_question_number",
+    "computational_accuracy_by_question_type",
+    "computational_accuracy_by_operation",
+    "operation_accuracy",
+    "operation_accuracy_by_question_number",
+    "operation_accuracy_by_operation",
+    "backward_subtraction",
+]
+
+class ScriptedClient:
+    """A client that gives a prepared response to each request in turn."""
+
+    def __init__(self):
+        self.responses = iter(())
+
+    def generate(self, messages, max_tokens=500):
+        return next(self.responses)
+
+
+class Data:
+    """The data the cases run on, loaded or generated when first used.
+
+    Args:
+        tmp_dir (str): A directory to write generated files to.
+        questions (int): The number of questions in the synthetic run.
+        run_questions (int): The number of questions to run `Tester.run`
+            on in the synthetic run.
+        seed (int): The seed for generating the synthetic run.
+    """
+
+    def __init__(self, tmp_dir, questions, run_questions, seed=0):
+        self.tmp_dir = tmp_dir
+        self.questions = questions
+        self.run_questions = run_questions
+        self.seed = seed
+
+    @cached_property
+    def train3_path(self):
+        return os.path.join(DATA_DIR, "processed", "train3.json")
+
+    @cached_property
+    def train3(self):
+        return load_data(self.train3_path)
+
+    @cached_property
+    def test_raw_path(self):
+        return os.path.join(DATA_DIR, "raw", "test.json")
+
+    @cached_property
+    def test(self):
+        processed = {
+            str(i): process_record(record)
+            for i, record in enumerate(iter_raw_records(self.test_raw_path))
+        }
+        path = os.path.join(self.tmp_dir, "test.json")
+        with open(path, "w") as out:
+            json.dump(processed, out)
+        return load_data(path)
+
+    @cached_property
+    def run1(self):
+        with open(os.path.join(DATA_DIR, "runs", "run1.pickle"), "rb") as run_file:
+            return pickle.load(run_file)
+
+    @cached_property
+    def run1_responses(self):
+        # Each response with the executed answers it can refer to
+        return [
+            (response, ch.exe_answers[:i])
+            for ch in self.run1.values()
+            for i, response in enumerate(ch.full_answers)
+        ]
+
+    @cached_property
+    def synthetic_path(self):
+        with open(self.train3_path) as json_file:
+            train3 = list(json.load(json_file).values())
+        synthetic = {}
+        questions = 0
+        while questions < self.questions:
+            entry = train3[len(synthetic) % len(train3)]
+            synthetic[str(len(synthetic))] = entry
+            questions += len(entry["dialogue_break"])
+        path = os.path.join(self.tmp_dir, "synthetic.json")
+        with open(path, "w") as out:
+            json.dump(synthetic, out)
+        return path
+
+    @cached_property
+    def synthetic(self):
+        return load_data(self.synthetic_path)
+
+    @cached_property
+    def synthetic_run(self):
+        # Answer every question with a mix of correct answers, wrong
+        # numbers, backward subtractions and malformed responses
+        rng = random.Random(self.seed)
+        client = ScriptedClient()
+        conversations = {}
+        for entry_id, entry in self.synthetic.items():
+            client.responses = iter([
+                _synthetic_response(i, answer, exe_answer, rng)
+                for i, (answer, exe_answer) in enumerate(zip(entry.answers, entry.exe_answers))
+            ])
+            ch = ConversationHandler(client, entry.context)
+            for question in entry.questions:
+                ch.ask(question)
+            conversations[entry_id] = ch
+        return conversations
+
+    @cached_property
+    def synthetic_responses(self):
+        return [
+            (response, ch.exe_answers[:i])
+            for ch in self.synthetic_run.values()
+            for i, response in enumerate(ch.full_answers)
+        ]
+
+    @cached_property
+    def synthetic_analyser(self):
+        path = os.path.join(self.tmp_dir, "synthetic.pickle")
+        with open(path, "wb") as out:
+            pickle.dump(self.synthetic_run, out)
+        return Analyser(self.synthetic, pickle_file_path=path)
+
+    @cached_property
+    def synthetic_run_entries(self):
+        entries = {}
+        questions = 0
+        for entry_id, entry in self.synthetic.items():
+            if questions >= self.run_questions:
+                break
+            entries[entry_id] = entry
+            questions += len(entry.questions)
+        return entries
+
+
+def _synthetic_response(question_number, answer, exe_answer, rng):
+    r = rng.random()
+    if r < 0.05:
+        return "I can't answer that"
+    if r < 0.15 and answer.startswith("subtract(") and ";" not in answer:
+        arg1, arg2 = answer[len("subtract("):-1].split(", ")
+        answer = f"subtract({arg2}, {arg1})"
+    elif r < 0.25 and isinstance(exe_answer, float):
+        answer = f"{exe_answer * 1.5:g}"
+    return f"ANS{question_number} = {answer}"
+
+def _extract_all(responses):
+    for response, _ in responses:
+        try:
+            extract_raw_answer(response)
+        except Exception:
+            pass
+
+def _execute_all(responses):
+    for response, exe_answers in responses:
+        try:
+            execute_answer(extract_raw_answer(response), exe_answers)
+        except Exception:
+            pass
+
+def _execute_all_cold(responses):
+    clear_program_cache()
+    _execute_all(responses)
+
+def _run_tester(entries, conversations, latency):
+    client = ReplayClient(conversations, latency=constant_latency(latency))
+    # The errors logged for malformed answers are expected, so aren't shown
+    with open(os.devnull, "w") as devnull:
+        Tester(client, entries, progress=ProgressReporter(out=devnull)).run(max_workers=16)
+
+
+# Each case is a name, the number of measurements to take and a
+# function that takes the data and returns the function to time and the
+# number of items it processes
+CASES = []
+
+def case(name, repeats=5):
+    def register(setup):
+        CASES.append((name, repeats, setup))
+        return setup
+    return register
+
+@case("parse.extract_raw_answer.run1")
+def _(data):
+    return lambda: _extract_all(data.run1_responses), len(data.run1_responses)
+
+@case("parse.extract_raw_answer.synthetic")
+def _(data):
+    return lambda: _extract_all(data.synthetic_responses), len(data.synthetic_responses)
+
+@case("execute.cold.run1")
+def _(data):
+    return lambda: _execute_all_cold(data.run1_responses), len(data.run1_responses)
+
+@case("execute.warm.run1")
+def _(data):
+    return lambda: _execute_all(data.run1_responses), len(data.run1_responses)
+
+# The synthetic answers repeat, so they are only timed with a warm cache
+@case("execute.warm.synthetic")
+def _(data):
+    return lambda: _execute_all(data.synthetic_responses), len(data.synthetic_responses)
+
+@case("execute.batch.synthetic")
+def _(data):
+    return lambda: rescore_run(data.synthetic_run), len(data.synthetic_responses)
+
+@case("data.process_record.test")
+def _(data):
+    def process():
+        for record in iter_raw_records(data.test_raw_path):
+            process_record(record)
+    return process, len(data.test)
+
+@case("data.load_data.train3")
+def _(data):
+    return lambda: load_data(data.train3_path), len(data.train3)
+
+@case("data.load_data.synthetic")
+def _(data):
+    return lambda: load_data(data.synthetic_path), len(data.synthetic)
+
+@case("analyser.build_run_table.synthetic")
+def _(data):
+    return (
+        lambda: build_run_table(data.synthetic, data.synthetic_run),
+        len(data.synthetic_responses),
+    )
+
+for metric in ANALYSER_METRICS:
+    @case(f"analyser.{metric}.synthetic")
+    def _(data, metric=metric):
+        # The table is built before timing, and the metric is called
+        # without its result cache, so that only calculating it is timed
+        analyser = data.synthetic_analyser
+        analyser.table
+        calculate = getattr(Analyser, metric).__wrapped__
+        return lambda: calculate(analyser, None, 0.001, 0.0), len(data.synthetic_responses)
+
+@case("analyser.computational_accuracy_sweep.synthetic")
+def _(data):
+    # A 20 x 5 grid of tolerances, overall and by question number and
+    # operation
+    analyser = data.synthetic_analyser
+    analyser.table
+    rel_tols = [0.0] + [10 ** (k / 4) for k in range(-24, -5)]
+    abs_tols = [0.0, 0.001, 0.01, 0.1, 1.0]
+
+    def sweep():
+        analyser.computational_accuracy_sweep(rel_tols, abs_tols)
+        analyser.computational_accuracy_sweep_by_question_number(rel_tols, abs_tols)
+        analyser.computational_accuracy_sweep_by_operation(rel_tols, abs_tols)
+    return sweep, len(data.synthetic_responses)
+
+@case("analyser.cached_metrics.synthetic")
+def _(data):
+    analyser = data.synthetic_analyser
+
+    def report():
+        for metric in ANALYSER_METRICS:
+            getattr(analyser, metric)()
+    return report, len(data.synthetic_responses)
+
+@case("tester.run.test", repeats=1)
+def _(data):
+    questions = sum(len(entry.questions) for entry in data.test.values())
+    return lambda: _run_tester(data.test, data.run1, 0.002), questions
+
+@case("tester.run.synthetic", repeats=1)
+def _(data):
+    entries = data.synthetic_run_entries
+    questions = sum(len(entry.questions) for entry in entries.values())
+    return lambda: _run_tester(entries, data.synthetic_run, 0.002), questions
+
+
+def measure(fn, repeats):
+    """Get the best time in seconds taken by a function over a number
+    of measurements.
+    """
+    start = time.perf_counter()
+    fn()
+    first = time.perf_counter() - start
+    if repeats <= 1:
+        return first
+    number = max(1, int(MIN_MEASUREMENT / first)) if first > 0 else 1000
+    best = first
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+def run_cases(data, only=None):
+    results = {}
+    for name, repeats, setup in CASES:
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        fn, items = setup(data)
+        seconds = measure(fn, repeats)
+        results[name] = {
+            "items": items,
+            "seconds": seconds,
+            "us_per_item": seconds / items * 1e6,
+        }
+        print(f"{name:<62}{items:>9}{seconds * 1e3:>12.2f}{results[name]['us_per_item']:>12.3f}")
+    return results
+
+def compare(results, baseline, threshold):
+    """Compare results with a baseline.
+
+    Returns:
+        regressions (List[str]): The names of the cases that are more
+            than `threshold` slower per item than the baseline.
+    """
+    regressions = []
+    print(f"\n{'case':<62}{'baseline us':>12}{'us':>12}{'change':>9}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["us_per_item"]
+        change = result["us_per_item"] / before - 1
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<62}{before:>12.3f}{result['us_per_item']:>12.3f}{change:>+9.1%}{flag}")
+    return regressions
+
+def main(args):
+    baseline_path = args.baseline or os.path.join(BASELINE_DIR, f"{platform.node()}.json")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data = Data(tmp_dir, args.questions, args.run_questions)
+        print(f"{'case':<62}{'items':>9}{'total ms':>12}{'us/item':>12}")
+        results = run_cases(data, args.only)
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.node(),
+        "questions": args.questions,
+        "time": time.time(),
+        "cases": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as out:
+            json.dump(report, out, indent=2)
+
+    if args.save:
+        # Cases that weren't run keep their earlier baselines
+        if os.path.exists(baseline_path):
+            with open(baseline_path) as baseline_file:
+                report["cases"] = {**json.load(baseline_file)["cases"], **results}
+        os.makedirs(os.path.dirname(os.path.abspath(baseline_path)), exist_ok=True)
+        with open(baseline_path, "w") as out:
+            json.dump(report, out, indent=2)
+        print(f"\nSaved the baseline to {baseline_path}")
+        return 0
+    if not os.path.exists(baseline_path):
+        print(f"\nNo baseline at {baseline_path}; save one with --save")
+        return 0
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline["questions"] != args.questions:
+        print(
+            f"\nThe baseline has {baseline['questions']} synthetic questions rather "
+            f"than {args.questions}, so the synthetic cases may not be comparable"
+        )
+    regressions = compare(results, baseline["cases"], args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) of more than {args.threshold:.0%}")
+        return 1
+    print("\nNo regressions")
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time parsing, execution, analysis and runs, and flag regressions."
+    )
+    parser.add_argument("--questions", type=int, default=100_000,
+                        help="The number of questions in the synthetic run.")
+    parser.add_argument("--run-questions", type=int, default=5_000,
+                        help="The number of synthetic questions to run Tester.run on.")
+    parser.add_argument("--only", nargs="+",
+                        help="Only run the cases whose names start with one of these.")
+    parser.add_argument("--baseline",
+                        help="The baseline file. Defaults to one for this machine in "
+                        "benchmarks/baselines.")
+    parser.add_argument("--save", action="store_true",
+                        help="Save the results as the baseline instead of comparing.")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="The slowdown per item flagged as a regression.")
+    parser.add_argument("--output", help="A file to also write the results to.")
+    sys.exit(main(parser.parse_args()))
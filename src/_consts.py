@@ -188,4 +188,7 @@ I will provide an example conversation.
     },
 ]
 
-ASSISTANT_INITIAL_CONFIRMATION = "Understood. And what are your questions? I will make sure to only answer with a number, including a percentage sign \"%\" if I am asked for a percentage, or in the form operation(arg1, arg2)."
\ No newline at end of file
+ASSISTANT_INITIAL_CONFIRMATION = "Understood. And what are your questions? I will make sure to only answer with a number, including a percentage sign \"%\" if I am asked for a percentage, or in the form operation(arg1, arg2)."
+BATCH_PREFIX = "Please answer all of the following questions, in order, with one line for each answer."
+
+BATCH_SUFFIX = "Remember to answer every question, each on its own line in the form ANS{i} = {your answer}, where {i} is the question number and {answer} is either a number from the text, or an operation with two arguments in the form operation(arg1, arg2). Later answers can refer to earlier ones as ANS{i}."
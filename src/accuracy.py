@@ -1,4 +1,7 @@
 from dataclasses import dataclass
+from typing import Hashable, List, Optional
+
+import numpy as np
 
 @dataclass
 class Accuracy:
@@ -8,4 +11,56 @@ class Accuracy:
 
     def calculate_acc(self):
         if self.total > 0:
-            self.accuracy = self.score / self.total
\ No newline at end of file
+            self.accuracy = self.score / self.total
+
+
+@dataclass
+class ToleranceSweep:
+    """The accuracy at every pair of tolerances in a grid, optionally
+    split into groups of questions.
+
+    Attributes:
+        rel_tols (np.ndarray): The relative tolerances.
+        abs_tols (np.ndarray): The absolute tolerances.
+        groups (List[Hashable]): The name of each group, e.g. its
+            question number or operation, or [None] if the questions
+            aren't split into groups.
+        scores (np.ndarray): The number correct in each group at each
+            pair of tolerances, indexed by [abs_tol, rel_tol, group].
+        totals (np.ndarray): The number of questions in each group.
+    """
+    rel_tols: np.ndarray
+    abs_tols: np.ndarray
+    groups: List[Hashable]
+    scores: np.ndarray
+    totals: np.ndarray
+
+    def accuracies(self) -> np.ndarray:
+        """The accuracy in each group at each pair of tolerances,
+        indexed by [abs_tol, rel_tol, group], or 0 for empty groups.
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.totals > 0, self.scores / self.totals, 0.0)
+
+    def accuracy(
+        self, rel_tol: float, abs_tol: float = 0.0, group: Optional[Hashable] = None
+    ) -> Accuracy:
+        """Get the accuracy of a group at one of the pairs of tolerances.
+
+        Raises:
+            ValueError: If the tolerances or the group aren't in the
+                sweep.
+        """
+        i = _grid_index(self.abs_tols, abs_tol, "abs_tol")
+        j = _grid_index(self.rel_tols, rel_tol, "rel_tol")
+        k = self.groups.index(group)
+        accuracy = Accuracy(int(self.scores[i, j, k]), int(self.totals[k]))
+        accuracy.calculate_acc()
+        return accuracy
+
+
+def _grid_index(tols, tol, name):
+    matches = np.flatnonzero(tols == tol)
+    if len(matches) == 0:
+        raise ValueError(f"{name} {tol} isn't in the sweep")
+    return matches[0]
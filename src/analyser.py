@@ -1,11 +1,41 @@
+import copy
 import pickle
-from typing import Dict, List, Optional
+from collections import Counter, OrderedDict
+from functools import wraps
+from typing import Dict, List, Optional, Sequence
 
-from accuracy import Accuracy
-from utils import equivalent_val
-from _consts import OP_MAP
+import numpy as np
+
+from accuracy import Accuracy, ToleranceSweep
+from evaluation import OPERATIONS, SUBTRACT, RunTable, build_run_table
+from run_store import RunStore
 from _extra_typing import EntryKeyCollection
 
+def _memoised(metric):
+    # Cache the results of a metric by its indices and tolerances
+    @wraps(metric)
+    def memoised_metric(
+        self,
+        indices: Optional[EntryKeyCollection] = None,
+        rel_tol: float = 0.001,
+        abs_tol: float = 0.0,
+    ):
+        if indices is not None:
+            # The indices may be an iterator, which can only be read once
+            indices = list(indices)
+        key = (metric.__name__, _indices_key(indices), rel_tol, abs_tol)
+        self._check_run()
+        if key in self._results:
+            self._results.move_to_end(key)
+        else:
+            self._results[key] = metric(self, indices, rel_tol, abs_tol)
+            while len(self._results) > self.cache_size:
+                self._results.popitem(last=False)
+        # Copied so that changing a result doesn't change the cached one
+        return copy.deepcopy(self._results[key])
+    return memoised_metric
+
+
 class Analyser:
     """A class for analysing conversation results.
 
@@ -13,8 +43,12 @@ class Analyser:
         entries (Entries): A collection of entries containing the expected
             answers, with a unique key for each that can be used access
             a specific entry.
-        pickle_file_path (str): A path to a pickle file containing a
-            dictionary of conversations.
+        pickle_file_path (Optional[str]): A path to a pickle file
+            containing a dictionary of conversations.
+        run_store_path (Optional[str]): A path to a run store to load
+            the conversations from instead of a pickle file.
+        cache_size (int): The maximum number of metric results to keep,
+            with the least recently used dropped first.
 
     Attributes:
         entries (Entries): A collection of entries containing the expected
@@ -24,12 +58,97 @@ class Analyser:
             conversation handler for each entry, indexed by the entry's
             unique key. This will contain generated answers to be
             compared with the expected answers in entries.
+        table (RunTable): A columnar table of the expected and generated
+            answers, which all of the metrics are calculated from. It is
+            built on first use, and rebuilt if `entries` or
+            `conversations` are replaced, have items set or removed, or
+            any conversation is asked more questions.
+
+    The results of the metrics are cached by their indices and
+    tolerances, so calling a metric again with the same arguments, e.g.
+    while plotting, doesn't recalculate it. The cache is cleared
+    whenever the table is rebuilt. `entries` (if it is a dict) and
+    `conversations` are copied into dicts that count the changes made
+    to them, so changes made to the dicts that were passed in, or to a
+    conversation's answers other than by asking or replaying questions,
+    aren't noticed; call `clear_cache` after making them.
     """
     
-    def __init__(self, entries, pickle_file_path):
+    def __init__(
+        self,
+        entries,
+        pickle_file_path: Optional[str] = None,
+        run_store_path: Optional[str] = None,
+        cache_size: int = 256,
+    ):
+        if (pickle_file_path is None) == (run_store_path is None):
+            raise ValueError(
+                "Exactly one of pickle_file_path and run_store_path "
+                "should be provided"
+            )
+        self._replaced = 0
         self.entries = entries
-        with open(pickle_file_path, "rb") as conversation_file:
-            self.conversations = pickle.load(conversation_file)
+        if pickle_file_path is not None:
+            with open(pickle_file_path, "rb") as conversation_file:
+                self.conversations = pickle.load(conversation_file)
+        else:
+            self.conversations = RunStore(run_store_path).conversations(entries)
+        self.cache_size = cache_size
+        self._table = None
+        self._run_state = None
+        self._results = OrderedDict()
+
+    @property
+    def entries(self):
+        return self._entries
+
+    @entries.setter
+    def entries(self, entries):
+        # Other mappings, e.g. `CompiledEntries`, are read-only
+        if isinstance(entries, dict):
+            entries = _VersionedDict(entries)
+        self._entries = entries
+        self._replaced += 1
+
+    @property
+    def conversations(self):
+        return self._conversations
+
+    @conversations.setter
+    def conversations(self, conversations):
+        self._conversations = _VersionedConversations(conversations)
+        self._replaced += 1
+
+    @property
+    def table(self) -> RunTable:
+        self._check_run()
+        return self._run_table()
+
+    def clear_cache(self):
+        """Drop the table and the cached metric results, so that they
+        are calculated again from the current conversations.
+        """
+        self._table = None
+        self._run_state = None
+        self._results.clear()
+
+    def _run_table(self):
+        # The table, without checking whether the run has changed
+        if self._table is None:
+            self._table = build_run_table(self.entries, self.conversations)
+        return self._table
+
+    def _check_run(self):
+        # Anything calculated from an earlier version of the entries or
+        # conversations is dropped
+        state = (
+            self._replaced,
+            getattr(self._entries, "version", 0),
+            self._conversations.version,
+        )
+        if state != self._run_state:
+            self.clear_cache()
+            self._run_state = state
 
     def compare(self, indices: Optional[EntryKeyCollection] = None):
         """View the difference between expected and generated results.
@@ -45,14 +164,20 @@ class Analyser:
                 for.
         """
         indices = self._get_indices(indices)
+        # The results for single entries aren't cached, so that they
+        # don't push the results for the whole run out of the cache
+        self._check_run()
+        computational_accuracy = self.computational_accuracy.__wrapped__
+        by_question_type = self.computational_accuracy_by_question_type.__wrapped__
+        operation_accuracy = self.operation_accuracy.__wrapped__
 
         for i in indices:
             if self._index_absent(i):
                 continue
             entry, conv = self.entries[i], self.conversations[i]
-            c_acc = self.computational_accuracy([i])
-            r_acc = self.computational_accuracy_by_question_type([i])["retrieval"]
-            o_acc = self.operation_accuracy([i])
+            c_acc = computational_accuracy(self, [i])
+            r_acc = by_question_type(self, [i])["retrieval"]
+            o_acc = operation_accuracy(self, [i])
             print(f"\033[1mEntry {i}\033[0m")
             print("----------------------------------------")
             print("\033[1;31mQuestions\033[0m")
@@ -60,12 +185,12 @@ class Analyser:
                 print(q)
             print("----------------------------------------")
             print("\033[1;34mComputations\033[0m")
-            print(f"Expected : {entry.exe_answers}")
+            print(f"Expected : {[entry.exe_answer(q) for q in range(len(entry.answers))]}")
             print(f"Generated: {conv.exe_answers}")
             print(f"\033[34mComputational Accuracy:\033[0m {c_acc}")
             print("----------------------------------------")
             print("\033[1;32mRetrievals and Operations\033[0m")
-            print(f"Expected : {entry.answers}")
+            print(f"Expected : {list(entry.answers)}")
             print(f"Generated: {conv.answers}")
             print(f"\033[32mRetrieval Accuracy:\033[0m {r_acc}")
             print(f"\033[32mOperation Accuracy:\033[0m {o_acc}")
@@ -97,6 +222,7 @@ class Analyser:
                 print(err)
             print("\n----------------------------------------\n")
 
+    @_memoised
     def computational_accuracy(
         self,
         indices: Optional[EntryKeyCollection] = None,
@@ -126,21 +252,11 @@ class Analyser:
                     * `total`: total number of questions
                     * `accuracy`: `score` / `total`
         """
-        indices = self._get_indices(indices)
-
-        accuracy = Accuracy()
-        for i in indices:
-            if self._index_absent(i):
-                continue
-            expecteds = self.entries[i].exe_answers
-            gots = self.conversations[i].exe_answers
-            for expected, got in zip(expecteds, gots):
-                if equivalent_val(expected, got, rel_tol, abs_tol):
-                    accuracy.score += 1
-                accuracy.total += 1
-        accuracy.calculate_acc()
-        return accuracy
+        table = self._run_table()
+        rows = table.rows(indices)
+        return _accuracy(table.computational_matches(rows, rel_tol, abs_tol))
 
+    @_memoised
     def computational_accuracy_by_question_number(
         self,
         indices: Optional[EntryKeyCollection] = None,
@@ -175,24 +291,14 @@ class Analyser:
                     * `accuracy`: `score` / `total`
                 The list is indexed by question number.
             """
-        indices = self._get_indices(indices)
-
-        accuracies = []
-        for i in indices:
-            if self._index_absent(i):
-                continue
-            expecteds = self.entries[i].exe_answers
-            gots = self.conversations[i].exe_answers
-            for question_number, (expected, got) in enumerate(zip(expecteds, gots)):
-                if question_number == len(accuracies):
-                    accuracies.append(Accuracy())
-                if equivalent_val(expected, got, rel_tol, abs_tol):
-                    accuracies[question_number].score += 1
-                accuracies[question_number].total += 1
-        for acc_item in accuracies:
-            acc_item.calculate_acc()
-        return accuracies
-
+        table = self._run_table()
+        rows = table.rows(indices)
+        return _accuracies_by_question_number(
+            table.question_numbers[rows],
+            table.computational_matches(rows, rel_tol, abs_tol),
+        )
+
+    @_memoised
     def computational_accuracy_by_question_type(
         self,
         indices: Optional[EntryKeyCollection] = None,
@@ -228,24 +334,16 @@ class Analyser:
                 It will contain two items, one for "retrieval", and
                 the other for "operation".
         """
-        indices = self._get_indices(indices)
-
-        accuracies = {"retrieval": Accuracy(), "operation": Accuracy()}
-        for i in indices:
-            if self._index_absent(i):
-                continue
-            entry = self.entries[i]
-            expecteds = entry.exe_answers
-            gots = self.conversations[i].exe_answers
-            for question_number, (expected, got) in enumerate(zip(expecteds, gots)):
-                key = "operation" if entry.is_operation(question_number) else "retrieval"
-                if equivalent_val(expected, got, rel_tol, abs_tol):
-                    accuracies[key].score += 1
-                accuracies[key].total += 1
-        for acc_item in accuracies.values():
-            acc_item.calculate_acc()
-        return accuracies
-
+        table = self._run_table()
+        rows = table.rows(indices)
+        matches = table.computational_matches(rows, rel_tol, abs_tol)
+        is_operation = table.is_operation[rows]
+        return {
+            "retrieval": _accuracy(matches[~is_operation]),
+            "operation": _accuracy(matches[is_operation]),
+        }
+
+    @_memoised
     def computational_accuracy_by_operation(
         self,
         indices: Optional[EntryKeyCollection] = None,
@@ -282,27 +380,85 @@ class Analyser:
                 It will contain one item for each possible operation that
                 can be performed.
         """
-        indices = self._get_indices(indices)
+        table = self._run_table()
+        rows = table.rows(indices)
+        rows = rows[table.is_operation[rows]]
+        return _accuracies_by_operation(
+            table.expected_op[rows],
+            table.computational_matches(rows, rel_tol, abs_tol),
+        )
+
+    def computational_accuracy_sweep(
+        self,
+        rel_tols: Sequence[float],
+        abs_tols: Sequence[float] = (0.0,),
+        indices: Optional[EntryKeyCollection] = None,
+    ) -> ToleranceSweep:
+        """Compute the computational accuracy at every pair of tolerances
+        in a grid, e.g. to plot accuracy against tolerance.
 
-        accuracies = {op: Accuracy() for op in OP_MAP}
-        for i in indices:
-            if self._index_absent(i):
-                continue
-            entry = self.entries[i]
-            operations = entry.answers
-            expecteds = entry.exe_answers
-            gots = self.conversations[i].exe_answers
-            for question_number, (expected, got, operation)  in enumerate(zip(expecteds, gots, operations)):
-                if not entry.is_operation(question_number):
-                    continue
-                op = operation.split("(")[0]
-                if equivalent_val(expected, got, rel_tol, abs_tol):
-                    accuracies[op].score += 1
-                accuracies[op].total += 1
-        for acc_item in accuracies.values():
-            acc_item.calculate_acc()
-        return accuracies
+        This gives the same accuracies as calling `computational_accuracy`
+        with each pair of tolerances, but the errors of the answers are
+        only calculated and sorted once, so a fine grid costs little
+        more than a single call.
+
+        Args:
+            rel_tols (Sequence[float]): The relative tolerances.
+            abs_tols (Sequence[float]): The absolute tolerances.
+            indices (EntryKeyCollection): An iterable containing keys
+                of the entries that you would like to include in the
+                accuracy calculation.
+
+        Returns:
+            sweep (ToleranceSweep): The accuracy at each pair of
+                tolerances, in a single group.
+        """
+        table = self.table
+        rows = table.rows(indices)
+        return _sweep(table, rows, rel_tols, abs_tols, [None], None)
+
+    def computational_accuracy_sweep_by_question_number(
+        self,
+        rel_tols: Sequence[float],
+        abs_tols: Sequence[float] = (0.0,),
+        indices: Optional[EntryKeyCollection] = None,
+    ) -> ToleranceSweep:
+        """Compute the computational accuracy by question number at every
+        pair of tolerances in a grid, in the same way as
+        `computational_accuracy_sweep`.
+
+        Returns:
+            sweep (ToleranceSweep): The accuracy at each pair of
+                tolerances, with a group for each question number.
+        """
+        table = self.table
+        rows = table.rows(indices)
+        question_numbers = table.question_numbers[rows]
+        length = int(question_numbers.max()) + 1 if len(rows) else 0
+        return _sweep(table, rows, rel_tols, abs_tols, list(range(length)), question_numbers)
 
+    def computational_accuracy_sweep_by_operation(
+        self,
+        rel_tols: Sequence[float],
+        abs_tols: Sequence[float] = (0.0,),
+        indices: Optional[EntryKeyCollection] = None,
+    ) -> ToleranceSweep:
+        """Compute the computational accuracy by operation at every pair
+        of tolerances in a grid, in the same way as
+        `computational_accuracy_sweep`. As in
+        `computational_accuracy_by_operation`, only "operation" type
+        questions are included.
+
+        Returns:
+            sweep (ToleranceSweep): The accuracy at each pair of
+                tolerances, with a group for each operation.
+        """
+        table = self.table
+        rows = table.rows(indices)
+        rows = rows[table.is_operation[rows]]
+        return _sweep(table, rows, rel_tols, abs_tols, list(OPERATIONS), table.expected_op[rows])
+
+    @_memoised
     def operation_accuracy(
         self,
         indices: Optional[EntryKeyCollection] = None,
@@ -332,23 +488,12 @@ class Analyser:
                     * `total`: total number of questions
                     * `accuracy`: `score` / `total`
         """
-        indices = self._get_indices(indices)
-
-        accuracy = Accuracy()
-        for i in indices:
-            if self._index_absent(i):
-                continue
-            entry = self.entries[i]
-            answers = self.conversations[i].answers
-            for question_number, answer in enumerate(answers):
-                if not entry.is_operation(question_number):
-                    continue
-                if entry.equivalent_operations(question_number, answer, rel_tol, abs_tol):
-                    accuracy.score += 1
-                accuracy.total += 1
-        accuracy.calculate_acc()
-        return accuracy
+        table = self._run_table()
+        rows = table.rows(indices)
+        rows = rows[table.is_operation[rows]]
+        return _accuracy(table.operation_matches(rows, rel_tol, abs_tol))
 
+    @_memoised
     def operation_accuracy_by_question_number(
         self,
         indices: Optional[EntryKeyCollection] = None,
@@ -383,26 +528,18 @@ class Analyser:
                     * `accuracy`: `score` / `total`
                 The list is indexed by question number.
             """
-        indices = self._get_indices(indices)
-
-        accuracies = []
-        for i in indices:
-            if self._index_absent(i):
-                continue
-            entry = self.entries[i]
-            answers = self.conversations[i].answers
-            for question_number, answer in enumerate(answers):
-                if question_number == len(accuracies):
-                    accuracies.append(Accuracy())
-                if not entry.is_operation(question_number):
-                    continue
-                if entry.equivalent_operations(question_number, answer, rel_tol, abs_tol):
-                    accuracies[question_number].score += 1
-                accuracies[question_number].total += 1
-        for acc_item in accuracies:
-            acc_item.calculate_acc()
-        return accuracies
-
+        table = self._run_table()
+        rows = table.rows(indices)
+        is_operation = table.is_operation[rows]
+        # Every question number gets an item, even if none of the
+        # questions with that number are operations
+        return _accuracies_by_question_number(
+            table.question_numbers[rows],
+            table.operation_matches(rows, rel_tol, abs_tol),
+            is_operation,
+        )
+
+    @_memoised
     def operation_accuracy_by_operation(
         self,
         indices: Optional[EntryKeyCollection] = None,
@@ -437,26 +574,15 @@ class Analyser:
                 It will contain one item for each possible operation that
                 can be performed.
         """
-        indices = self._get_indices(indices)
-
-        accuracies = {op: Accuracy() for op in OP_MAP}
-        for i in indices:
-            if self._index_absent(i):
-                continue
-            entry = self.entries[i]
-            operations = entry.answers
-            answers = self.conversations[i].answers
-            for question_number, (answer, operation)  in enumerate(zip(answers, operations)):
-                if not entry.is_operation(question_number):
-                    continue
-                op = operation.split("(")[0]
-                if entry.equivalent_operations(question_number, answer, rel_tol, abs_tol):
-                    accuracies[op].score += 1
-                accuracies[op].total += 1
-        for acc_item in accuracies.values():
-            acc_item.calculate_acc()
-        return accuracies
-
+        table = self._run_table()
+        rows = table.rows(indices)
+        rows = rows[table.is_operation[rows]]
+        return _accuracies_by_operation(
+            table.expected_op[rows],
+            table.operation_matches(rows, rel_tol, abs_tol),
+        )
+
+    @_memoised
     def backward_subtraction(
         self,
         indices: Optional[EntryKeyCollection] = None,
@@ -476,26 +602,13 @@ class Analyser:
                     * `total`: total number of subtraction questions
                     * `accuracy`: `score` / `total`
         """
-        indices = self._get_indices(indices)
-
-        accuracy = Accuracy()
-        for i in indices:
-            if self._index_absent(i):
-                continue
-            entry = self.entries[i]
-            operations = entry.answers
-            answers = self.conversations[i].answers
-            for question_number, (answer, operation)  in enumerate(zip(answers, operations)):
-                if not entry.is_operation(question_number):
-                    continue
-                op = operation.split("(")[0]
-                if op != "subtract":
-                    continue
-                if entry.backward_subtraction(question_number, answer, rel_tol, abs_tol):
-                    accuracy.score += 1
-                accuracy.total += 1
-        accuracy.calculate_acc()
-        return accuracy
+        table = self._run_table()
+        rows = table.rows(indices)
+        rows = rows[
+            table.is_operation[rows]
+            & (table.expected_op[rows] == SUBTRACT)
+        ]
+        return _accuracy(table.backward_subtractions(rows, rel_tol, abs_tol))
 
     def _get_indices(self, indices):
         if indices is None:
@@ -506,4 +619,127 @@ class Analyser:
         if i in self.conversations:
             return False
         # print(f"No conversation for entry {i}")
-        return True
\ No newline at end of file
+        return True
+
+
+class _ChangeCounter:
+    # A count of changes, which conversations can be given a (weak)
+    # reference to
+    __slots__ = ("count", "__weakref__")
+
+    def __init__(self):
+        self.count = 0
+
+
+class _VersionedDict(dict):
+    # A dict that counts the changes made to it, so that they can be
+    # noticed without comparing its items
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.changes = _ChangeCounter()
+
+    @property
+    def version(self):
+        return self.changes.count
+
+    def _changed(method):
+        @wraps(method)
+        def changing_method(self, *args, **kwargs):
+            self.changes.count += 1
+            return method(self, *args, **kwargs)
+        return changing_method
+
+    __setitem__ = _changed(dict.__setitem__)
+    __delitem__ = _changed(dict.__delitem__)
+    __ior__ = _changed(dict.__ior__)
+    clear = _changed(dict.clear)
+    pop = _changed(dict.pop)
+    popitem = _changed(dict.popitem)
+    setdefault = _changed(dict.setdefault)
+    update = _changed(dict.update)
+    del _changed
+
+    def __reduce__(self):
+        # Unpickled as a new dict with the same items, since the items
+        # would otherwise be set before the counter is
+        return type(self), (dict(self),)
+
+
+class _VersionedConversations(_VersionedDict):
+    # A dict of conversations that also counts the answers added to the
+    # conversations in it
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._count_changes(self.values())
+
+    def __setitem__(self, key, conversation):
+        super().__setitem__(key, conversation)
+        conversation.count_changes(self.changes)
+
+    def __ior__(self, other):
+        super().__ior__(other)
+        self._count_changes(self.values())
+        return self
+
+    def setdefault(self, key, default=None):
+        conversation = super().setdefault(key, default)
+        conversation.count_changes(self.changes)
+        return conversation
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._count_changes(self.values())
+
+    def _count_changes(self, conversations):
+        for conversation in conversations:
+            conversation.count_changes(self.changes)
+
+
+def _indices_key(indices):
+    # The metrics don't depend on the order of the indices, but do count
+    # repeated indices more than once
+    if indices is None:
+        return None
+    return frozenset(Counter(indices).items())
+
+def _sweep(table, rows, rel_tols, abs_tols, groups, row_groups):
+    rel_tols = np.asarray(rel_tols, dtype=np.float64)
+    abs_tols = np.asarray(abs_tols, dtype=np.float64)
+    if row_groups is None:
+        row_groups = np.zeros(len(rows), dtype=np.int64)
+    row_groups = row_groups.astype(np.int64)
+    # Rows in a negative group, e.g. an unknown operation, are left out
+    totals = np.bincount(row_groups[row_groups >= 0], minlength=len(groups))
+    scores = table.computational_sweep(rows, rel_tols, abs_tols, row_groups, len(groups))
+    return ToleranceSweep(rel_tols, abs_tols, groups, scores, totals)
+
+def _accuracy(matches):
+    accuracy = Accuracy(score=int(np.count_nonzero(matches)), total=len(matches))
+    accuracy.calculate_acc()
+    return accuracy
+
+def _accuracies_by_question_number(question_numbers, matches, counted=None):
+    if len(question_numbers) == 0:
+        return []
+    if counted is None:
+        counted = np.ones(len(question_numbers), dtype=bool)
+    length = question_numbers.max() + 1
+    scores = np.bincount(question_numbers[counted & matches], minlength=length)
+    totals = np.bincount(question_numbers[counted], minlength=length)
+    accuracies = [Accuracy(int(score), int(total)) for score, total in zip(scores, totals)]
+    for acc_item in accuracies:
+        acc_item.calculate_acc()
+    return accuracies
+
+def _accuracies_by_operation(ops, matches):
+    # Expected answers with an unknown operation are left out
+    known = ops >= 0
+    scores = np.bincount(ops[known & matches], minlength=len(OPERATIONS))
+    totals = np.bincount(ops[known], minlength=len(OPERATIONS))
+    accuracies = {
+        op: Accuracy(int(score), int(total))
+        for op, score, total in zip(OPERATIONS, scores, totals)
+    }
+    for acc_item in accuracies.values():
+        acc_item.calculate_acc()
+    return accuracies
@@ -0,0 +1,520 @@
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Iterator, List, Optional
+
+from huggingface_hub import InferenceClient
+
+from _extra_typing import Conversation
+
+# Matches the question number in a user message, as formatted by
+# ConversationHandler
+QUESTION_NUMBER = re.compile(r"Q(\d+): ")
+
+HF_INFERENCE_URL = "https://api-inference.huggingface.co"
+
+@dataclass
+class Completion:
+    """A response generated by a backend.
+
+    Attributes:
+        text (str): The generated text.
+        completion_tokens (int): The tokens generated.
+        prompt_tokens (Optional[int]): The tokens in the prompt, if the
+            backend reports them.
+        cached_tokens (Optional[int]): The prompt tokens that were
+            reused from the backend's prefix cache rather than
+            processed again, if the backend reports them.
+        prefill_time (Optional[float]): The time in seconds the backend
+            spent processing the prompt tokens that weren't cached, if
+            the backend reports it.
+    """
+    text: str
+    completion_tokens: int = 0
+    prompt_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None
+    prefill_time: Optional[float] = None
+
+    @property
+    def prefilled_tokens(self) -> Optional[int]:
+        """The prompt tokens that had to be processed."""
+        if self.prompt_tokens is None or self.cached_tokens is None:
+            return None
+        return self.prompt_tokens - self.cached_tokens
+
+
+class Backend:
+    """A server that generates chat completions, used by `Client`.
+
+    The first `cacheable` messages of a request are the part of the
+    prompt that is the same every time it is sent for a conversation,
+    i.e. the instructions and examples, and the context unless only the
+    parts of it relevant to each question are sent. Backends that support
+    it are told to keep that part of the prompt in their prefix (KV)
+    cache, so that it doesn't have to be processed again for every
+    question.
+
+    The async methods are given a pooled `aiohttp.ClientSession` to
+    send requests with. Backends that can't send requests asynchronously
+    run the sync methods in a thread instead.
+    """
+
+    def complete(
+        self,
+        messages: Conversation,
+        max_tokens: int,
+        stop: Optional[List[str]] = None,
+        cacheable: int = 0,
+    ) -> Completion:
+        raise NotImplementedError
+
+    def stream(
+        self,
+        messages: Conversation,
+        max_tokens: int,
+        stop: Optional[List[str]] = None,
+        cacheable: int = 0,
+    ) -> Iterator[str]:
+        """Generate a completion, yielding each token as it is
+        generated. Closing the iterator stops the generation.
+        """
+        raise NotImplementedError
+
+    async def acomplete(
+        self,
+        messages: Conversation,
+        max_tokens: int,
+        stop: Optional[List[str]] = None,
+        cacheable: int = 0,
+        session=None,
+    ) -> Completion:
+        return await asyncio.to_thread(self.complete, messages, max_tokens, stop, cacheable)
+
+    async def astream(
+        self,
+        messages: Conversation,
+        max_tokens: int,
+        stop: Optional[List[str]] = None,
+        cacheable: int = 0,
+        session=None,
+    ) -> AsyncIterator[str]:
+        """Generate a completion asynchronously, yielding each token as
+        it is generated. Defaults to yielding the whole completion at
+        once.
+        """
+        completion = await self.acomplete(messages, max_tokens, stop, cacheable, session)
+        yield completion.text
+
+
+class HuggingFaceBackend(Backend):
+    """The HuggingFace inference API.
+
+    The API doesn't take any cache hints, so `cacheable` is ignored,
+    although text-generation-inference servers reuse cached prefixes
+    automatically. Async requests are sent to the API's OpenAI-compatible
+    route, so that they can share a pooled session.
+
+    Args:
+        model (str): The model to use.
+        token (str): A HuggingFace token.
+    """
+
+    def __init__(self, model: str, token: Optional[str]):
+        self.model = model
+        self._client = InferenceClient(model, token=token)
+
+    def complete(self, messages, max_tokens, stop=None, cacheable=0):
+        output = self._client.chat_completion(
+            messages=messages,
+            max_tokens=max_tokens,
+            stop=stop,
+        )
+        usage = output.usage
+        return Completion(
+            output.choices[0].message.content.strip(),
+            completion_tokens=usage.completion_tokens if usage else 0,
+            prompt_tokens=usage.prompt_tokens if usage else None,
+        )
+
+    def stream(self, messages, max_tokens, stop=None, cacheable=0):
+        chunks = self._client.chat_completion(
+            messages=messages,
+            max_tokens=max_tokens,
+            stop=stop,
+            stream=True,
+        )
+        try:
+            for chunk in chunks:
+                yield chunk.choices[0].delta.content or ""
+        finally:
+            # Closing the generator closes the connection, which stops
+            # the server from generating any more tokens
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    async def acomplete(self, messages, max_tokens, stop=None, cacheable=0, session=None):
+        return await self._http().acomplete(messages, max_tokens, stop, cacheable, session)
+
+    async def astream(self, messages, max_tokens, stop=None, cacheable=0, session=None):
+        chunks = self._http().astream(messages, max_tokens, stop, cacheable, session)
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+    def _http(self):
+        # The OpenAI-compatible route that InferenceClient sends chat
+        # completions to
+        model = self._client.model
+        token = self._client.token
+        if model.startswith(("http://", "https://")):
+            return OpenAICompatibleBackend(model, api_key=token, endpoint="")
+        return OpenAICompatibleBackend(
+            f"{HF_INFERENCE_URL}/models/{model}", model=model, api_key=token
+        )
+
+
+class OpenAICompatibleBackend(Backend):
+    """A server with an OpenAI-compatible chat completions endpoint.
+
+    Args:
+        base_url (str): The URL of the server, e.g.
+            "http://localhost:8080".
+        model (Optional[str]): The model to ask the server for, if it
+            serves more than one.
+        api_key (Optional[str]): A key to authenticate with, if the
+            server needs one.
+        timeout (float): The time in seconds to wait for a response to
+            a sync request. Async requests use the session's timeouts.
+        endpoint (str): The path of the chat completions endpoint.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        model: Optional[str] = None,
+        api_key: Optional[str] = None,
+        timeout: float = 120,
+        endpoint: str = "/v1/chat/completions",
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.api_key = api_key
+        self.timeout = timeout
+        self.endpoint = endpoint
+
+    def complete(self, messages, max_tokens, stop=None, cacheable=0):
+        with self._request(messages, max_tokens, stop, cacheable, stream=False) as response:
+            output = json.load(response)
+        return self._completion(output)
+
+    def stream(self, messages, max_tokens, stop=None, cacheable=0):
+        response = self._request(messages, max_tokens, stop, cacheable, stream=True)
+        try:
+            for line in response:
+                chunk = self._chunk(line)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            response.close()
+
+    async def acomplete(self, messages, max_tokens, stop=None, cacheable=0, session=None):
+        if session is None:
+            async with new_session() as session:
+                return await self.acomplete(messages, max_tokens, stop, cacheable, session)
+        body = self._body(messages, max_tokens, stop, cacheable, stream=False)
+        async with session.post(self._url(), json=body, headers=self._headers()) as response:
+            response.raise_for_status()
+            output = await response.json(content_type=None)
+        return self._completion(output)
+
+    async def astream(self, messages, max_tokens, stop=None, cacheable=0, session=None):
+        if session is None:
+            async with new_session() as session:
+                async for chunk in self.astream(messages, max_tokens, stop, cacheable, session):
+                    yield chunk
+            return
+        body = self._body(messages, max_tokens, stop, cacheable, stream=True)
+        # Leaving the context manager early releases the connection,
+        # which stops the server from generating any more tokens
+        async with session.post(self._url(), json=body, headers=self._headers()) as response:
+            response.raise_for_status()
+            async for line in response.content:
+                chunk = self._chunk(line)
+                if chunk is None:
+                    break
+                yield chunk
+
+    def _completion(self, output):
+        usage = output.get("usage") or {}
+        return Completion(
+            (output["choices"][0]["message"]["content"] or "").strip(),
+            completion_tokens=usage.get("completion_tokens", 0),
+            prompt_tokens=usage.get("prompt_tokens"),
+            cached_tokens=self._cached_tokens(output),
+            prefill_time=self._prefill_time(output),
+        )
+
+    def _chunk(self, line):
+        # The token in a line of a streamed response, which is sent as
+        # server-sent events, one "data: {chunk}" line per token. Lines
+        # without a token give "", and the end of the stream None
+        line = line.decode().strip()
+        if not line.startswith("data:"):
+            return ""
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return None
+        choices = json.loads(data).get("choices")
+        if not choices:
+            return ""
+        return choices[0].get("delta", {}).get("content") or ""
+
+    def _request(self, messages, max_tokens, stop, cacheable, stream):
+        request = urllib.request.Request(
+            self._url(),
+            data=json.dumps(self._body(messages, max_tokens, stop, cacheable, stream)).encode(),
+            headers=self._headers(),
+        )
+        return urllib.request.urlopen(request, timeout=self.timeout)
+
+    def _url(self):
+        return f"{self.base_url}{self.endpoint}"
+
+    def _body(self, messages, max_tokens, stop, cacheable, stream):
+        body = {
+            "messages": list(messages),
+            "max_tokens": max_tokens,
+            "stream": stream,
+        }
+        if self.model is not None:
+            body["model"] = self.model
+        if stop:
+            body["stop"] = stop
+        body.update(self._cache_hints(messages, cacheable))
+        return body
+
+    def _headers(self):
+        headers = {"Content-Type": "application/json"}
+        if self.api_key is not None:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def _cache_hints(self, messages, cacheable):
+        # Extra request fields telling the server what to cache
+        return {}
+
+    def _cached_tokens(self, output):
+        details = (output.get("usage") or {}).get("prompt_tokens_details") or {}
+        return details.get("cached_tokens")
+
+    def _prefill_time(self, output):
+        return None
+
+
+class LlamaCppBackend(OpenAICompatibleBackend):
+    """A llama.cpp server.
+
+    Requests are sent with `cache_prompt`, so the server keeps the
+    prompt's KV cache in the slot that processed it and only processes
+    the part of the next prompt that differs. With more than one slot,
+    pass `slots` so that every request for a conversation is sent to the
+    same slot, chosen by a hash of its cacheable prefix; otherwise the
+    server may give it a slot that has a different conversation cached.
+    Requests whose cacheable prefix is shared with other conversations,
+    e.g. because the context is retrieved for each question, are left
+    for the server to place, rather than all being sent to one slot.
+
+    Args:
+        base_url (str): The URL of the server, e.g.
+            "http://localhost:8080".
+        slots (Optional[int]): The number of slots the server was
+            started with (`--parallel`), or None to let the server
+            choose.
+        **kwargs: Passed to `OpenAICompatibleBackend`.
+    """
+
+    def __init__(self, base_url: str, slots: Optional[int] = None, **kwargs):
+        super().__init__(base_url, **kwargs)
+        self.slots = slots
+
+    def _cache_hints(self, messages, cacheable):
+        hints = {"cache_prompt": True}
+        if self.slots is not None and cacheable > getattr(messages, "shared", 0):
+            prefix = json.dumps(list(messages[:cacheable]), sort_keys=True)
+            digest = hashlib.sha256(prefix.encode()).digest()
+            hints["id_slot"] = int.from_bytes(digest[:8], "big") % self.slots
+        return hints
+
+    def _cached_tokens(self, output):
+        timings = output.get("timings") or {}
+        if "cache_n" in timings:
+            return timings["cache_n"]
+        return super()._cached_tokens(output)
+
+    def _prefill_time(self, output):
+        timings = output.get("timings") or {}
+        if "prompt_ms" in timings:
+            return timings["prompt_ms"] / 1000
+        return None
+
+
+class VLLMBackend(OpenAICompatibleBackend):
+    """A vLLM server.
+
+    vLLM caches prompt prefixes automatically when started with
+    `--enable-prefix-caching`, so no hints are needed, and reports the
+    cached tokens when started with `--enable-prompt-tokens-details`.
+    """
+
+
+class StubBackend(Backend):
+    """A local stand-in for a server with a prefix cache, for testing
+    and benchmarking offline.
+
+    Processing the prompt takes `seconds_per_prompt_token` for each
+    token that isn't cached, and the server caches the prompts of the
+    last `cache_size` requests sent with a cacheable prefix. Prompts are
+    matched a message at a time, so a prompt's longest run of leading
+    messages that is the same as a cached prompt's is reused. Tokens are
+    estimated as four characters each.
+
+    Args:
+        responder (Optional[Callable[[Conversation], str]]): A function
+            that generates the response to some messages. Defaults to
+            answering every question with "ANS{i} = 0".
+        seconds_per_prompt_token (float): The simulated time to process
+            each prompt token that isn't cached.
+        cache_size (int): The number of prompts to keep cached.
+        prefix_caching (bool): Whether the server caches prompts at all.
+
+    Attributes:
+        requests (int): The number of requests handled.
+    """
+
+    def __init__(
+        self,
+        responder: Optional[Callable[[Conversation], str]] = None,
+        seconds_per_prompt_token: float = 2e-5,
+        cache_size: int = 16,
+        prefix_caching: bool = True,
+    ):
+        self.responder = responder if responder is not None else _answer_zero
+        self.seconds_per_prompt_token = seconds_per_prompt_token
+        self.cache_size = cache_size
+        self.prefix_caching = prefix_caching
+        self.requests = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def complete(self, messages, max_tokens, stop=None, cacheable=0):
+        completion = self._completion(messages, cacheable)
+        time.sleep(completion.prefill_time)
+        return completion
+
+    def stream(self, messages, max_tokens, stop=None, cacheable=0):
+        completion = self.complete(messages, max_tokens, stop, cacheable)
+        for i in range(0, len(completion.text), 4):
+            yield completion.text[i:i + 4]
+
+    async def acomplete(self, messages, max_tokens, stop=None, cacheable=0, session=None):
+        completion = self._completion(messages, cacheable)
+        await asyncio.sleep(completion.prefill_time)
+        return completion
+
+    async def astream(self, messages, max_tokens, stop=None, cacheable=0, session=None):
+        completion = await self.acomplete(messages, max_tokens, stop, cacheable)
+        for i in range(0, len(completion.text), 4):
+            yield completion.text[i:i + 4]
+
+    def _completion(self, messages, cacheable):
+        prompt_tokens, cached_tokens = self._prefill(messages, cacheable)
+        text = self.responder(messages)
+        return Completion(
+            text,
+            completion_tokens=len(text) // 4,
+            prompt_tokens=prompt_tokens,
+            cached_tokens=cached_tokens,
+            prefill_time=(prompt_tokens - cached_tokens) * self.seconds_per_prompt_token,
+        )
+
+    # The lock can't be pickled, and conversation handlers (and so their
+    # clients' backends) get pickled with runs
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _prefill(self, messages, cacheable):
+        # The prompt tokens, and how many of them were cached. Like a
+        # real server, prompts are only cached and reused when asked to
+        keys = []
+        tokens = []
+        for message in messages:
+            previous = keys[-1] if keys else ""
+            message = json.dumps(message, sort_keys=True)
+            keys.append(hashlib.sha256((previous + message).encode()).hexdigest())
+            tokens.append(len(message) // 4)
+        with self._lock:
+            self.requests += 1
+            if not (self.prefix_caching and cacheable):
+                return sum(tokens), 0
+            # Each message's key covers every message before it, so the
+            # longest shared run of messages ends at the last shared key
+            matched = 0
+            matched_prompt = None
+            for prompt, cached_keys in self._cache.items():
+                n = len(set(keys) & set(cached_keys))
+                if n > matched:
+                    matched, matched_prompt = n, prompt
+            if matched_prompt is not None:
+                self._cache.move_to_end(matched_prompt)
+            self._cache[keys[-1]] = keys
+            self._cache.move_to_end(keys[-1])
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return sum(tokens), sum(tokens[:matched])
+
+
+def new_session(
+    pool_size: int = 100,
+    timeout: Optional[float] = 120,
+    connect_timeout: Optional[float] = 10,
+    keepalive_timeout: float = 30,
+):
+    """Create an aiohttp session that keeps up to `pool_size`
+    connections open for reuse.
+
+    Args:
+        pool_size (int): The maximum number of connections open at once.
+            Requests beyond this wait for a connection to be free.
+        timeout (Optional[float]): The time in seconds to wait for a
+            whole request, or None for no limit.
+        connect_timeout (Optional[float]): The time in seconds to wait
+            for a connection, including waiting for one from the pool.
+        keepalive_timeout (float): The time in seconds to keep an idle
+            connection open.
+    """
+    # aiohttp is only needed for async requests
+    import aiohttp
+
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=pool_size, keepalive_timeout=keepalive_timeout),
+        timeout=aiohttp.ClientTimeout(total=timeout, connect=connect_timeout),
+    )
+
+def _answer_zero(messages):
+    match = QUESTION_NUMBER.search(messages[-1]["content"])
+    return f"ANS{match.group(1) if match else 0} = 0"
@@ -0,0 +1,345 @@
+from dataclasses import dataclass
+from typing import Dict, List, Mapping, Sequence
+
+import numpy as np
+
+from utils import Literal, Ref, Program, parse_answer
+from _consts import OP_MAP
+from _extra_typing import EntryKey
+
+# Operations are stored as their index in OP_MAP
+OPERATIONS = list(OP_MAP)
+ADD, SUBTRACT, MULTIPLY, DIVIDE, EXP, GREATER = (
+    OPERATIONS.index(op) for op in ["add", "subtract", "multiply", "divide", "exp", "greater"]
+)
+
+# Kinds of arguments and answers
+LITERAL = 0
+REF = 1
+STEP_REF = 2
+INVALID = 3
+PROGRAM = 4
+
+@dataclass
+class CompiledRun:
+    """The answers of a whole run, compiled into flat arrays.
+
+    Every answer is a row, and every step of every program is an
+    instruction. Rows and instructions only refer back to earlier
+    answers in the same entry and earlier steps in the same program,
+    so they can be executed in waves: one wave for the references at
+    each question number, then one per step, each wave evaluating all
+    of its instructions at once with NumPy.
+
+    Attributes:
+        entry_rows (Dict[EntryKey, Tuple[int, int]]): The start and stop
+            row of each entry.
+        row_kind (np.ndarray): Whether each answer is a literal,
+            reference, program, or couldn't be parsed.
+        row_question (np.ndarray): The question number of each row.
+        row_value (np.ndarray): The value of literal answers.
+        row_ref (np.ndarray): The row that reference answers refer to.
+        row_last (np.ndarray): The last instruction of program answers.
+        instr_row (np.ndarray): The row of each instruction.
+        instr_step (np.ndarray): The step number of each instruction.
+        instr_op (np.ndarray): The index in OP_MAP of each operation.
+        arg_kind (np.ndarray): The kind of each of the two arguments.
+        arg_value (np.ndarray): The value of literal arguments.
+        arg_index (np.ndarray): The row that reference arguments refer
+            to, or the instruction that step references refer to.
+    """
+    entry_rows: Dict[EntryKey, tuple]
+    row_kind: np.ndarray
+    row_question: np.ndarray
+    row_value: np.ndarray
+    row_ref: np.ndarray
+    row_last: np.ndarray
+    instr_row: np.ndarray
+    instr_step: np.ndarray
+    instr_op: np.ndarray
+    arg_kind: np.ndarray
+    arg_value: np.ndarray
+    arg_index: np.ndarray
+
+    def __len__(self):
+        return len(self.row_kind)
+
+
+@dataclass
+class BatchResult:
+    """The executed answers of a compiled run.
+
+    Attributes:
+        values (np.ndarray): The executed answer of each row, or NaN if
+            it couldn't be executed. The result of "greater" is stored
+            as 1.0 for "yes" and 0.0 for "no".
+        yes_no (np.ndarray): Whether each row is the result of "greater".
+    """
+    values: np.ndarray
+    yes_no: np.ndarray
+
+    def answer(self, row: int):
+        """Get the executed answer of a row, as `execute_answer` would."""
+        if self.yes_no[row]:
+            return "yes" if self.values[row] == 1 else "no"
+        return float(self.values[row])
+
+
+def compile_run(answers: Mapping[EntryKey, Sequence[str]]) -> CompiledRun:
+    """Compile the answers of each entry into flat arrays.
+
+    Each distinct answer is only compiled once, and then copied to the
+    rows it appears in with array indexing.
+
+    Args:
+        answers (Mapping[EntryKey, Sequence[str]]): The (extracted)
+            answers of each entry, in question order.
+    """
+    codes = {}
+    row_codes = []
+    entry_rows = {}
+    for entry_id, entry_answers in answers.items():
+        start = len(row_codes)
+        row_codes.extend(codes.setdefault(answer, len(codes)) for answer in entry_answers)
+        entry_rows[entry_id] = (start, len(row_codes))
+    unique = _compile_answers(list(codes))
+
+    row_codes = np.array(row_codes, dtype=np.int64)
+    starts, stops = np.array(list(entry_rows.values()), dtype=np.int64).reshape(-1, 2).T
+    row_question = np.arange(len(row_codes)) - np.repeat(starts, stops - starts)
+    row_kind = unique["kind"][row_codes]
+
+    # Copy the instructions of each row's answer, in row order
+    n_steps = unique["n_steps"][row_codes]
+    instr_row = np.repeat(np.arange(len(row_codes)), n_steps)
+    first_instr = np.cumsum(n_steps) - n_steps
+    instr_step = np.arange(len(instr_row)) - np.repeat(first_instr, n_steps)
+    source = unique["first_instr"][row_codes][instr_row] + instr_step
+    arg_kind = unique["arg_kind"][source]
+    arg_index = unique["arg_index"][source]
+
+    # References were compiled relative to the answer, so resolve them
+    # to rows and instructions in the whole run
+    row_ref, valid = _resolve_refs(unique["ref"][row_codes], np.arange(len(row_codes)), row_question)
+    row_kind[(row_kind == REF) & ~valid] = INVALID
+    arg_rows = np.repeat(instr_row, 2).reshape(-1, 2)
+    arg_refs, valid = _resolve_refs(arg_index, arg_rows, row_question[arg_rows])
+    arg_kind[(arg_kind == REF) & ~valid] = INVALID
+    arg_index = np.where(
+        arg_kind == STEP_REF, (first_instr[instr_row])[:, None] + arg_index, arg_refs
+    )
+
+    row_last = np.where(n_steps > 0, first_instr + n_steps - 1, -1)
+    return CompiledRun(
+        entry_rows=entry_rows,
+        row_kind=row_kind,
+        row_question=row_question,
+        row_value=unique["value"][row_codes],
+        row_ref=row_ref,
+        row_last=row_last,
+        instr_row=instr_row,
+        instr_step=instr_step,
+        instr_op=unique["op"][source],
+        arg_kind=arg_kind,
+        arg_value=unique["arg_value"][source],
+        arg_index=arg_index,
+    )
+
+def execute_run(run: CompiledRun) -> BatchResult:
+    """Execute every answer in a compiled run.
+
+    The results are the same as calling `execute_answer` on each answer
+    in turn, with NaN for answers that raise an exception, except that
+    raising a negative number to a fractional power gives NaN rather
+    than a complex number, and "exp" may differ in the last digit.
+    """
+    values = np.full(len(run), np.nan)
+    yes_no = np.zeros(len(run), dtype=bool)
+    # References to other answers must be to numbers that aren't NaN
+    usable = np.zeros(len(run), dtype=bool)
+
+    literals = run.row_kind == LITERAL
+    values[literals] = run.row_value[literals]
+    usable[literals] = ~np.isnan(run.row_value[literals])
+
+    n_instrs = len(run.instr_row)
+    instr_values = np.full(n_instrs, np.nan)
+    instr_yes_no = np.zeros(n_instrs, dtype=bool)
+    # Whether each instruction and all of the steps before it succeeded
+    instr_ok = np.zeros(n_instrs, dtype=bool)
+
+    refs = np.flatnonzero(run.row_kind == REF)
+    programs = np.flatnonzero(run.row_kind == PROGRAM)
+    instrs_by_wave = _group_by(
+        run.row_question[run.instr_row], run.instr_step, np.arange(n_instrs)
+    )
+    refs_by_question = _group_by(run.row_question[refs], 0, refs)
+    programs_by_question = _group_by(run.row_question[programs], 0, programs)
+
+    n_questions = run.row_question.max() + 1 if len(run) else 0
+    for question_number in range(n_questions):
+        rows = refs_by_question.get((question_number, 0))
+        if rows is not None:
+            sources = run.row_ref[rows]
+            ok = usable[sources]
+            values[rows] = np.where(ok, values[sources], np.nan)
+            usable[rows] = ok
+
+        step = 0
+        while (question_number, step) in instrs_by_wave:
+            wave = instrs_by_wave[(question_number, step)]
+            args, ok = _gather_args(run, wave, values, usable, instr_values, instr_ok, instr_yes_no)
+            if step > 0:
+                ok &= instr_ok[wave - 1]
+            results, is_yes_no, op_ok = _apply(run.instr_op[wave], args[:, 0], args[:, 1])
+            instr_values[wave] = results
+            instr_yes_no[wave] = is_yes_no
+            instr_ok[wave] = ok & op_ok
+            step += 1
+
+        rows = programs_by_question.get((question_number, 0))
+        if rows is not None:
+            last = run.row_last[rows]
+            ok = instr_ok[last]
+            values[rows] = np.where(ok, instr_values[last], np.nan)
+            yes_no[rows] = ok & instr_yes_no[last]
+            usable[rows] = ok & ~instr_yes_no[last] & ~np.isnan(instr_values[last])
+
+    return BatchResult(values, yes_no)
+
+def rescore_run(conversations) -> Dict[EntryKey, List]:
+    """Re-execute the answers of every conversation in a run.
+
+    Args:
+        conversations (Dict[EntryKey, ConversationHandler]): The
+            conversations from a run.
+
+    Returns:
+        exe_answers (Dict[EntryKey, List]): The executed answers of each
+            conversation, in the same form as `exe_answers`.
+    """
+    run = compile_run({i: ch.answers for i, ch in conversations.items()})
+    result = execute_run(run)
+    return {
+        i: [result.answer(row) for row in range(start, stop)]
+        for i, (start, stop) in run.entry_rows.items()
+    }
+
+def _compile_answers(answers):
+    # Compile each answer into its kind, value and reference, and the
+    # operations and arguments of its steps. Argument indices are
+    # relative to the answer
+    columns = {name: [] for name in ["kind", "value", "ref", "n_steps", "first_instr"]}
+    instrs = {name: [] for name in ["op", "arg_kind", "arg_value", "arg_index"]}
+    for answer in answers:
+        kind, value, ref, steps = INVALID, np.nan, 0, ()
+        try:
+            parsed = parse_answer(answer)
+        except Exception:
+            parsed = None
+        if isinstance(parsed, Literal):
+            kind, value = LITERAL, parsed.value
+        elif isinstance(parsed, Ref):
+            kind, ref = REF, parsed.index
+        elif isinstance(parsed, Program):
+            kind, steps = PROGRAM, parsed.steps
+        columns["kind"].append(kind)
+        columns["value"].append(value)
+        columns["ref"].append(ref)
+        columns["n_steps"].append(len(steps))
+        columns["first_instr"].append(len(instrs["op"]))
+        for op, args in steps:
+            instrs["op"].append(OPERATIONS.index(op))
+            for arg in args:
+                if isinstance(arg, Literal):
+                    instrs["arg_kind"].append(LITERAL)
+                    instrs["arg_value"].append(arg.value)
+                    instrs["arg_index"].append(0)
+                else:
+                    instrs["arg_kind"].append(REF if isinstance(arg, Ref) else STEP_REF)
+                    instrs["arg_value"].append(np.nan)
+                    instrs["arg_index"].append(arg.index)
+    return {
+        "kind": np.array(columns["kind"], dtype=np.int8),
+        "value": np.array(columns["value"], dtype=np.float64),
+        "ref": np.array(columns["ref"], dtype=np.int64),
+        "n_steps": np.array(columns["n_steps"], dtype=np.int64),
+        "first_instr": np.array(columns["first_instr"], dtype=np.int64),
+        "op": np.array(instrs["op"], dtype=np.int8),
+        "arg_kind": np.array(instrs["arg_kind"], dtype=np.int8).reshape(-1, 2),
+        "arg_value": np.array(instrs["arg_value"], dtype=np.float64).reshape(-1, 2),
+        "arg_index": np.array(instrs["arg_index"], dtype=np.int64).reshape(-1, 2),
+    }
+
+def _resolve_refs(indices, rows, question_numbers):
+    # References are indices into the answers before this one in the
+    # same entry, and can be negative, as in a Python list
+    indices = np.where(indices < 0, indices + question_numbers, indices)
+    valid = (indices >= 0) & (indices < question_numbers)
+    return np.where(valid, rows - question_numbers + indices, -1), valid
+
+def _group_by(first, second, values):
+    # Group values by pairs of keys, keeping each group in order
+    first = np.asarray(first)
+    second = np.broadcast_to(second, first.shape)
+    if not len(values):
+        return {}
+    order = np.lexsort((second, first))
+    first, second, values = first[order], second[order], values[order]
+    splits = np.flatnonzero((np.diff(first) != 0) | (np.diff(second) != 0)) + 1
+    starts = np.concatenate([[0], splits])
+    return {
+        (int(first[k]), int(second[k])): group
+        for k, group in zip(starts, np.split(values, splits))
+    }
+
+def _gather_args(run, wave, values, usable, instr_values, instr_ok, instr_yes_no):
+    kinds = run.arg_kind[wave]
+    indices = run.arg_index[wave]
+    args = run.arg_value[wave].copy()
+    ok = kinds == LITERAL
+
+    refs = kinds == REF
+    args[refs] = values[indices[refs]]
+    ok[refs] = usable[indices[refs]]
+
+    # Unlike references to answers, references to steps may be NaN, but
+    # "yes" and "no" can't be used in an operation (other than by
+    # accident, as in "no" + "no")
+    step_refs = kinds == STEP_REF
+    sources = indices[step_refs]
+    args[step_refs] = instr_values[sources]
+    ok[step_refs] = instr_ok[sources] & ~instr_yes_no[sources]
+    return args, ok.all(axis=1)
+
+def _apply(ops, x, y):
+    # Evaluate each operation group with array arithmetic. Operations
+    # that raise an exception in Python are marked as not ok
+    results = np.full(len(ops), np.nan)
+    ok = np.ones(len(ops), dtype=bool)
+    with np.errstate(all="ignore"):
+        for op in np.unique(ops):
+            group = ops == op
+            a, b = x[group], y[group]
+            if op == ADD:
+                results[group] = a + b
+            elif op == SUBTRACT:
+                results[group] = a - b
+            elif op == MULTIPLY:
+                results[group] = a * b
+            elif op == DIVIDE:
+                results[group] = a / b
+                ok[group] = b != 0
+            elif op == EXP:
+                result = np.power(a, b)
+                results[group] = result
+                # Python raises for 0 to a negative power and overflow,
+                # and gives a complex number (here NaN) for a negative
+                # number to a fractional power
+                ok[group] = (
+                    ~((a == 0) & (b < 0))
+                    & ~(np.isinf(result) & np.isfinite(a) & np.isfinite(b))
+                )
+            elif op == GREATER:
+                results[group] = (a > b).astype(np.float64)
+    return results, ops == GREATER, ok
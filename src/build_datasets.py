@@ -0,0 +1,417 @@
+import hashlib
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+# Bumped whenever the processing of a record changes, so that an
+# incremental build reprocesses everything
+PIPELINE_VERSION = 1
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+@dataclass
+class BuildReport:
+    """A summary of a dataset build.
+
+    Attributes:
+        processed (int): The number of records processed.
+        unchanged (int): The number of records skipped because they
+            hadn't changed since the last build.
+        failed (Dict[int, str]): The error for each record that couldn't
+            be processed, by position in the raw file.
+        shards (List[str]): The paths of the shards written.
+    """
+    processed: int = 0
+    unchanged: int = 0
+    failed: Dict[int, str] = field(default_factory=dict)
+    shards: List[str] = field(default_factory=list)
+
+
+def build_dataset(
+    raw_file_path: str,
+    out_dir: str,
+    name: Optional[str] = None,
+    shard_size: int = 1000,
+    max_workers: Optional[int] = None,
+    incremental: bool = False,
+) -> BuildReport:
+    """Convert a raw ConvFinQA file into processed dataset shards.
+
+    Records are read from the raw file one at a time and processed in a
+    pool of worker processes. Shard `k` holds the records at positions
+    `k * shard_size` to `(k + 1) * shard_size - 1` in the raw file, keyed
+    by their position, in the same format as the files read by
+    `load_data`. Each shard is written as soon as all of its records
+    are done.
+
+    A manifest of the hash of every record is kept in `out_dir`. In
+    incremental mode, records whose hash hasn't changed are taken from
+    the existing shards rather than processed again, and shards with no
+    changed records aren't rewritten at all.
+
+    Args:
+        raw_file_path (str): The path to the raw JSON file, e.g.
+            "data/raw/train.json".
+        out_dir (str): The directory to write the shards to.
+        name (Optional[str]): The prefix of the shard file names.
+            Defaults to the name of the raw file.
+        shard_size (int): The number of records in each shard.
+        max_workers (Optional[int]): The number of worker processes.
+            Defaults to the number of CPUs.
+        incremental (bool): Whether to only process changed records.
+
+    Returns:
+        report (BuildReport): A summary of the build.
+    """
+    if name is None:
+        name = os.path.splitext(os.path.basename(raw_file_path))[0]
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, MANIFEST_FILE_NAME)
+    old_manifest = _load_manifest(manifest_path) if incremental else {}
+    if old_manifest.get("shard_size") != shard_size or old_manifest.get("name") != name:
+        old_manifest = {}
+    # Records in shards that have gone missing must be processed again
+    old_hashes = {
+        k: v for k, v in old_manifest.get("records", {}).items()
+        if os.path.exists(_shard_path(out_dir, name, int(k) // shard_size))
+    }
+    hashes = {}
+    report = BuildReport()
+
+    with ProcessPoolExecutor(max_workers) as executor:
+        # Records are submitted in order and results collected in order,
+        # with a bounded number in flight so the whole file is never in
+        # memory at once
+        in_flight = deque()
+        max_in_flight = 4 * (max_workers or os.cpu_count() or 1)
+        shard = _Shard(0, shard_size)
+
+        def collect():
+            nonlocal shard
+            position, record_hash, result = in_flight.popleft()
+            if position >= shard.stop:
+                _finish_shard(shard, out_dir, name, old_hashes, hashes, report)
+                shard = _Shard(position // shard_size, shard_size)
+            if result is not None:
+                result = result.result()
+            shard.add(position, record_hash, result)
+
+        for position, record in enumerate(iter_raw_records(raw_file_path)):
+            record_hash = record_digest(record)
+            hashes[str(position)] = record_hash
+            if old_hashes.get(str(position)) == record_hash:
+                in_flight.append((position, record_hash, None))
+            else:
+                in_flight.append(
+                    (position, record_hash, executor.submit(_process_safely, record))
+                )
+            while len(in_flight) > max_in_flight:
+                collect()
+        while in_flight:
+            collect()
+        _finish_shard(shard, out_dir, name, old_hashes, hashes, report)
+
+    # Remove shards past the end of a raw file that has shrunk
+    shard_count = -(-len(hashes) // shard_size)
+    for path in old_manifest.get("shards", []):
+        if _shard_number(path) >= shard_count and os.path.exists(path):
+            os.remove(path)
+
+    _write_json(manifest_path, {
+        "version": PIPELINE_VERSION,
+        "name": name,
+        "shard_size": shard_size,
+        "records": hashes,
+        "shards": [_shard_path(out_dir, name, k) for k in range(shard_count)],
+    })
+    return report
+
+def iter_raw_records(file_path: str, chunk_size: int = 2 ** 20) -> Iterator[Dict[str, Any]]:
+    """Read the records in a raw JSON file one at a time.
+
+    The raw files are a JSON list of records, and are parsed
+    incrementally, so only one chunk of the file and one record need to
+    be in memory at once.
+    """
+    decoder = json.JSONDecoder()
+    with open(file_path, encoding="utf-8") as json_file:
+        reader = _Reader(json_file, chunk_size)
+        if reader.next_char() != "[":
+            raise ValueError(f"{file_path} should contain a JSON list of records")
+        reader.pos += 1
+        if reader.next_char() == "]":
+            return
+        while True:
+            reader.next_char()
+            while True:
+                try:
+                    record, end = decoder.raw_decode(reader.buffer, reader.pos)
+                    break
+                except json.JSONDecodeError:
+                    if not reader.fill():
+                        raise
+            reader.pos = end
+            yield record
+            separator = reader.next_char()
+            reader.pos += 1
+            if separator == "]":
+                return
+            if separator != ",":
+                raise ValueError(f"Expected \",\" or \"]\" in {file_path} but got {separator!r}")
+
+def record_digest(record: Dict[str, Any]) -> str:
+    """A hash of a raw record and the version of the pipeline."""
+    source = json.dumps([PIPELINE_VERSION, record], sort_keys=True)
+    return hashlib.sha256(source.encode()).hexdigest()
+
+def process_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert a raw record into a processed entry.
+
+    Records with a "step_list" are converted into answers as follows:
+        * retrieved numbers are kept as they are
+        * operations are written in the form "operation(arg1, arg2)",
+          with references to earlier answers written as ANS{j}
+        * operations that depend on steps which weren't asked as a
+          question (their question is "n/a") include those steps first,
+          with references to them written as "#k", e.g.
+              add(35, 33);divide(#0, 2)
+          unless the same step was asked earlier, in which case its
+          answer is referred to instead.
+    Records without a "step_list" (e.g. from the test split) have no
+    answers.
+    """
+    annotation = record["annotation"]
+    entry = {"type": record_type(record)}
+    if "amt_table" in annotation:
+        entry["context"] = " ".join(
+            [annotation["amt_pre_text"], annotation["amt_table"], annotation["amt_post_text"]]
+        )
+    else:
+        entry["context"] = " ".join(
+            [" ".join(record["pre_text"]), render_table(record["table"]), " ".join(record["post_text"])]
+        )
+    entry["answers"] = create_answers(annotation) if "step_list" in annotation else []
+    entry["dialogue_break"] = annotation["dialogue_break"]
+    entry["exe_ans_list"] = annotation.get("exe_ans_list", [])
+    if "id" in record:
+        entry["source_id"] = record["id"]
+    return entry
+
+def record_type(record: Dict[str, Any]) -> int:
+    # Type 1 entries come from a single FinQA question, and type 2 from
+    # two. Records without the questions are typed by their id
+    if "qa" in record:
+        return 1
+    if "qa_0" in record and "qa_1" in record:
+        return 2
+    if record.get("id", "").startswith("Single_"):
+        return 1
+    if record.get("id", "").startswith("Double_"):
+        return 2
+    raise ValueError("Can't tell whether the record has one or two questions")
+
+def render_table(table: List[List[str]]) -> str:
+    """Render a table as HTML, with each row numbered, as in the
+    processed contexts.
+    """
+    rows = "".join(
+        "<tr>" + "".join(f"<td>{cell}</td>" for cell in [str(i + 1), *row]) + "</tr>"
+        for i, row in enumerate(table)
+    )
+    return f"<table class='wikitable'>{rows}</table>"
+
+def create_answers(annotation: Dict[str, Any]) -> List[str]:
+    answers = []
+    # The answer or hidden step that each label (e.g. "A0" or "#1")
+    # in the step list refers to
+    labels = {}
+    asked_steps = {}
+    for step, label, question in zip(
+        annotation["step_list"], annotation["answer_list"], annotation["dialogue_break_ori"]
+    ):
+        is_step = label.startswith("A") or label.startswith("#")
+        if question == "n/a":
+            if is_step:
+                labels[label] = asked_steps.get(step, step)
+            continue
+        if is_step:
+            answers.append(_build_program(step, labels))
+            labels[label] = asked_steps[step] = f"ANS{len(answers) - 1}"
+        else:
+            answers.append(label)
+    return answers
+
+def process_step(step: str):
+    step = step.replace(" ", "")
+    op, args = step.split("(")
+    arg1, arg2 = args.split(")")[0].split(",")
+    return op, arg1, arg2
+
+def process_arg(arg: str) -> str:
+    # Constants are written as e.g. const_100 or const_m1 (for -1)
+    if arg.startswith("const_m"):
+        return f"-{arg[7:]}"
+    if arg.startswith("const_"):
+        return arg[6:]
+    return arg
+
+
+def _build_program(step, labels):
+    # Hidden steps are added before the steps that use them, each only
+    # once, and referred to by their position in the program
+    steps = []
+    positions = {}
+
+    def add_step(step):
+        op, *args = process_step(step)
+        for i, arg in enumerate(args):
+            if arg in labels and labels[arg].startswith("ANS"):
+                args[i] = labels[arg]
+            elif arg in labels:
+                hidden = labels[arg]
+                if hidden not in positions:
+                    positions[hidden] = add_step(hidden)
+                args[i] = f"#{positions[hidden]}"
+            elif arg.startswith("A") or arg.startswith("#"):
+                raise ValueError(f"Unknown reference {arg} in {step}")
+            else:
+                args[i] = process_arg(arg)
+        steps.append(f"{op}({args[0]}, {args[1]})")
+        return len(steps) - 1
+
+    add_step(step)
+    return ";".join(steps)
+
+def _process_safely(record):
+    try:
+        return True, process_record(record)
+    except Exception as e:
+        return False, f"{type(e).__name__}: {e}"
+
+
+class _Shard:
+    def __init__(self, number, shard_size):
+        self.number = number
+        self.start = number * shard_size
+        self.stop = (number + 1) * shard_size
+        self.positions = []
+        self.results = {}
+
+    def add(self, position, record_hash, result):
+        self.positions.append(position)
+        if result is not None:
+            self.results[position] = result
+
+
+def _finish_shard(shard, out_dir, name, old_hashes, hashes, report):
+    if not shard.positions:
+        return
+    path = _shard_path(out_dir, name, shard.number)
+    old_positions = {int(k) for k in old_hashes if shard.start <= int(k) < shard.stop}
+    unchanged = len(shard.positions) - len(shard.results)
+    if not shard.results and old_positions == set(shard.positions) and os.path.exists(path):
+        report.unchanged += unchanged
+        return
+
+    entries = {}
+    if unchanged:
+        with open(path) as json_file:
+            entries = json.load(json_file)
+    out = {}
+    for position in shard.positions:
+        if position not in shard.results:
+            if str(position) in entries:
+                out[str(position)] = entries[str(position)]
+                report.unchanged += 1
+            continue
+        ok, result = shard.results[position]
+        if ok:
+            out[str(position)] = result
+            report.processed += 1
+        else:
+            report.failed[position] = result
+            # Make sure a failed record is retried next time
+            hashes.pop(str(position), None)
+    _write_json(path, out, indent=4)
+    report.shards.append(path)
+
+def _shard_path(out_dir, name, number):
+    return os.path.join(out_dir, f"{name}-{number:05d}.json")
+
+def _shard_number(path):
+    return int(os.path.splitext(path)[0].rsplit("-", 1)[1])
+
+def _load_manifest(path):
+    try:
+        with open(path) as json_file:
+            manifest = json.load(json_file)
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("version") != PIPELINE_VERSION:
+        return {}
+    return manifest
+
+def _write_json(path, data, indent=None):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as out:
+        out.write(json.dumps(data, indent=indent))
+    os.replace(tmp_path, path)
+
+
+class _Reader:
+    # A buffer over a file that is filled a chunk at a time
+    def __init__(self, file, chunk_size):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+
+    def fill(self):
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def next_char(self):
+        # Skip whitespace and return the next character, or "" at the
+        # end of the file
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Convert a raw ConvFinQA file into processed dataset shards."
+    )
+    parser.add_argument("raw_file_path")
+    parser.add_argument("out_dir")
+    parser.add_argument("--name")
+    parser.add_argument("--shard-size", type=int, default=1000)
+    parser.add_argument("--max-workers", type=int)
+    parser.add_argument("--incremental", action="store_true")
+    args = parser.parse_args()
+
+    report = build_dataset(
+        args.raw_file_path,
+        args.out_dir,
+        name=args.name,
+        shard_size=args.shard_size,
+        max_workers=args.max_workers,
+        incremental=args.incremental,
+    )
+    print(
+        f"Processed {report.processed} records, {report.unchanged} unchanged, "
+        f"{len(report.failed)} failed, wrote {len(report.shards)} shards"
+    )
+    for position, error in report.failed.items():
+        print(f"Record {position}: {error}")
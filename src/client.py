@@ -1,13 +1,468 @@
-from huggingface_hub import InferenceClient
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+import metrics
+from backends import Backend, HuggingFaceBackend, new_session
+
+class ResponseCache:
+    """A persistent cache of LLM responses, stored in an SQLite file.
+
+    Responses are keyed by a hash of the model, the maximum number of
+    tokens and the full list of messages, so re-running a deterministic
+    experiment returns the same responses without contacting the LLM.
+    When the cache grows beyond its limits, the least recently used
+    responses are evicted.
+
+    Args:
+        file_path (str): The path to the cache file. It will be created
+            if it doesn't exist, unless the cache is read-only.
+        max_entries (Optional[int]): The maximum number of responses to
+            keep, or None for no limit.
+        max_bytes (Optional[int]): The maximum total size of the cached
+            responses in bytes, or None for no limit.
+        read_only (bool): Whether to only read from the cache. New
+            responses are not stored and nothing is evicted.
+
+    Attributes:
+        hits (int): The number of lookups that found a response.
+        misses (int): The number of lookups that didn't.
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        read_only: bool = False,
+    ):
+        self.file_path = file_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self._connect()
+
+    def _connect(self):
+        self._lock = threading.Lock()
+        if self.read_only:
+            self._db = sqlite3.connect(
+                f"file:{self.file_path}?mode=ro", uri=True, check_same_thread=False
+            )
+        else:
+            self._db = sqlite3.connect(self.file_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_used "
+                "ON responses (last_used)"
+            )
+            self._db.commit()
+
+    # Conversation handlers (and so their clients) get pickled with
+    # runs, so reconnect to the cache file rather than pickling the
+    # connection
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_db"], state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._connect()
+
+    @staticmethod
+    def key(model: str, max_tokens: int, messages, **options) -> str:
+        # Options that change the response (e.g. stop sequences) are
+        # only included when set, so existing keys stay valid
+        request = {"model": model, "max_tokens": max_tokens, "messages": messages}
+        request.update({k: v for k, v in options.items() if v})
+        request = json.dumps(request, sort_keys=True)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self._db.execute(
+                    "UPDATE responses SET last_used = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+                self._db.commit()
+            return row[0]
+
+    def put(self, key: str, response: str):
+        if self.read_only:
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, response, len(response.encode()), time.time()),
+            )
+            self._evict()
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def _evict(self):
+        count, size = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        while (
+            (self.max_entries is not None and count > self.max_entries)
+            or (self.max_bytes is not None and size > self.max_bytes)
+        ):
+            key, evicted_size = self._db.execute(
+                "SELECT key, size FROM responses ORDER BY last_used LIMIT 1"
+            ).fetchone()
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            count -= 1
+            size -= evicted_size
+
+
+# A complete answer line, i.e. ANS{i} = {answer} followed by a newline
+ANSWER_LINE = re.compile(r"ANS\d+\s*=[^\n]*\S[^\n]*\n")
+
+@dataclass
+class GenerationStats:
+    """Statistics about the responses generated by a client.
+
+    Each streamed chunk is counted as one token, which is how
+    text-generation servers stream their output.
+    """
+    requests: int = 0
+    completion_tokens: int = 0
+    early_stops: int = 0
+    tokens_saved: int = 0
+    time_to_answer: float = 0
+    # Prompt statistics, for the requests the backend reported them for
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    prefilled_tokens: int = 0
+    prefill_time: float = 0
+
+    def mean_time_to_answer(self):
+        if self.requests > 0:
+            return self.time_to_answer / self.requests
+        return 0
+
+    def cache_hit_rate(self):
+        """The fraction of prompt tokens reused from the backend's
+        prefix cache.
+        """
+        if self.prompt_tokens > 0:
+            return self.cached_tokens / self.prompt_tokens
+        return 0
+
+    def prefill_time_saved(self):
+        """An estimate of the time the backend saved by reusing cached
+        prompt tokens, assuming they would have taken as long to process
+        as the tokens it did process.
+        """
+        if self.prefilled_tokens > 0:
+            return self.cached_tokens * self.prefill_time / self.prefilled_tokens
+        return 0
+
 
 class Client:
-    """A wrapper class for HuggingFace InferenceClient."""
+    """A client for generating responses from an LLM.
+
+    Requests are sent to a backend, which defaults to the HuggingFace
+    inference API. If the messages are a `Prompt`, its cacheable prefix
+    is passed to the backend, so that backends that support it (e.g.
+    `backends.LlamaCppBackend`) can reuse it between requests.
+
+    Args:
+        model (str): The model to use.
+        token (Optional[str]): A HuggingFace token.
+        cache (Optional[ResponseCache]): A cache to look up responses
+            in before sending a request, and to store new responses in.
+        stream (bool): Whether to stream responses. A streamed response
+            is cancelled as soon as it contains a complete answer line,
+            of the form ANS{i} = {answer}, so the model doesn't spend
+            time and tokens on anything it writes after that. A `Prompt`
+            asking for several answers is cancelled once it has all of
+            them.
+        stop (Optional[List[str]]): Sequences at which the model should
+            stop generating.
+        backend (Optional[Backend]): The backend to send requests to,
+            instead of the HuggingFace inference API.
+        pool_size (int): The maximum number of connections `agenerate`
+            keeps open to the backend. Further requests wait for a free
+            connection.
+        timeout (Optional[float]): The time in seconds `agenerate` waits
+            for a whole request, or None for no limit.
+        connect_timeout (Optional[float]): The time in seconds
+            `agenerate` waits for a connection, including waiting for a
+            free one from the pool.
+
+    Attributes:
+        stats (GenerationStats): Statistics about the responses
+            generated so far. For early stops, `tokens_saved` counts
+            the unused part of the `max_tokens` budget, so it is an
+            upper bound on the tokens actually saved.
+        backend (Backend): The backend requests are sent to.
+    """
 
-    def __init__(self, model: str, token: str):
-        self._client = InferenceClient(model, token)
+    def __init__(
+        self,
+        model: str,
+        token: Optional[str] = None,
+        cache: Optional[ResponseCache] = None,
+        stream: bool = False,
+        stop: Optional[List[str]] = None,
+        backend: Optional[Backend] = None,
+        pool_size: int = 100,
+        timeout: Optional[float] = 120,
+        connect_timeout: Optional[float] = 10,
+    ):
+        self.model = model
+        self.cache = cache
+        self.stream = stream
+        self.stop = stop
+        self.stats = GenerationStats()
+        self._stats_lock = threading.Lock()
+        self.backend = backend if backend is not None else HuggingFaceBackend(model, token)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._session = None
+        self._session_loop = None
 
     def generate(self, messages: str, max_tokens: int = 500) -> str:
-        return self._client.chat_completion(
-            messages=messages,
-            max_tokens=max_tokens,
-        ).choices[0].message.content.strip()
\ No newline at end of file
+        with metrics.record(metrics.GENERATE):
+            key = self._cache_key(messages, max_tokens)
+            if key is not None:
+                response = self.cache.get(key)
+                if response is not None:
+                    metrics.annotate(cache_hit=True)
+                    return response
+
+            # The part of the prompt that is the same for every request in
+            # the conversation
+            cacheable = getattr(messages, "cacheable", 0)
+            start = time.perf_counter()
+            if self.stream:
+                response, tokens, stopped_early = self._generate_stream(
+                    messages, max_tokens, cacheable
+                )
+                completion = None
+            else:
+                completion = self.backend.complete(messages, max_tokens, self.stop, cacheable)
+                response = completion.text
+                tokens = completion.completion_tokens
+                stopped_early = False
+            self._update_stats(
+                messages, tokens, stopped_early, max_tokens, time.perf_counter() - start,
+                completion,
+            )
+
+            if key is not None:
+                self.cache.put(key, response)
+            return response
+
+    async def agenerate(self, messages: str, max_tokens: int = 500) -> str:
+        """Generate a response asynchronously, in the same way as
+        `generate`.
+
+        Requests are sent with a session that keeps connections to the
+        backend open between requests, so many conversations can be run
+        at once from a single thread. The session belongs to the running
+        event loop, and should be closed with `aclose` when done, or by
+        using the client as an async context manager.
+        """
+        with metrics.record(metrics.GENERATE):
+            key = self._cache_key(messages, max_tokens)
+            if key is not None:
+                response = self.cache.get(key)
+                if response is not None:
+                    metrics.annotate(cache_hit=True)
+                    return response
+
+            cacheable = getattr(messages, "cacheable", 0)
+            session = self._get_session()
+            start = time.perf_counter()
+            if self.stream:
+                response, tokens, stopped_early = await self._agenerate_stream(
+                    messages, max_tokens, cacheable, session
+                )
+                completion = None
+            else:
+                completion = await self.backend.acomplete(
+                    messages, max_tokens, self.stop, cacheable, session
+                )
+                response = completion.text
+                tokens = completion.completion_tokens
+                stopped_early = False
+            self._update_stats(
+                messages, tokens, stopped_early, max_tokens, time.perf_counter() - start,
+                completion,
+            )
+
+            if key is not None:
+                self.cache.put(key, response)
+            return response
+
+    async def aclose(self):
+        """Close the session used by `agenerate`."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self) -> "Client":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    def _get_session(self):
+        # A session can only be used in the event loop it was created in
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            self._session = new_session(self.pool_size, self.timeout, self.connect_timeout)
+            self._session_loop = loop
+        return self._session
+
+    def _cache_key(self, messages, max_tokens):
+        if self.cache is None:
+            return None
+        return ResponseCache.key(
+            self.model, max_tokens, messages, stream=self.stream, stop=self.stop
+        )
+
+    def _generate_stream(self, messages, max_tokens, cacheable):
+        chunks = self.backend.stream(messages, max_tokens, self.stop, cacheable)
+        cutoff = _StreamCutoff(getattr(messages, "expected_answers", 1))
+        try:
+            for chunk in chunks:
+                if cutoff.add(chunk):
+                    break
+        finally:
+            # Closing the generator closes the connection, which stops
+            # the server from generating any more tokens
+            chunks.close()
+        return cutoff.response.strip(), cutoff.tokens, cutoff.stopped_early
+
+    async def _agenerate_stream(self, messages, max_tokens, cacheable, session):
+        chunks = self.backend.astream(messages, max_tokens, self.stop, cacheable, session)
+        cutoff = _StreamCutoff(getattr(messages, "expected_answers", 1))
+        try:
+            async for chunk in chunks:
+                if cutoff.add(chunk):
+                    break
+        finally:
+            await chunks.aclose()
+        return cutoff.response.strip(), cutoff.tokens, cutoff.stopped_early
+
+    def _update_stats(self, messages, tokens, stopped_early, max_tokens, elapsed, completion=None):
+        prompt_tokens = None
+        if completion is not None:
+            prompt_tokens = completion.prompt_tokens
+        if prompt_tokens is None:
+            prompt_tokens = _estimate_tokens(messages)
+        metrics.add(prompt_tokens=prompt_tokens, completion_tokens=tokens)
+        with self._stats_lock:
+            self.stats.requests += 1
+            self.stats.completion_tokens += tokens
+            self.stats.time_to_answer += elapsed
+            if stopped_early:
+                self.stats.early_stops += 1
+                self.stats.tokens_saved += max(0, max_tokens - tokens)
+            if completion is not None and completion.prefilled_tokens is not None:
+                self.stats.prompt_tokens += completion.prompt_tokens
+                self.stats.cached_tokens += completion.cached_tokens
+                if completion.prefill_time is not None:
+                    self.stats.prefilled_tokens += completion.prefilled_tokens
+                    self.stats.prefill_time += completion.prefill_time
+
+    # The lock and session can't be pickled, and conversation handlers
+    # (and so their clients) get pickled with runs
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_stats_lock", None)
+        state["_session"] = None
+        state["_session_loop"] = None
+        return state
+
+    def __setstate__(self, state):
+        # Runs pickled by older versions won't have the newer attributes
+        self.cache = None
+        self.stream = False
+        self.stop = None
+        self.stats = GenerationStats()
+        self.pool_size = 100
+        self.timeout = 120
+        self.connect_timeout = 10
+        self._session = None
+        self._session_loop = None
+        if "_client" in state:
+            # Older versions held the HuggingFace client directly
+            state = state.copy()
+            backend = HuggingFaceBackend.__new__(HuggingFaceBackend)
+            backend._client = state.pop("_client")
+            backend.model = state.get("model", backend._client.model)
+            state.setdefault("model", backend.model)
+            state["backend"] = backend
+        self.__dict__.update(state)
+        self._stats_lock = threading.Lock()
+
+
+def _estimate_tokens(messages):
+    # The same estimate as scheduler.estimate_tokens, which imports this
+    # module
+    return sum(len(message["content"]) for message in messages) // 4
+
+
+class _StreamCutoff:
+    # Collects a streamed response until it contains the expected
+    # number of complete answer lines
+    def __init__(self, expected_answers):
+        self.expected_answers = expected_answers
+        self.response = ""
+        self.tokens = 0
+        self.answer_lines = 0
+        self.stopped_early = False
+
+    def add(self, chunk):
+        # Returns whether the response is complete
+        self.tokens += 1
+        self.response += chunk
+        # Only the last line can have been completed by the chunk
+        start = self.response.rfind("\n", 0, len(self.response) - len(chunk)) + 1
+        for match in ANSWER_LINE.finditer(self.response, start):
+            self.answer_lines += 1
+            if self.answer_lines == self.expected_answers:
+                self.response = self.response[:match.end()]
+                self.stopped_early = True
+                return True
+        return False
+
+
+async def agenerate(client, messages, max_tokens: int = 500) -> str:
+    """Generate a response asynchronously with any client.
+
+    Clients with an `agenerate` method (e.g. `Client`) are awaited
+    directly, and any others (e.g. `replay.ReplayClient`) are run in a
+    thread.
+    """
+    if hasattr(client, "agenerate"):
+        return await client.agenerate(messages, max_tokens=max_tokens)
+    return await asyncio.to_thread(client.generate, messages, max_tokens=max_tokens)
@@ -0,0 +1,272 @@
+import json
+import mmap
+import os
+from collections.abc import Mapping
+
+import numpy as np
+
+from data import load_data
+from entry import Entry
+
+# Bumped whenever the layout of compiled files changes
+FORMAT_VERSION = 2
+MAGIC = b"CFQADAT\0"
+
+# The per-entry columns, stored as int64 arrays
+ENTRY_COLUMNS = [
+    "ids", "types", "question_counts", "answer_counts", "exe_starts", "exe_counts",
+    "text_starts", "text_counts", "string_starts",
+]
+
+def compile_data(file_path: str, compiled_file_path: str = None) -> str:
+    """Compile a processed dataset into a binary file for lazy loading.
+
+    The compiled file contains a small JSON header followed by
+    8-byte-aligned sections that are memory-mapped when the file is
+    loaded:
+        * one int64 column per entry attribute in `ENTRY_COLUMNS`
+        * the executed answers of every entry, as float64, with NaN for
+          the answers that aren't numbers
+        * the question numbers of those text answers, as int64
+        * the end offset of every string in the string blob, as int64
+        * the string blob, which holds each entry's context, questions,
+          answers and text answers, in that order, encoded in UTF-8
+
+    Every entry is validated while compiling, so loading the compiled
+    file doesn't need to check anything. Entries are built from it
+    without being validated or converted again, and only their answers
+    are parsed.
+
+    Args:
+        file_path (str): The path to the processed JSON file.
+        compiled_file_path (str): The path to write the compiled file
+            to. Defaults to `file_path` with a ".bin" extension.
+
+    Returns:
+        compiled_file_path (str): The path of the compiled file.
+    """
+    if compiled_file_path is None:
+        compiled_file_path = os.path.splitext(file_path)[0] + ".bin"
+    entries = load_data(file_path)
+
+    columns = {name: [] for name in ENTRY_COLUMNS}
+    exe_answers = []
+    text_questions = []
+    strings = []
+    for entry in entries.values():
+        columns["ids"].append(entry.id)
+        columns["types"].append(entry.type)
+        columns["question_counts"].append(len(entry.questions))
+        columns["answer_counts"].append(len(entry.answers))
+        columns["exe_starts"].append(len(exe_answers))
+        columns["exe_counts"].append(len(entry.exe_answers))
+        columns["text_starts"].append(len(text_questions))
+        columns["text_counts"].append(len(entry.text_answers))
+        columns["string_starts"].append(len(strings))
+        exe_answers.extend(entry.exe_answers)
+        text_questions.extend(entry.text_answers)
+        strings.append(entry.context)
+        strings.extend(entry.questions)
+        strings.extend(entry.answers)
+        strings.extend(entry.text_answers.values())
+
+    encoded = [s.encode() for s in strings]
+    sections = [np.array(columns[name], dtype=np.int64) for name in ENTRY_COLUMNS]
+    sections.append(np.array(exe_answers, dtype=np.float64))
+    sections.append(np.array(text_questions, dtype=np.int64))
+    sections.append(np.cumsum([len(s) for s in encoded], dtype=np.int64))
+    blob = b"".join(encoded)
+
+    stat = os.stat(file_path)
+    header = {
+        "version": FORMAT_VERSION,
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+        "entry_count": len(entries),
+        "exe_answer_count": len(exe_answers),
+        "text_answer_count": len(text_questions),
+        "string_count": len(strings),
+    }
+    header = json.dumps(header).encode()
+
+    # Write to a temporary file first, so a compiled file is never left
+    # half written
+    tmp_path = compiled_file_path + ".tmp"
+    with open(tmp_path, "wb") as out:
+        out.write(MAGIC)
+        out.write(np.int64(len(header)).tobytes())
+        out.write(header)
+        out.write(b"\0" * _padding(out.tell()))
+        for section in sections:
+            out.write(section.tobytes())
+        out.write(blob)
+    os.replace(tmp_path, compiled_file_path)
+    return compiled_file_path
+
+def load_compiled(compiled_file_path: str) -> "CompiledEntries":
+    """Open a compiled dataset without loading any entries."""
+    return CompiledEntries(compiled_file_path)
+
+def load_data_lazy(file_path: str) -> "CompiledEntries":
+    """Lazily load a processed dataset, compiling it first if needed.
+
+    The compiled file sits next to the processed JSON file, and is
+    rebuilt whenever the JSON file changes.
+    """
+    compiled_file_path = os.path.splitext(file_path)[0] + ".bin"
+    if not is_up_to_date(file_path, compiled_file_path):
+        compile_data(file_path, compiled_file_path)
+    return load_compiled(compiled_file_path)
+
+def is_up_to_date(file_path: str, compiled_file_path: str) -> bool:
+    try:
+        header = _read_header(compiled_file_path)
+    except (OSError, ValueError):
+        return False
+    stat = os.stat(file_path)
+    return (
+        header["version"] == FORMAT_VERSION
+        and header["source_size"] == stat.st_size
+        and header["source_mtime_ns"] == stat.st_mtime_ns
+    )
+
+
+class CompiledEntries(Mapping):
+    """The entries of a compiled dataset, loaded on demand.
+
+    This behaves like the dictionary returned by `load_data`, but the
+    file is memory-mapped and an `Entry` is only built the first time
+    it is accessed, so opening a dataset takes the same time and memory
+    however large it is.
+
+    Args:
+        compiled_file_path (str): The path to a file written by
+            `compile_data`.
+    """
+
+    def __init__(self, compiled_file_path: str):
+        self.compiled_file_path = compiled_file_path
+        header = _read_header(compiled_file_path)
+        if header["version"] != FORMAT_VERSION:
+            raise ValueError(
+                f"{compiled_file_path} has format version {header['version']}, "
+                f"expected {FORMAT_VERSION}. Compile it again with compile_data."
+            )
+        self._entries = {}
+
+        with open(compiled_file_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = header["data_offset"]
+        n = header["entry_count"]
+        for name in ENTRY_COLUMNS:
+            setattr(self, f"_{name}", np.frombuffer(self._mmap, np.int64, n, offset))
+            offset += 8 * n
+        self._exe_answers = np.frombuffer(
+            self._mmap, np.float64, header["exe_answer_count"], offset
+        )
+        offset += 8 * header["exe_answer_count"]
+        self._text_questions = np.frombuffer(
+            self._mmap, np.int64, header["text_answer_count"], offset
+        )
+        offset += 8 * header["text_answer_count"]
+        self._string_ends = np.frombuffer(
+            self._mmap, np.int64, header["string_count"], offset
+        )
+        self._blob_offset = offset + 8 * header["string_count"]
+
+        # Entries are found by binary search on their ids
+        self._order = np.argsort(self._ids, kind="stable")
+        self._sorted_ids = self._ids[self._order]
+
+    def __getitem__(self, key) -> Entry:
+        if key not in self._entries:
+            self._entries[key] = self._load_entry(self._position(key))
+        return self._entries[key]
+
+    def __iter__(self):
+        return (int(i) for i in self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, key):
+        try:
+            self._position(key)
+        except KeyError:
+            return False
+        return True
+
+    @property
+    def loaded(self) -> int:
+        """The number of entries that have been built so far."""
+        return len(self._entries)
+
+    def _position(self, key):
+        try:
+            i = np.searchsorted(self._sorted_ids, key)
+        except TypeError:
+            raise KeyError(key)
+        if i == len(self._sorted_ids) or self._sorted_ids[i] != key:
+            raise KeyError(key)
+        return self._order[i]
+
+    def _load_entry(self, position):
+        n_questions = int(self._question_counts[position])
+        n_answers = int(self._answer_counts[position])
+        n_texts = int(self._text_counts[position])
+        strings = self._strings(
+            int(self._string_starts[position]), 1 + n_questions + n_answers + n_texts
+        )
+        exe_start = int(self._exe_starts[position])
+        # Copied so that the entry doesn't keep the file open
+        exe_answers = self._exe_answers[
+            exe_start:exe_start + int(self._exe_counts[position])
+        ].copy()
+        text_start = int(self._text_starts[position])
+        text_questions = self._text_questions[text_start:text_start + n_texts]
+        text_answers = {
+            int(q): answer
+            for q, answer in zip(text_questions, strings[1 + n_questions + n_answers:])
+        }
+        return Entry._from_compiled(
+            id=int(self._ids[position]),
+            type=int(self._types[position]),
+            context=strings[0],
+            questions=tuple(strings[1:1 + n_questions]),
+            answers=tuple(strings[1 + n_questions:1 + n_questions + n_answers]),
+            exe_answers=exe_answers,
+            text_answers=text_answers,
+        )
+
+    def _strings(self, start, count):
+        ends = self._string_ends[start:start + count]
+        begin = self._string_ends[start - 1] if start > 0 else 0
+        strings = []
+        for end in ends:
+            strings.append(
+                self._mmap[self._blob_offset + begin:self._blob_offset + end].decode()
+            )
+            begin = end
+        return strings
+
+
+def _read_header(compiled_file_path):
+    with open(compiled_file_path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{compiled_file_path} is not a compiled dataset")
+        length = int(np.frombuffer(f.read(8), np.int64)[0])
+        header = json.loads(f.read(length))
+    end = len(MAGIC) + 8 + length
+    header["data_offset"] = end + _padding(end)
+    return header
+
+def _padding(offset):
+    # Sections are aligned to 8 bytes so they can be viewed as arrays
+    return -offset % 8
+
+
+if __name__ == "__main__":
+    import sys
+
+    for path in sys.argv[1:]:
+        print(f"Compiled {path} to {compile_data(path)}")
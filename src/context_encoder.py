@@ -0,0 +1,144 @@
+import html
+import re
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from _extra_typing import Entries, EntryKeyCollection
+
+TABLE_PATTERN = re.compile(r"<table[^>]*>(.*?)</table>", re.DOTALL)
+ROW_PATTERN = re.compile(r"<tr>(.*?)</tr>", re.DOTALL)
+CELL_PATTERN = re.compile(r"<t[dh][^>]*>(.*?)</t[dh]>", re.DOTALL)
+
+# Replacements applied in order to normalise text and table cells.
+# Negative numbers and percentages are written twice in the dataset,
+# e.g. "-9 ( 9 )" and "9% ( 9 % )", and only these repeats are dropped,
+# not a different number in brackets. Spaces are put around all
+# punctuation, e.g. "$ 3.3 billion ( 2007 ) ."
+NORMALISATIONS = [
+    (re.compile(r"-([\d.,]+) \( \1 \)"), r"-\1"),
+    (re.compile(r"([\d.,]+)% \( \1 % \)"), r"\1%"),
+    (re.compile(r"(\d) %"), r"\1%"),
+    (re.compile(r"([$£€]) (?=[-\d.])"), r"\1"),
+    (re.compile(r"\( "), "("),
+    (re.compile(r" ([.,;:)])"), r"\1"),
+    (re.compile(r"\s+"), " "),
+]
+
+@dataclass
+class ContextReport:
+    """The size of an entry's context before and after encoding.
+
+    Attributes:
+        entry_id (EntryKey): The key of the entry.
+        tokens_before (int): The tokens in the original context.
+        tokens_after (int): The tokens in the encoded context.
+    """
+    entry_id: object
+    tokens_before: int
+    tokens_after: int
+
+    @property
+    def saving(self) -> float:
+        """The fraction of the original tokens saved."""
+        if self.tokens_before == 0:
+            return 0
+        return 1 - self.tokens_after / self.tokens_before
+
+
+def encode_context(context: str) -> str:
+    """Encode a processed context in as few tokens as possible.
+
+    Each HTML table is rendered as a pipe table, one row per line, and
+    the text and cells are normalised, so that the numbers are left
+    unchanged but written once, with no padding:
+        "$ 3.3 billion ( 2007 ) ." -> "$3.3 billion (2007)."
+        "-9 ( 9 )" -> "-9"
+    The row numbers added to tables in the processed dataset are
+    dropped.
+    """
+    parts = []
+    end = 0
+    for match in TABLE_PATTERN.finditer(context):
+        parts.append(normalise(context[end:match.start()]))
+        rows = [
+            [html.unescape(cell) for cell in CELL_PATTERN.findall(row)]
+            for row in ROW_PATTERN.findall(match.group(1))
+        ]
+        parts.append("\n" + render_pipe_table(_drop_row_numbers(rows)) + "\n")
+        end = match.end()
+    parts.append(normalise(context[end:]))
+    return "".join(part.strip(" ") for part in parts).strip()
+
+def encode_record(pre_text: List[str], table: List[List[str]], post_text: List[str]) -> str:
+    """Encode the context of a raw record, in the same way as
+    `encode_context`.
+    """
+    return "\n".join([
+        normalise(" ".join(pre_text)),
+        render_pipe_table(table),
+        normalise(" ".join(post_text)),
+    ]).strip()
+
+def render_pipe_table(rows: List[List[str]]) -> str:
+    return "\n".join(
+        "|".join(normalise(cell).replace("|", "/") for cell in row) for row in rows
+    )
+
+def normalise(text: str) -> str:
+    for pattern, replacement in NORMALISATIONS:
+        text = pattern.sub(replacement, text)
+    return text.strip()
+
+def count_tokens(text: str) -> int:
+    """Roughly estimate the number of tokens in some text, in the same
+    way as `scheduler.estimate_tokens`.
+    """
+    return len(text) // 4
+
+def context_reports(
+    entries: Entries,
+    indices: Optional[EntryKeyCollection] = None,
+    encoder: Callable[[str], str] = encode_context,
+    tokenizer: Callable[[str], int] = count_tokens,
+) -> List[ContextReport]:
+    """Measure the tokens saved by encoding each entry's context.
+
+    Args:
+        entries (Entries): The entries to measure.
+        indices (Optional[EntryKeyCollection]): The keys of the entries
+            to measure. Defaults to all of them.
+        encoder (Callable[[str], str]): The context encoder.
+        tokenizer (Callable[[str], int]): A function that counts the
+            tokens in some text, e.g. using the model's tokenizer.
+            Defaults to a rough estimate.
+
+    Returns:
+        reports (List[ContextReport]): The tokens before and after
+            encoding, for each entry.
+    """
+    if indices is None:
+        indices = entries.keys()
+    return [
+        ContextReport(
+            i,
+            tokenizer(entries[i].context),
+            tokenizer(encoder(entries[i].context)),
+        )
+        for i in indices
+    ]
+
+def print_context_reports(reports: List[ContextReport]):
+    for report in reports:
+        print(
+            f"Entry {report.entry_id}: {report.tokens_before} -> "
+            f"{report.tokens_after} tokens ({report.saving:.1%} saved)"
+        )
+    before = sum(report.tokens_before for report in reports)
+    after = sum(report.tokens_after for report in reports)
+    saving = 1 - after / before if before else 0
+    print(f"Total: {before} -> {after} tokens ({saving:.1%} saved)")
+
+def _drop_row_numbers(rows):
+    if rows and all(row and row[0] == str(i + 1) for i, row in enumerate(rows)):
+        return [row[1:] for row in rows]
+    return rows
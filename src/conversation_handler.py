@@ -1,9 +1,19 @@
 import math
-from typing import Tuple, Union
+import re
+import weakref
+from typing import List, Optional, Sequence, Tuple, Union
 
-from client import Client
+import metrics
+from client import Client, agenerate
+from prefix import DEFAULT_PREFIX, Prompt, SharedPrefix
+from retrieval import ContextRetriever
 from utils import extract_raw_answer, execute_answer
-from _consts import INIT_MESSAGES, ASSISTANT_INITIAL_CONFIRMATION, SUFFIX
+from _consts import ASSISTANT_INITIAL_CONFIRMATION, BATCH_PREFIX, BATCH_SUFFIX, SUFFIX
+
+CONFIRMATION_MESSAGE = {"role": "assistant", "content": ASSISTANT_INITIAL_CONFIRMATION}
+
+# An answer line in a response to several questions at once
+BATCH_ANSWER_LINE = re.compile(r"^\s*ANS(\d+)\s*=.*$", re.MULTILINE)
 
 class ConversationHandler:
     """A class for conversing with an LLM given some initial context.
@@ -13,11 +23,32 @@ class ConversationHandler:
             receiving messages to and from an LLM.
         context (str): Some context to set the scene for the LLM so
             that it can refer back to it for question answering.
+        retriever (Optional[ContextRetriever]): A retriever for the
+            context. If given, each question is sent with only the
+            parts of the context relevant to it, rather than the full
+            context, although the full context is kept in the
+            conversation.
+        history_window (Optional[int]): The number of most recent
+            questions and answers to send in full. Earlier ones are
+            replaced by a ledger of each question and the value of its
+            answer, so that the prompt stays roughly the same size
+            however long the conversation gets. None sends the full
+            history, and 0 sends only the ledger and the question being
+            asked. Negative values raise a ValueError.
+        prefix (SharedPrefix): The instructions and examples to start
+            the conversation with, which are shared with other
+            conversations rather than copied.
 
     Attributes:
         client (Client): A client that handles sending and
             receiving messages to and from an LLM.
-        conversation (Conversation): The message history.
+        prefix (SharedPrefix): The instructions and examples the
+            conversation starts with.
+        context (str): The context the questions are about.
+        turns (Conversation): The questions and answers so far.
+        conversation (Conversation): The full message history, i.e. the
+            prefix, the context and the turns. This is assembled each
+            time it is accessed, so shouldn't be modified.
         answers (List[str]): A list of the responses from the LLM so
             far in the conversation. These can either be numbers or
             a description of an operation, in the form:
@@ -35,25 +66,33 @@ class ConversationHandler:
             error occured.
     """
 
-    def __init__(self, client: Client, context: str):
+    def __init__(
+        self,
+        client: Client,
+        context: str,
+        retriever: Optional[ContextRetriever] = None,
+        history_window: Optional[int] = None,
+        prefix: SharedPrefix = DEFAULT_PREFIX,
+    ):
+        if history_window is not None and history_window < 0:
+            raise ValueError(f"history_window must be at least 0, not {history_window}")
         self.client = client
-        self.conversation = INIT_MESSAGES.copy()
-        self.conversation.extend([
-            {
-                "role": "user",
-                "content": context
-            },
-            {
-                "role": "assistant",
-                "content": ASSISTANT_INITIAL_CONFIRMATION
-            },
-        ])
+        self.retriever = retriever
+        self.history_window = history_window
+        self.prefix = prefix
+        self.context = context
+        self.turns = []
         self.full_answers = []
         self.answers = []
         self.exe_answers = []
         self.question_count = 0
         self.err_log = []
         self.err_indices = []
+        self._change_counters = None
+
+    @property
+    def conversation(self) -> Prompt:
+        return self._messages(self.context, self.turns)
 
     def ask(self, question: str) -> Tuple[float, Union[None, str]]:
         """Ask the LLM a question based on the provided context.
@@ -66,6 +105,200 @@ class ConversationHandler:
             error (Union[None, str]): An error message if there was a
                 problem handling the request.
         """
+        with metrics.record(metrics.ASK):
+            context = self._retrieve_context(question)
+            self._add_question(question)
+
+            # An answer will be generated in a "raw" form that will then
+            # need to be processed to get a real output
+            answer = self.client.generate(self._send_messages(context))
+            return self._add_answer(answer)
+
+    def ask_all(self, questions: Sequence[str]) -> List[Tuple[float, Union[None, str]]]:
+        """Ask the LLM several questions in a single request.
+
+        The LLM is asked to answer every question, one line each, and
+        each answer is added to the conversation as if its question had
+        been asked on its own. Any question without an answer line, or
+        whose answer can't be extracted or executed, is then asked again
+        with `ask`, in order, so that it can see the answers before it.
+
+        Args:
+            questions (Sequence[str]): The questions to ask, which are
+                numbered on from the questions already asked.
+
+        Returns:
+            results (List[Tuple[float, Union[None, str]]]): The executed
+                answer and any error for each question, as returned by
+                `ask`.
+        """
+        if not questions:
+            return []
+        with metrics.record(metrics.ASK_ALL):
+            response = self.client.generate(
+                self._batch_messages(questions), max_tokens=500 * len(questions)
+            )
+        answer_lines = _batch_answer_lines(response)
+        results = []
+        for question in questions:
+            result = self._add_batch_answer(question, answer_lines)
+            results.append(result if result is not None else self.ask(question))
+        self._select_referenced()
+        return results
+
+    async def aask(self, question: str) -> Tuple[float, Union[None, str]]:
+        """Ask the LLM a question asynchronously, in the same way as
+        `ask`.
+        """
+        with metrics.record(metrics.ASK):
+            context = self._retrieve_context(question)
+            self._add_question(question)
+            answer = await agenerate(self.client, self._send_messages(context))
+            return self._add_answer(answer)
+
+    async def aask_all(self, questions: Sequence[str]) -> List[Tuple[float, Union[None, str]]]:
+        """Ask the LLM several questions in a single request
+        asynchronously, in the same way as `ask_all`.
+        """
+        if not questions:
+            return []
+        with metrics.record(metrics.ASK_ALL):
+            response = await agenerate(
+                self.client, self._batch_messages(questions), max_tokens=500 * len(questions)
+            )
+        answer_lines = _batch_answer_lines(response)
+        results = []
+        for question in questions:
+            result = self._add_batch_answer(question, answer_lines)
+            results.append(result if result is not None else await self.aask(question))
+        self._select_referenced()
+        return results
+
+    def _batch_messages(self, questions):
+        first = self.question_count
+        # Retrieve for each question in turn, as replaying them does, and
+        # send the context retrieved for all of them
+        context = None
+        for question in questions:
+            context = self._retrieve_context(question)
+        lines = "\n".join(
+            f"Q{first + i}: {question}" for i, question in enumerate(questions)
+        )
+        messages = self._send_messages(context, [{
+            "role": "user",
+            "content": f"{BATCH_PREFIX}\n{lines}\n{BATCH_SUFFIX}",
+        }])
+        messages.expected_answers = len(questions)
+        return messages
+
+    def _select_referenced(self):
+        # Replaying the questions one at a time lets the retriever see
+        # the answers to the earlier questions in a batch, so let it see
+        # them here too
+        if self.retriever is not None:
+            self.retriever.select_referenced(self.answers[:-1])
+
+    def _add_batch_answer(self, question, answer_lines):
+        # Add the next question and its answer from a batched response,
+        # or return None if it needs to be asked on its own
+        answer = answer_lines.get(self.question_count)
+        if answer is None:
+            return None
+        processed = _process_answer(answer, self.exe_answers)
+        if processed[2] is not None:
+            return None
+        self._add_question(question)
+        return self._add_answer(answer, processed)
+
+    def replay(self, question: str, answer: str) -> Tuple[float, Union[None, str]]:
+        """Add a previously generated answer to the conversation.
+
+        The conversation is updated exactly as if `ask` had been called
+        and the LLM had responded with `answer`, but without contacting
+        the LLM. This allows a conversation to be rebuilt from a saved
+        run.
+
+        Args:
+            question (str): The question that was asked.
+            answer (str): The raw response from the LLM.
+
+        Returns:
+            answer (float): The executed answer.
+            error (Union[None, str]): An error message if there was a
+                problem handling the answer.
+        """
+        self._retrieve_context(question)
+        self._add_question(question)
+        return self._add_answer(answer)
+
+    def count_changes(self, counter):
+        """Increment `counter.count` whenever an answer is added to the
+        conversation, so that anything calculated from the conversation
+        (e.g. by `Analyser`) can tell cheaply that it is out of date.
+
+        Only a weak reference to the counter is kept, and it isn't
+        pickled with the conversation.
+        """
+        if self._change_counters is None:
+            self._change_counters = weakref.WeakSet()
+        self._change_counters.add(counter)
+
+    def _retrieve_context(self, question):
+        # The parts of the context relevant to the question, or None to
+        # send the full context. This is also called when replaying, so
+        # that the retriever sees every question
+        if self.retriever is None:
+            return None
+        return self.retriever.retrieve(question, self.answers)
+
+    def _messages(self, context, turns):
+        # The context is only the same for every request if it is sent
+        # whole, as the retrieved parts change from question to question
+        cacheable = len(self.prefix)
+        if self.retriever is None:
+            cacheable += 2
+        messages = Prompt(self.prefix.messages, cacheable, len(self.prefix))
+        messages.append({"role": "user", "content": context})
+        messages.append(CONFIRMATION_MESSAGE)
+        messages.extend(turns)
+        return messages
+
+    def _send_messages(self, context, pending=()):
+        # Assemble the messages to send, i.e. the turns so far and any
+        # pending messages, which may have a narrowed down context and
+        # older turns replaced by a ledger
+        if context is None:
+            context = self.context
+        turns = self.turns + list(pending)
+        dropped = 0
+        if self.history_window is not None:
+            dropped = max(0, self.question_count - self.history_window)
+        if dropped == 0:
+            return self._messages(context, turns)
+
+        kept = turns[2 * dropped:]
+        ledger = "Earlier questions and answers:\n" + "\n".join(
+            f"{_question_line(self.turns[2 * i]['content'])} "
+            f"ANS{i} = {self._ledger_value(i)}"
+            for i in range(dropped)
+        )
+        # The ledger is added to the first question that is kept, if
+        # any, so that user and assistant messages still alternate
+        if kept and kept[0]["role"] == "user":
+            kept = [{"role": "user", "content": f"{ledger}\n{kept[0]['content']}"}] + kept[1:]
+        else:
+            kept = [{"role": "user", "content": ledger}] + kept
+        return self._messages(context, kept)
+
+    def _ledger_value(self, i):
+        # The executed answer, or what the LLM answered if it couldn't be
+        # executed
+        exe_answer = self.exe_answers[i]
+        if isinstance(exe_answer, str) or not math.isnan(exe_answer):
+            return exe_answer
+        return self.answers[i]
+
+    def _add_question(self, question):
         # Add the provided question to the conversation, prefixed with
         # a question index to allow the LLM to more easily refer to
         # specific answers, as well as the calculated value of the last
@@ -75,41 +308,34 @@ class ConversationHandler:
             prev = self.exe_answers[-1]
             if isinstance(prev, str) or not math.isnan(prev):
                 prefix = f"Ok, so ANS{self.question_count-1} = {prev}. Now the next question:\n"
-        self.conversation.append({
+        self.turns.append({
             "role": "user",
             "content": f"{prefix}Q{self.question_count}: {question}\n{SUFFIX}"
         })
 
-        # An answer will be generated in a "raw" form that will then
-        # need to be processed to get a real output
-        answer = self.client.generate(self.conversation)
-        
+    def _add_answer(self, answer, processed=None):
         # Add the response in "raw" form to the conversation to keep
         # the conversation history up-to-date so that the LLM can
-        # refer to previous answers
-        self.conversation.append({
+        # refer to previous answers. The answer is processed here unless
+        # it already has been
+        self.turns.append({
             "role": "assistant",
             "content": answer
         })
         self.question_count += 1
         self.full_answers.append(answer)
+        if self._change_counters:
+            for counter in self._change_counters:
+                counter.count += 1
 
-        # Attempt to process the generated answer
-        try:
-            extracted_answer = extract_raw_answer(answer)
-        except Exception as e:
-            self._log_new_error(answer, e)
-            extracted_answer = "n/a"
-            exe_answer = float("nan")
+        if processed is None:
+            processed = _process_answer(answer, self.exe_answers)
+        extracted_answer, exe_answer, exception = processed
+        error = None
+        if exception is not None:
+            self._log_new_error(answer, exception)
+            metrics.annotate(error=type(exception).__name__)
             error = self.err_log[-1]
-        else:
-            try:
-                exe_answer = execute_answer(extracted_answer, self.exe_answers)
-                error = None
-            except Exception as e:
-                self._log_new_error(answer, e)
-                exe_answer = float("nan")
-                error = self.err_log[-1]
 
         self.answers.append(extracted_answer)
         self.exe_answers.append(exe_answer)
@@ -119,4 +345,50 @@ class ConversationHandler:
         self.err_log.append(
             f"Question {self.question_count}: Answer {answer}\nError: {error}"
         )
-        self.err_indices.append(self.question_count)
\ No newline at end of file
+        self.err_indices.append(self.question_count)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_change_counters"] = None
+        return state
+
+    def __setstate__(self, state):
+        # Conversations pickled by older versions won't have the newer
+        # attributes, and kept a copy of the whole conversation
+        self.retriever = None
+        self.history_window = None
+        self._change_counters = None
+        if "conversation" in state:
+            state = state.copy()
+            conversation = state.pop("conversation")
+            state["prefix"] = DEFAULT_PREFIX
+            state["context"] = conversation[len(DEFAULT_PREFIX)]["content"]
+            state["turns"] = conversation[len(DEFAULT_PREFIX) + 2:]
+        self.__dict__.update(state)
+
+
+def _process_answer(answer, exe_answers):
+    # Attempt to process a generated answer, giving the extracted and
+    # executed answers and the exception if either step failed
+    try:
+        extracted_answer = extract_raw_answer(answer)
+    except Exception as e:
+        return "n/a", float("nan"), e
+    try:
+        return extracted_answer, execute_answer(extracted_answer, exe_answers), None
+    except Exception as e:
+        return extracted_answer, float("nan"), e
+
+
+def _batch_answer_lines(response):
+    # The first answer line for each question number in a response to
+    # several questions
+    answer_lines = {}
+    for match in BATCH_ANSWER_LINE.finditer(response):
+        answer_lines.setdefault(int(match.group(1)), match.group(0).strip())
+    return answer_lines
+
+def _question_line(content):
+    # The "Q{i}: {question}" line of a question message, without the
+    # previous answer before it or the suffix after it
+    return content[:-len(SUFFIX)].strip("\n").split("\n")[-1]
\ No newline at end of file
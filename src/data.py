@@ -1,4 +1,5 @@
-import json       
+import ast
+import json
 
 from entry import Entry
 
@@ -9,10 +10,18 @@ def load_data(file_path):
     for k, v in json_data.items():
         data[int(k)] = Entry(
             id=int(k),
-            type=v["type"],
+            type=int(v["type"]),
             context=v["context"],
-            questions=v["dialogue_break"],
-            answers=v["answers"],
-            exe_answers=v["exe_ans_list"]
+            questions=_decode_list(v["dialogue_break"]),
+            answers=_decode_list(v["answers"]),
+            exe_answers=_decode_list(v["exe_ans_list"])
         )
-    return data
\ No newline at end of file
+    return data
+
+def _decode_list(value):
+    # Some exports store lists as their Python representation
+    if isinstance(value, str):
+        value = ast.literal_eval(value)
+    if not isinstance(value, (list, tuple)):
+        raise ValueError(f"Expected a list but got {value!r}")
+    return value
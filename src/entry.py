@@ -1,22 +1,117 @@
-from typing import List
-from dataclasses import dataclass
+import numbers
+from dataclasses import dataclass, field
+from typing import Dict, Tuple, Union
 
-from utils import is_operation, equivalent_operation, backward_subtraction
+import numpy as np
 
-@dataclass
+from utils import (
+    Literal, Ref, Program, parse_answer, is_operation, equivalent_operation, backward_subtraction,
+)
+from _consts import OP_MAP
+
+# The index in OP_MAP of an answer that isn't an operation
+NO_OPERATION = -1
+
+@dataclass(slots=True, eq=False)
 class Entry:
     """An entry contains some context, a set of questions to answer, and
     their model answers
+
+    Everything that only depends on the model answers is worked out once
+    when the entry is created, and the answers are checked to be valid.
+    An entry may have no answers, in which case it can be run but not
+    analysed.
+
+    Attributes:
+        exe_answers (np.ndarray): The executed model answers, or NaN for
+            answers that aren't numbers (e.g. "yes" or "no").
+        text_answers (Dict[int, str]): The executed model answers that
+            aren't numbers, by question number.
+        programs (Tuple[Union[Literal, Ref, Program], ...]): The parsed
+            model answers.
+        is_operations (np.ndarray): Whether each model answer is an
+            operation rather than a retrieval.
+        expected_ops (np.ndarray): The index in OP_MAP of the (first)
+            operation of each model answer, or -1.
     """
     id: int
     type: int
     context: str
-    questions: List[str]
-    answers: List[str]
-    exe_answers: List[float]
+    questions: Tuple[str, ...]
+    answers: Tuple[str, ...]
+    exe_answers: np.ndarray
+    text_answers: Dict[int, str] = field(init=False)
+    programs: Tuple[Union[Literal, Ref, Program], ...] = field(init=False)
+    is_operations: np.ndarray = field(init=False)
+    expected_ops: np.ndarray = field(init=False)
+
+    def __post_init__(self):
+        self.questions = tuple(self.questions)
+        self.answers = tuple(self.answers)
+        # Entries without answers (e.g. from the test split) can still be
+        # run, but not analysed
+        if self.answers and not len(self.questions) == len(self.answers) == len(self.exe_answers):
+            raise ValueError(
+                f"Entry {self.id} has {len(self.questions)} questions, "
+                f"{len(self.answers)} answers and {len(self.exe_answers)} "
+                "executed answers"
+            )
+
+        self.text_answers = {
+            i: answer for i, answer in enumerate(self.exe_answers)
+            if not isinstance(answer, numbers.Real)
+        }
+        self.exe_answers = np.array(
+            [np.nan if i in self.text_answers else answer for i, answer in enumerate(self.exe_answers)],
+            dtype=np.float64,
+        )
+        self._parse_answers()
+
+    @classmethod
+    def _from_compiled(cls, id, type, context, questions, answers, exe_answers, text_answers):
+        # Build an entry that was already checked when it was compiled,
+        # without checking or converting its attributes again
+        entry = object.__new__(cls)
+        entry.id = id
+        entry.type = type
+        entry.context = context
+        entry.questions = questions
+        entry.answers = answers
+        entry.exe_answers = exe_answers
+        entry.text_answers = text_answers
+        entry._parse_answers()
+        return entry
+
+    def _parse_answers(self):
+        # Everything that depends on the parsed model answers
+        programs = []
+        for question_number, answer in enumerate(self.answers):
+            try:
+                programs.append(parse_answer(answer))
+            except Exception as e:
+                raise ValueError(
+                    f"Entry {self.id} has an invalid answer to question "
+                    f"{question_number}: {answer} ({e})"
+                )
+        self.programs = tuple(programs)
+        self.is_operations = np.array([is_operation(a) for a in self.answers], dtype=bool)
+        operations = list(OP_MAP)
+        self.expected_ops = np.array(
+            [
+                operations.index(program.steps[0].op) if isinstance(program, Program) else NO_OPERATION
+                for program in self.programs
+            ],
+            dtype=np.int8,
+        )
+
+    def exe_answer(self, question_number):
+        """Get an executed model answer, which may not be a number."""
+        if question_number in self.text_answers:
+            return self.text_answers[question_number]
+        return self.exe_answers[question_number]
 
     def is_operation(self, question_number):
-        return is_operation(self.answers[question_number])
+        return bool(self.is_operations[question_number])
 
     def equivalent_operations(self, question_number, program, rel_tol, abs_tol):
         expected = self.answers[question_number]
@@ -24,4 +119,4 @@ class Entry:
 
     def backward_subtraction(self, question_number, program, rel_tol, abs_tol):
         expected = self.answers[question_number]
-        return backward_subtraction(expected, program, self.exe_answers, rel_tol, abs_tol)
\ No newline at end of file
+        return backward_subtraction(expected, program, self.exe_answers, rel_tol, abs_tol)
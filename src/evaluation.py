@@ -0,0 +1,373 @@
+import numbers
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from utils import (
+    Program, parse_answer, evaluate_arg, equivalent_operation, backward_subtraction,
+)
+from _consts import OP_MAP
+from _extra_typing import EntryKey, EntryKeyCollection
+
+# Operations are stored as their index in OP_MAP, with -1 for none
+OPERATIONS = list(OP_MAP)
+NO_OPERATION = -1
+COMMUTATIVE_OPERATIONS = [OPERATIONS.index("add"), OPERATIONS.index("multiply")]
+SUBTRACT = OPERATIONS.index("subtract")
+
+# Parse statuses of the generated answers
+PARSED = 0
+FORMAT_ERROR = 1
+EXECUTION_ERROR = 2
+
+@dataclass
+class RunTable:
+    """A columnar table of the expected and generated answers in a run.
+
+    Each row is a question answered in the run, and each column is a
+    NumPy array, so that metrics can be calculated with vectorised
+    masks and group-bys instead of looping over every question.
+    Rows for the same entry are contiguous, in question order.
+
+    Attributes:
+        entry_ids (np.ndarray): The key of each row's entry.
+        question_numbers (np.ndarray): The question number within the
+            entry.
+        expected (np.ndarray): The expected executed answer, or NaN if
+            it isn't a number.
+        got (np.ndarray): The generated executed answer, or NaN if it
+            isn't a number.
+        numeric (np.ndarray): Whether both executed answers are
+            numbers, so should be compared with a tolerance.
+        text_match (np.ndarray): Whether the executed answers are equal
+            when they aren't both numbers (e.g. "yes" and "yes").
+        is_operation (np.ndarray): Whether the expected answer is an
+            operation rather than a retrieval.
+        expected_op (np.ndarray): The index in OP_MAP of the expected
+            operation, or -1.
+        generated_op (np.ndarray): The index in OP_MAP of the generated
+            operation, or -1.
+        expected_args (np.ndarray): The two processed arguments of the
+            expected operation, or NaN.
+        generated_args (np.ndarray): The two processed arguments of the
+            generated operation, or NaN.
+        args_parsed (np.ndarray): Whether both the expected and
+            generated operations could be parsed and their arguments
+            processed.
+        multi_step (np.ndarray): Whether either operation is a
+            multi-step program. These rows are compared one at a time
+            using the programs below, rather than with `expected_args`
+            and `generated_args`.
+        expected_answers (np.ndarray): The expected answers.
+        generated_answers (np.ndarray): The generated answers.
+        exe_answers (np.ndarray): The expected executed answers of each
+            row's entry, for resolving references in the programs.
+        parse_status (np.ndarray): Whether the generated answer was
+            parsed (0), had a format error (1) or failed to execute (2).
+        entry_rows (Dict[EntryKey, Tuple[int, int]]): The start and stop
+            row of each entry.
+    """
+    entry_ids: np.ndarray
+    question_numbers: np.ndarray
+    expected: np.ndarray
+    got: np.ndarray
+    numeric: np.ndarray
+    text_match: np.ndarray
+    is_operation: np.ndarray
+    expected_op: np.ndarray
+    generated_op: np.ndarray
+    expected_args: np.ndarray
+    generated_args: np.ndarray
+    args_parsed: np.ndarray
+    multi_step: np.ndarray
+    expected_answers: np.ndarray
+    generated_answers: np.ndarray
+    exe_answers: np.ndarray
+    parse_status: np.ndarray
+    entry_rows: Dict[EntryKey, Tuple[int, int]]
+
+    def __len__(self):
+        return len(self.question_numbers)
+
+    def rows(self, indices: Optional[EntryKeyCollection] = None) -> np.ndarray:
+        """Get the rows for the given entries.
+
+        Entries without any rows are skipped. An entry that appears
+        more than once in `indices` has its rows included more than
+        once.
+        """
+        if indices is None:
+            return np.arange(len(self))
+        ranges = [
+            np.arange(*self.entry_rows[i]) for i in indices if i in self.entry_rows
+        ]
+        if not ranges:
+            return np.arange(0)
+        return np.concatenate(ranges)
+
+    def computational_matches(
+        self, rows: np.ndarray, rel_tol: float, abs_tol: float
+    ) -> np.ndarray:
+        """Whether each generated executed answer matches the expected one."""
+        return (
+            (self.numeric[rows] & isclose(self.expected[rows], self.got[rows], rel_tol, abs_tol))
+            | self.text_match[rows]
+        )
+
+    def computational_sweep(
+        self,
+        rows: np.ndarray,
+        rel_tols: np.ndarray,
+        abs_tols: np.ndarray,
+        groups: Optional[np.ndarray] = None,
+        group_count: int = 1,
+    ) -> np.ndarray:
+        """Count the generated executed answers that match the expected
+        ones at every pair of tolerances.
+
+        An answer matches in the same way as in `computational_matches`,
+        i.e. if its error is within `abs_tol` or its error relative to
+        the larger of the two answers is within `rel_tol`. The errors are
+        calculated and sorted once, and then for each `abs_tol`, the
+        answers within each `rel_tol` are counted with a binary search.
+
+        Args:
+            rows (np.ndarray): The rows to count.
+            rel_tols (np.ndarray): The relative tolerances.
+            abs_tols (np.ndarray): The absolute tolerances.
+            groups (Optional[np.ndarray]): The group of each row, from 0
+                to `group_count` - 1, to count separately. Rows with a
+                negative group are left out. Defaults to a single group.
+            group_count (int): The number of groups.
+
+        Returns:
+            scores (np.ndarray): The number of matches, indexed by
+                [abs_tol, rel_tol, group].
+        """
+        if groups is None:
+            groups = np.zeros(len(rows), dtype=np.int64)
+        known = groups >= 0
+        expected, got = self.expected[rows], self.got[rows]
+        numeric = self.numeric[rows] & known
+        with np.errstate(invalid="ignore"):
+            equal = numeric & (expected == got)
+            diff = np.abs(expected - got)
+            # Different answers that aren't both finite never match
+            close = numeric & ~equal & np.isfinite(diff)
+
+        scores = np.zeros((len(abs_tols), len(rel_tols), group_count), dtype=np.int64)
+        # Text answers and equal answers match at any tolerance
+        scores += np.bincount(groups[self.text_match[rows] & known], minlength=group_count)
+        scores += np.bincount(groups[equal], minlength=group_count)
+
+        groups, diff = groups[close], diff[close]
+        scale = np.maximum(np.abs(expected[close]), np.abs(got[close]))
+        rel_diff = diff / scale
+        # Sorted by group and then relative error, which stays sorted
+        # when the answers within each abs_tol are taken out
+        order = np.lexsort((rel_diff, groups))
+        groups, diff, scale, rel_diff = groups[order], diff[order], scale[order], rel_diff[order]
+        for k, abs_tol in enumerate(abs_tols):
+            within_abs = diff <= abs_tol
+            scores[k] += np.bincount(groups[within_abs], minlength=group_count)
+            rest = ~within_abs
+            rest_groups, rest_rel_diff = groups[rest], rel_diff[rest]
+            rest_diff, rest_scale = diff[rest], scale[rest]
+            bounds = np.searchsorted(rest_groups, np.arange(group_count + 1))
+            for group in range(group_count):
+                group_rows = slice(bounds[group], bounds[group + 1])
+                scores[k, :, group] += _count_within_rel_tols(
+                    rest_rel_diff[group_rows],
+                    rest_diff[group_rows],
+                    rest_scale[group_rows],
+                    rel_tols,
+                )
+        return scores
+
+    def operation_matches(
+        self, rows: np.ndarray, rel_tol: float, abs_tol: float
+    ) -> np.ndarray:
+        """Whether each generated operation is equivalent to the expected one.
+
+        The operations must match, as must the arguments, in either order
+        for commutative operations.
+        """
+        e1, e2 = self.expected_args[rows, 0], self.expected_args[rows, 1]
+        g1, g2 = self.generated_args[rows, 0], self.generated_args[rows, 1]
+        expected_op = self.expected_op[rows]
+        in_order = isclose(e1, g1, rel_tol, abs_tol) & isclose(e2, g2, rel_tol, abs_tol)
+        swapped = isclose(e1, g2, rel_tol, abs_tol) & isclose(e2, g1, rel_tol, abs_tol)
+        commutative = np.isin(expected_op, COMMUTATIVE_OPERATIONS)
+        matches = (
+            self.args_parsed[rows]
+            & (expected_op == self.generated_op[rows])
+            & (in_order | (commutative & swapped))
+        )
+        return self._compare_multi_step(rows, matches, equivalent_operation, rel_tol, abs_tol)
+
+    def backward_subtractions(
+        self, rows: np.ndarray, rel_tol: float, abs_tol: float
+    ) -> np.ndarray:
+        """Whether each generated subtraction has its arguments reversed."""
+        e1, e2 = self.expected_args[rows, 0], self.expected_args[rows, 1]
+        g1, g2 = self.generated_args[rows, 0], self.generated_args[rows, 1]
+        matches = (
+            self.args_parsed[rows]
+            & (self.expected_op[rows] == SUBTRACT)
+            & (self.generated_op[rows] == SUBTRACT)
+            & isclose(e1, g2, rel_tol, abs_tol)
+            & isclose(e2, g1, rel_tol, abs_tol)
+        )
+        return self._compare_multi_step(rows, matches, backward_subtraction, rel_tol, abs_tol)
+
+    def _compare_multi_step(self, rows, matches, compare, rel_tol, abs_tol):
+        # Multi-step programs don't fit in the argument columns, but
+        # they are rare enough to compare one at a time
+        for j in np.flatnonzero(self.multi_step[rows]):
+            row = rows[j]
+            matches[j] = compare(
+                self.expected_answers[row],
+                self.generated_answers[row],
+                self.exe_answers[row],
+                rel_tol,
+                abs_tol,
+            )
+        return matches
+
+
+def build_run_table(entries, conversations) -> RunTable:
+    """Build the table for all conversations that have an entry.
+
+    This is the only place that loops over every question in Python, so
+    it only needs to be done once per run.
+    """
+    columns = {name: [] for name in RunTable.__dataclass_fields__ if name != "entry_rows"}
+    entry_rows = {}
+    for i, conv in conversations.items():
+        if i not in entries:
+            continue
+        entry = entries[i]
+        start = len(columns["question_numbers"])
+        rows = zip(entry.answers, conv.answers, conv.exe_answers)
+        for question_number, (expected_answer, answer, got) in enumerate(rows):
+            expected = entry.exe_answer(question_number)
+            numeric = isinstance(expected, numbers.Real) and isinstance(got, numbers.Real)
+            _, expected_args, expected_steps = _parse_operation(
+                expected_answer, entry.exe_answers
+            )
+            generated_op, generated_args, generated_steps = _parse_operation(
+                answer, entry.exe_answers
+            )
+            if answer == "n/a":
+                parse_status = FORMAT_ERROR
+            elif isinstance(got, numbers.Real) and np.isnan(got):
+                parse_status = EXECUTION_ERROR
+            else:
+                parse_status = PARSED
+
+            columns["entry_ids"].append(i)
+            columns["question_numbers"].append(question_number)
+            columns["expected"].append(_as_float(expected))
+            columns["got"].append(_as_float(got))
+            columns["numeric"].append(numeric)
+            columns["text_match"].append(not numeric and expected == got)
+            columns["is_operation"].append(entry.is_operations[question_number])
+            columns["expected_op"].append(entry.expected_ops[question_number])
+            columns["generated_op"].append(generated_op)
+            columns["expected_args"].append(expected_args)
+            columns["generated_args"].append(generated_args)
+            columns["args_parsed"].append(
+                not np.isnan(expected_args).any() and not np.isnan(generated_args).any()
+            )
+            columns["multi_step"].append(expected_steps > 1 or generated_steps > 1)
+            columns["expected_answers"].append(expected_answer)
+            columns["generated_answers"].append(answer)
+            columns["exe_answers"].append(entry.exe_answers)
+            columns["parse_status"].append(parse_status)
+        entry_rows[i] = (start, len(columns["question_numbers"]))
+
+    return RunTable(
+        entry_ids=_object_array(columns["entry_ids"]),
+        question_numbers=np.array(columns["question_numbers"], dtype=np.int64),
+        expected=np.array(columns["expected"], dtype=np.float64),
+        got=np.array(columns["got"], dtype=np.float64),
+        numeric=np.array(columns["numeric"], dtype=bool),
+        text_match=np.array(columns["text_match"], dtype=bool),
+        is_operation=np.array(columns["is_operation"], dtype=bool),
+        expected_op=np.array(columns["expected_op"], dtype=np.int8),
+        generated_op=np.array(columns["generated_op"], dtype=np.int8),
+        expected_args=np.array(columns["expected_args"], dtype=np.float64).reshape(-1, 2),
+        generated_args=np.array(columns["generated_args"], dtype=np.float64).reshape(-1, 2),
+        args_parsed=np.array(columns["args_parsed"], dtype=bool),
+        multi_step=np.array(columns["multi_step"], dtype=bool),
+        expected_answers=_object_array(columns["expected_answers"]),
+        generated_answers=_object_array(columns["generated_answers"]),
+        exe_answers=_object_array(columns["exe_answers"]),
+        parse_status=np.array(columns["parse_status"], dtype=np.int8),
+        entry_rows=entry_rows,
+    )
+
+def answer_matches(expected, got, rel_tol: float = 0.001, abs_tol: float = 0.0) -> bool:
+    """Whether a single generated executed answer matches the expected
+    one, in the same way as `RunTable.computational_matches`.
+    """
+    if isinstance(expected, numbers.Real) and isinstance(got, numbers.Real):
+        return bool(isclose(np.float64(expected), np.float64(got), rel_tol, abs_tol))
+    return expected == got
+
+def isclose(a: np.ndarray, b: np.ndarray, rel_tol: float, abs_tol: float) -> np.ndarray:
+    """A vectorised version of `math.isclose`.
+
+    Unlike `np.isclose`, this is symmetric and treats infinities as only
+    close to themselves, in the same way as `math.isclose`.
+    """
+    with np.errstate(invalid="ignore"):
+        diff = np.abs(a - b)
+        tol = np.maximum(rel_tol * np.maximum(np.abs(a), np.abs(b)), abs_tol)
+        return (a == b) | (np.isfinite(diff) & (diff <= tol))
+
+def _count_within_rel_tols(rel_diff, diff, scale, rel_tols):
+    # The number of sorted relative errors within each tolerance. The
+    # relative errors are rounded, so any within a few ulps of a
+    # tolerance are compared exactly in the same way as `isclose`
+    rel_tols = np.asarray(rel_tols, dtype=np.float64)
+    low = np.searchsorted(rel_diff, rel_tols * (1 - 1e-12), side="left")
+    high = np.searchsorted(rel_diff, rel_tols * (1 + 1e-12), side="right")
+    counts = low.copy()
+    for j in np.flatnonzero(high > low):
+        near = slice(low[j], high[j])
+        counts[j] += np.count_nonzero(diff[near] <= rel_tols[j] * scale[near])
+    return counts
+
+def _parse_operation(program, exe_answers):
+    # Returns the operation (of the first step), the processed arguments
+    # of a single-step program and the number of steps
+    op = program.split("(")[0]
+    op = OPERATIONS.index(op) if "(" in program and op in OP_MAP else NO_OPERATION
+    try:
+        parsed = parse_answer(program)
+    except Exception:
+        return op, (np.nan, np.nan), 0
+    if not isinstance(parsed, Program):
+        return op, (np.nan, np.nan), 0
+    if len(parsed.steps) > 1:
+        return op, (np.nan, np.nan), len(parsed.steps)
+    try:
+        args = tuple(evaluate_arg(arg, exe_answers) for arg in parsed.steps[0].args)
+    except Exception:
+        return op, (np.nan, np.nan), 1
+    if not all(isinstance(arg, numbers.Real) for arg in args):
+        return op, (np.nan, np.nan), 1
+    return op, args, 1
+
+def _as_float(value):
+    return float(value) if isinstance(value, numbers.Real) else np.nan
+
+def _object_array(values):
+    # Assigned one at a time so that values which are themselves lists
+    # aren't broadcast into extra dimensions
+    array = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        array[i] = value
+    return array
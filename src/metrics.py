@@ -0,0 +1,394 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+# The kinds of call that are recorded
+ASK = "ask"
+ASK_ALL = "ask_all"
+GENERATE = "generate"
+
+PERCENTILES = (50, 95, 99)
+
+# The upper bounds in seconds of the latency and queue wait histogram
+# buckets written by `PrometheusSink`
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+@dataclass
+class CallRecord:
+    """Metrics for a single call to `ConversationHandler.ask` (or
+    `ask_all`) or `Client.generate`.
+
+    Tokens, queue wait and retries are added to every call in progress,
+    so an `ask` record includes those of the `generate` calls it made.
+
+    Attributes:
+        kind (str): The kind of call, e.g. "ask" or "generate".
+        start (float): The time the call started, as a Unix timestamp.
+        latency (float): The wall time taken by the call in seconds.
+        queue_wait (float): The time spent waiting for the rate limiter
+            before sending requests.
+        prompt_tokens (int): The tokens sent, as reported by the backend
+            or otherwise estimated.
+        completion_tokens (int): The tokens generated.
+        retries (int): The number of requests that were retried.
+        cache_hit (bool): Whether the response came from the response
+            cache.
+        error (Optional[str]): The class of the exception that the call
+            raised or, for an `ask`, that processing the answer raised,
+            e.g. "FormatException".
+        entry_id (Optional[EntryKey]): The key of the entry being run.
+        question_number (Optional[int]): The index of the question being
+            asked.
+    """
+    kind: str
+    start: float = 0
+    latency: float = 0
+    queue_wait: float = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    retries: int = 0
+    cache_hit: bool = False
+    error: Optional[str] = None
+    entry_id: Any = None
+    question_number: Optional[int] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+@dataclass
+class Summary:
+    """A summary of the records of one kind of call.
+
+    Attributes:
+        count (int): The number of calls.
+        errors (Dict[str, int]): The number of calls with each error.
+        latency (Dict[int, float]): The 50th, 95th and 99th percentile
+            latencies in seconds.
+        queue_wait (Dict[int, float]): The 50th, 95th and 99th
+            percentile queue waits in seconds.
+        total_latency (float): The total latency of the calls.
+        total_queue_wait (float): The total queue wait of the calls.
+        prompt_tokens (int): The total tokens sent.
+        completion_tokens (int): The total tokens generated.
+        retries (int): The total requests retried.
+        cache_hits (int): The number of responses from the cache.
+    """
+    count: int = 0
+    errors: Dict[str, int] = field(default_factory=dict)
+    latency: Dict[int, float] = field(default_factory=dict)
+    queue_wait: Dict[int, float] = field(default_factory=dict)
+    total_latency: float = 0
+    total_queue_wait: float = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    retries: int = 0
+    cache_hits: int = 0
+
+
+class MemorySink:
+    """Keeps every record in memory.
+
+    Attributes:
+        records (List[CallRecord]): The records so far.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def emit(self, record: CallRecord):
+        with self._lock:
+            self.records.append(record)
+
+    def summary(self) -> Dict[str, Summary]:
+        with self._lock:
+            return summarise(self.records)
+
+    def close(self):
+        pass
+
+
+class JsonlSink:
+    """Appends each record to a JSON lines file.
+
+    Args:
+        file_path (str): The path to the file.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        self._file = open(file_path, "a")
+
+    def emit(self, record: CallRecord):
+        line = json.dumps(record.to_dict(), default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class PrometheusSink:
+    """Writes aggregate metrics to a file in the Prometheus text format,
+    for the node exporter's textfile collector.
+
+    Only running totals and histogram bucket counts are kept for each
+    kind of call, rather than the records, so the sink uses the same
+    memory however long the run is. Latencies and queue waits are
+    exposed as histograms, from which Prometheus can estimate
+    percentiles.
+
+    The file is rewritten at most every `interval` seconds, and when the
+    sink is closed. It is replaced atomically, so it is never read half
+    written.
+
+    Args:
+        file_path (str): The path to the file, which should end in
+            ".prom".
+        interval (float): The minimum time in seconds between writes.
+        prefix (str): The prefix of the metric names.
+        buckets (Sequence[float]): The upper bounds in seconds of the
+            histogram buckets, in increasing order. A bucket for any
+            longer time is added.
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        interval: float = 10,
+        prefix: str = "convfinqa",
+        buckets: Sequence[float] = HISTOGRAM_BUCKETS,
+    ):
+        self.file_path = file_path
+        self.interval = interval
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self._totals = {}
+        self._lock = threading.Lock()
+        self._last_write = 0.0
+
+    def emit(self, record: CallRecord):
+        with self._lock:
+            totals = self._totals.get(record.kind)
+            if totals is None:
+                totals = self._totals[record.kind] = _Totals(len(self.buckets))
+            totals.add(record, self.buckets)
+            if time.monotonic() - self._last_write >= self.interval:
+                self._write()
+
+    def close(self):
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        lines = []
+        p = self.prefix
+        lines.append(f"# TYPE {p}_calls_total counter")
+        for kind, totals in self._totals.items():
+            lines.append(f'{p}_calls_total{{kind="{kind}"}} {totals.count}')
+        lines.append(f"# TYPE {p}_errors_total counter")
+        for kind, totals in self._totals.items():
+            for error, count in totals.errors.items():
+                lines.append(f'{p}_errors_total{{kind="{kind}",error="{error}"}} {count}')
+        for name, attribute in (("latency_seconds", "latency"), ("queue_wait_seconds", "queue_wait")):
+            lines.append(f"# TYPE {p}_{name} histogram")
+            for kind, totals in self._totals.items():
+                # Prometheus buckets count every value up to their bound
+                cumulative = 0
+                bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, getattr(totals, attribute + "_buckets")):
+                    cumulative += count
+                    lines.append(f'{p}_{name}_bucket{{kind="{kind}",le="{bound}"}} {cumulative}')
+                lines.append(
+                    f'{p}_{name}_sum{{kind="{kind}"}} {getattr(totals, "total_" + attribute)}'
+                )
+                lines.append(f'{p}_{name}_count{{kind="{kind}"}} {totals.count}')
+        for name in ("prompt_tokens", "completion_tokens", "retries", "cache_hits"):
+            lines.append(f"# TYPE {p}_{name}_total counter")
+            for kind, totals in self._totals.items():
+                lines.append(f'{p}_{name}_total{{kind="{kind}"}} {getattr(totals, name)}')
+
+        tmp_path = f"{self.file_path}.tmp"
+        with open(tmp_path, "w") as out:
+            out.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.file_path)
+        self._last_write = time.monotonic()
+
+
+class _Totals:
+    # The running totals of one kind of call, for `PrometheusSink`
+    def __init__(self, bucket_count):
+        self.count = 0
+        self.errors = Counter()
+        self.latency_buckets = [0] * (bucket_count + 1)
+        self.queue_wait_buckets = [0] * (bucket_count + 1)
+        self.total_latency = 0.0
+        self.total_queue_wait = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.retries = 0
+        self.cache_hits = 0
+
+    def add(self, record, buckets):
+        self.count += 1
+        if record.error is not None:
+            self.errors[record.error] += 1
+        # A value on a bucket's bound belongs to that bucket
+        self.latency_buckets[bisect_left(buckets, record.latency)] += 1
+        self.queue_wait_buckets[bisect_left(buckets, record.queue_wait)] += 1
+        self.total_latency += record.latency
+        self.total_queue_wait += record.queue_wait
+        self.prompt_tokens += record.prompt_tokens
+        self.completion_tokens += record.completion_tokens
+        self.retries += record.retries
+        self.cache_hits += record.cache_hit
+
+
+# The sinks records are sent to, and the records of the calls in
+# progress in the current thread or task, innermost last
+_sinks = []
+_sinks_lock = threading.Lock()
+_active = contextvars.ContextVar("active_calls", default=())
+_labels = contextvars.ContextVar("call_labels", default={})
+
+def add_sink(sink):
+    with _sinks_lock:
+        _sinks.append(sink)
+
+def remove_sink(sink):
+    with _sinks_lock:
+        _sinks.remove(sink)
+
+@contextmanager
+def collecting(*sinks):
+    """Send records to some sinks while in the context, and close them
+    when it exits.
+
+    Example:
+        with metrics.collecting(MemorySink(), JsonlSink("calls.jsonl")) as (memory, _):
+            tester.run()
+        print_summary(memory.summary())
+    """
+    for sink in sinks:
+        add_sink(sink)
+    try:
+        yield sinks
+    finally:
+        for sink in sinks:
+            remove_sink(sink)
+            sink.close()
+
+@contextmanager
+def labels(**values):
+    """Label the calls made in the context, e.g. with the entry and
+    question being run.
+    """
+    token = _labels.set({**_labels.get(), **values})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+@contextmanager
+def record(kind: str):
+    """Record a call made in the context.
+
+    Nothing is recorded if there are no sinks. An exception raised in
+    the context is recorded as the call's error.
+    """
+    if not _sinks:
+        yield None
+        return
+    call = CallRecord(kind, start=time.time(), **_labels.get())
+    token = _active.set(_active.get() + (call,))
+    start = time.perf_counter()
+    try:
+        yield call
+    except BaseException as e:
+        call.error = type(e).__name__
+        raise
+    finally:
+        call.latency = time.perf_counter() - start
+        _active.reset(token)
+        with _sinks_lock:
+            sinks = list(_sinks)
+        for sink in sinks:
+            sink.emit(call)
+
+def add(**values):
+    """Add to the counts (e.g. tokens or retries) of every call in
+    progress.
+    """
+    for call in _active.get():
+        for name, value in values.items():
+            setattr(call, name, getattr(call, name) + value)
+
+def annotate(**values):
+    """Set fields (e.g. the error) of the innermost call in progress."""
+    calls = _active.get()
+    if calls:
+        for name, value in values.items():
+            setattr(calls[-1], name, value)
+
+def percentiles(values: Iterable[float]) -> Dict[int, float]:
+    values = np.asarray(list(values), dtype=float)
+    if values.size == 0:
+        return {percentile: 0.0 for percentile in PERCENTILES}
+    return {
+        percentile: float(value)
+        for percentile, value in zip(PERCENTILES, np.percentile(values, PERCENTILES))
+    }
+
+def summarise(records: Iterable[CallRecord]) -> Dict[str, Summary]:
+    """Summarise some records by their kind."""
+    by_kind = defaultdict(list)
+    for call in records:
+        by_kind[call.kind].append(call)
+    summaries = {}
+    for kind, calls in by_kind.items():
+        summaries[kind] = Summary(
+            count=len(calls),
+            errors=dict(Counter(call.error for call in calls if call.error is not None)),
+            latency=percentiles(call.latency for call in calls),
+            queue_wait=percentiles(call.queue_wait for call in calls),
+            total_latency=sum(call.latency for call in calls),
+            total_queue_wait=sum(call.queue_wait for call in calls),
+            prompt_tokens=sum(call.prompt_tokens for call in calls),
+            completion_tokens=sum(call.completion_tokens for call in calls),
+            retries=sum(call.retries for call in calls),
+            cache_hits=sum(call.cache_hit for call in calls),
+        )
+    return summaries
+
+def load_records(file_path: str) -> List[CallRecord]:
+    """Load the records written by a `JsonlSink`."""
+    with open(file_path) as records_file:
+        return [CallRecord(**json.loads(line)) for line in records_file if line.strip()]
+
+def print_summary(summaries: Dict[str, Summary]):
+    for kind, summary in summaries.items():
+        latency = ", ".join(f"p{p} {v:.3f}s" for p, v in summary.latency.items())
+        queue_wait = ", ".join(f"p{p} {v:.3f}s" for p, v in summary.queue_wait.items())
+        print(f"{kind}: {summary.count} calls, {summary.total_latency:.1f}s in total")
+        print(f"  latency: {latency}")
+        print(f"  queue wait: {queue_wait}")
+        print(
+            f"  tokens: {summary.prompt_tokens} prompt, "
+            f"{summary.completion_tokens} completion"
+        )
+        print(f"  retries: {summary.retries}, cache hits: {summary.cache_hits}")
+        if summary.errors:
+            errors = ", ".join(f"{error} {count}" for error, count in summary.errors.items())
+            print(f"  errors: {errors}")
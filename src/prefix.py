@@ -0,0 +1,105 @@
+from typing import Dict, Iterable, Sequence, Tuple
+
+from _consts import INIT_MESSAGES
+
+class SharedPrefix:
+    """An interned, immutable list of messages that starts every
+    conversation, e.g. the instructions and example conversation.
+
+    Prefixes are shared between conversations rather than copied into
+    each of them, and are pickled by name, so a pickled run doesn't
+    repeat the prefix for every entry. Get one with `SharedPrefix.intern`
+    rather than by constructing it directly.
+
+    Args:
+        name (str): The name the prefix is interned and pickled under.
+        messages (Sequence[Dict[str, str]]): The messages in the prefix.
+
+    Attributes:
+        name (str): The name the prefix is interned and pickled under.
+        messages (Tuple[Dict[str, str], ...]): The messages in the
+            prefix. These must not be modified.
+    """
+    _interned: Dict[str, "SharedPrefix"] = {}
+
+    def __init__(self, name: str, messages: Sequence[Dict[str, str]]):
+        self.name = name
+        self.messages = tuple(dict(message) for message in messages)
+
+    @classmethod
+    def intern(cls, name: str, messages: Sequence[Dict[str, str]]) -> "SharedPrefix":
+        """Get the shared prefix with the given name, creating it if
+        there isn't one yet.
+
+        Raises:
+            ValueError: If there is already a prefix with the name but
+                different messages.
+        """
+        prefix = cls._interned.get(name)
+        if prefix is None:
+            prefix = cls._interned[name] = cls(name, messages)
+        elif list(prefix.messages) != list(messages):
+            raise ValueError(f"A different prefix is already interned as {name!r}")
+        return prefix
+
+    @classmethod
+    def get(cls, name: str) -> "SharedPrefix":
+        """Get the shared prefix with the given name.
+
+        Raises:
+            KeyError: If no prefix has been interned with the name, e.g.
+                when unpickling a run that used a custom prefix without
+                interning it first.
+        """
+        try:
+            return cls._interned[name]
+        except KeyError:
+            raise KeyError(
+                f"No prefix is interned as {name!r}; intern it with "
+                "SharedPrefix.intern before loading conversations that use it"
+            ) from None
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def __reduce__(self) -> Tuple:
+        return SharedPrefix.get, (self.name,)
+
+    def __repr__(self) -> str:
+        return f"SharedPrefix({self.name!r}, {len(self.messages)} messages)"
+
+
+class Prompt(list):
+    """A list of messages to send to an LLM, which knows how many of its
+    leading messages are the same for every request in a conversation,
+    i.e. the prefix, and the context and the confirmation of the context
+    if the whole context is sent. Backends can keep these in their
+    prefix cache.
+
+    Args:
+        messages (Iterable[Dict[str, str]]): The messages.
+        cacheable (int): The number of leading messages that are the
+            same for every request.
+        shared (int): The number of leading messages that are also the
+            same for other conversations, i.e. the prefix.
+        expected_answers (int): The number of answer lines the response
+            should contain, so that a streamed response isn't cut off
+            after the first one.
+    """
+
+    def __init__(
+        self,
+        messages: Iterable[Dict[str, str]] = (),
+        cacheable: int = 0,
+        shared: int = 0,
+        expected_answers: int = 1,
+    ):
+        super().__init__(messages)
+        self.cacheable = cacheable
+        self.shared = shared
+        self.expected_answers = expected_answers
+
+
+# The prefix used by default, with the instructions and examples in
+# _consts.py
+DEFAULT_PREFIX = SharedPrefix.intern("default", INIT_MESSAGES)
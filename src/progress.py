@@ -0,0 +1,249 @@
+import json
+import sys
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass
+from typing import Optional, TextIO
+
+import metrics
+
+@dataclass
+class ProgressSnapshot:
+    """The progress of a run at some point in time.
+
+    Attributes:
+        time (float): The time of the snapshot, as a Unix timestamp.
+        elapsed (float): The seconds since the run started.
+        entries_done (int): The entries finished.
+        entries_total (int): The entries in the run.
+        questions_done (int): The questions answered.
+        questions_total (int): The questions to answer in the run.
+        questions_per_second (float): The recent rate of answering
+            questions.
+        tokens_per_second (float): The prompt and completion tokens
+            processed per second, for clients that report them.
+        mean_latency (float): The mean time taken by recent questions.
+        eta (Optional[float]): The estimated seconds until the run
+            finishes, if known.
+        errors (int): The questions whose answers couldn't be processed.
+        correct (int): The questions answered correctly.
+        accuracy (float): The fraction of questions with expected answers
+            that were answered correctly.
+    """
+    time: float
+    elapsed: float
+    entries_done: int
+    entries_total: int
+    questions_done: int
+    questions_total: int
+    questions_per_second: float
+    tokens_per_second: float
+    mean_latency: float
+    eta: Optional[float]
+    errors: int
+    correct: int
+    accuracy: float
+
+
+class ProgressReporter:
+    """Reports the progress of a run as it goes.
+
+    A single progress line is redrawn as questions are answered, with
+    the throughput, the estimated time remaining and the errors and
+    accuracy so far. Messages logged through the reporter are printed
+    above the progress line rather than through it. Snapshots of the
+    progress can also be appended to a JSON lines file.
+
+    The reporter can be updated from any number of threads or tasks at
+    once. While a run is in progress, it is registered as a metrics sink
+    to count the tokens processed.
+
+    Args:
+        out (Optional[TextIO]): The stream to draw the progress line on,
+            or None to not draw it. Defaults to stdout.
+        render_interval (float): The minimum time in seconds between
+            redraws of the progress line.
+        snapshot_path (Optional[str]): A JSON lines file to append
+            snapshots to.
+        snapshot_interval (float): The time in seconds between
+            snapshots.
+        window (int): The number of recent questions that the latency
+            is averaged over.
+        rate_window (float): The time in seconds that the rate is
+            measured over.
+    """
+
+    def __init__(
+        self,
+        out: Optional[TextIO] = sys.stdout,
+        render_interval: float = 0.2,
+        snapshot_path: Optional[str] = None,
+        snapshot_interval: float = 10,
+        window: int = 50,
+        rate_window: float = 30,
+    ):
+        self.out = out
+        self.render_interval = render_interval
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.window = window
+        self.rate_window = rate_window
+        self._lock = threading.Lock()
+        self._line_length = 0
+        self._reset(0, 0)
+
+    def start(self, entries: int, questions: int):
+        """Start reporting on a run of some entries and questions."""
+        with self._lock:
+            self._reset(entries, questions)
+        metrics.add_sink(self)
+
+    def question_done(
+        self,
+        elapsed: float,
+        error: Optional[str] = None,
+        correct: Optional[bool] = None,
+    ):
+        """Record that a question has been answered.
+
+        Args:
+            elapsed (float): The time taken to answer the question.
+            error (Optional[str]): The error processing the answer, if
+                any.
+            correct (Optional[bool]): Whether the answer was correct, or
+                None if there is no expected answer.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._questions_done += 1
+            self._errors += error is not None
+            if correct is not None:
+                self._scored += 1
+                self._correct += correct
+            self._latencies.append(elapsed)
+            self._times.append(now)
+            self._update(now)
+
+    def entry_done(self):
+        with self._lock:
+            self._entries_done += 1
+            self._update(time.monotonic())
+
+    def log(self, message: str):
+        """Print a message above the progress line."""
+        with self._lock:
+            if self.out is None:
+                print(message)
+                return
+            self._clear()
+            self.out.write(message + "\n")
+            self._render()
+
+    def finish(self):
+        """Draw the final progress line and write a final snapshot."""
+        metrics.remove_sink(self)
+        with self._lock:
+            if self.out is not None:
+                self._render()
+                self.out.write("\nDone\n")
+                self.out.flush()
+            self._write_snapshot()
+
+    def snapshot(self) -> ProgressSnapshot:
+        with self._lock:
+            return self._snapshot(time.monotonic())
+
+    # As a metrics sink, count the tokens processed
+    def emit(self, record: metrics.CallRecord):
+        if record.kind == metrics.GENERATE:
+            with self._lock:
+                self._tokens += record.prompt_tokens + record.completion_tokens
+
+    def close(self):
+        pass
+
+    def _reset(self, entries, questions):
+        self._entries_total = entries
+        self._questions_total = questions
+        self._entries_done = 0
+        self._questions_done = 0
+        self._errors = 0
+        self._correct = 0
+        self._scored = 0
+        self._tokens = 0
+        self._latencies = deque(maxlen=self.window)
+        self._times = deque()
+        self._start = time.monotonic()
+        self._last_render = 0.0
+        self._last_snapshot = self._start
+
+    def _update(self, now):
+        if self.out is not None and now - self._last_render >= self.render_interval:
+            self._render()
+        if self.snapshot_path is not None and now - self._last_snapshot >= self.snapshot_interval:
+            self._write_snapshot()
+
+    def _snapshot(self, now):
+        elapsed = now - self._start
+        done = self._questions_done
+        # The rate over the last rate_window seconds, which follows
+        # changes in the rate better than the rate over the whole run
+        while self._times and self._times[0] < now - self.rate_window:
+            self._times.popleft()
+        span = min(self.rate_window, elapsed)
+        rate = len(self._times) / span if span > 0 else 0.0
+        remaining = self._questions_total - done
+        return ProgressSnapshot(
+            time=time.time(),
+            elapsed=elapsed,
+            entries_done=self._entries_done,
+            entries_total=self._entries_total,
+            questions_done=done,
+            questions_total=self._questions_total,
+            questions_per_second=rate,
+            tokens_per_second=self._tokens / elapsed if elapsed > 0 else 0.0,
+            mean_latency=(
+                sum(self._latencies) / len(self._latencies) if self._latencies else 0.0
+            ),
+            eta=remaining / rate if rate > 0 else None,
+            errors=self._errors,
+            correct=self._correct,
+            accuracy=self._correct / self._scored if self._scored else 0.0,
+        )
+
+    def _render(self):
+        s = self._snapshot(time.monotonic())
+        eta = _format_seconds(s.eta) if s.eta is not None else "?"
+        line = (
+            f"Entries {s.entries_done}/{s.entries_total}, "
+            f"questions {s.questions_done}/{s.questions_total} | "
+            f"{s.questions_per_second:.2f} q/s, {s.tokens_per_second:.0f} tok/s, "
+            f"{s.mean_latency:.2f} s/q | errors {s.errors}, accuracy {s.accuracy:.1%} | "
+            f"ETA {eta}"
+        )
+        # Pad with spaces to cover any longer line drawn before
+        self.out.write("\r" + line.ljust(self._line_length))
+        self.out.flush()
+        self._line_length = len(line)
+        self._last_render = time.monotonic()
+
+    def _clear(self):
+        self.out.write("\r" + " " * self._line_length + "\r")
+        self._line_length = 0
+
+    def _write_snapshot(self):
+        if self.snapshot_path is None:
+            return
+        with open(self.snapshot_path, "a") as out:
+            out.write(json.dumps(asdict(self._snapshot(time.monotonic()))) + "\n")
+        self._last_snapshot = time.monotonic()
+
+
+def _format_seconds(seconds):
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}h{minutes:02d}m{seconds:02d}s"
+    return f"{minutes}m{seconds:02d}s"
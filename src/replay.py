@@ -0,0 +1,354 @@
+import json
+import math
+import pickle
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+from _extra_typing import Conversation
+
+# Matches the question number and question in a line of a user
+# message, as formatted by ConversationHandler. A message may also have
+# earlier questions in a ledger, so the question asked is the last match
+QUESTION_PATTERN = re.compile(r"^Q(\d+): (.*)\n", re.MULTILINE)
+
+def constant_latency(seconds: float) -> Callable[[random.Random], float]:
+    return lambda rng: seconds
+
+def uniform_latency(low: float, high: float) -> Callable[[random.Random], float]:
+    return lambda rng: rng.uniform(low, high)
+
+def lognormal_latency(median: float, sigma: float) -> Callable[[random.Random], float]:
+    """A long-tailed latency distribution, typical of LLM endpoints."""
+    return lambda rng: rng.lognormvariate(math.log(median), sigma)
+
+
+class InjectedHTTPError(Exception):
+    """An HTTP error raised by the replay client to simulate a failure.
+
+    This has the same `response.status_code` and `response.headers`
+    attributes as the errors raised by HuggingFace clients, so it is
+    handled in the same way.
+    """
+
+    def __init__(self, status_code: int, retry_after: Optional[float] = None):
+        kind = "Client" if status_code < 500 else "Server"
+        super().__init__(f"{status_code} {kind} Error: injected by ReplayClient")
+        self.response = _InjectedResponse(status_code, retry_after)
+
+
+class _InjectedResponse:
+    def __init__(self, status_code, retry_after):
+        self.status_code = status_code
+        self.headers = {}
+        if retry_after is not None:
+            self.headers["Retry-After"] = str(retry_after)
+
+
+class ReplayClient:
+    """A fake client that replays the responses from a previous run.
+
+    This can be used anywhere a `Client` is expected, to run the rest
+    of the pipeline offline. Each request is matched to a recorded
+    response by its question number and question, using the entry's
+    context to tell apart identical questions from different entries.
+    Requests with no recorded response get the `fallback` response.
+
+    Args:
+        conversations (Dict[EntryKey, ConversationHandler]): The
+            conversations from a previous run.
+        latency (Optional[Callable[[random.Random], float]]): A function
+            that samples the time in seconds to wait before responding,
+            e.g. `lognormal_latency(1.5, 0.5)`. Defaults to no latency.
+        rate_limit_rate (float): The probability of a request failing
+            with a 429 error.
+        timeout_rate (float): The probability of a request timing out.
+        retry_after (Optional[float]): The Retry-After time in seconds
+            to report with 429 errors.
+        timeout (float): The time in seconds to wait before raising a
+            timeout.
+        fallback (str): The response for requests that weren't recorded.
+            "{i}" is replaced with the question number.
+        seed (Optional[int]): A seed for the latency and failure
+            sampling.
+
+    Attributes:
+        requests (int): The number of requests received.
+        replayed (int): The number of requests answered with a recorded
+            response.
+    """
+
+    def __init__(
+        self,
+        conversations,
+        latency: Optional[Callable[[random.Random], float]] = None,
+        rate_limit_rate: float = 0.0,
+        timeout_rate: float = 0.0,
+        retry_after: Optional[float] = None,
+        timeout: float = 10.0,
+        fallback: str = "ANS{i} = 0",
+        seed: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.timeout_rate = timeout_rate
+        self.retry_after = retry_after
+        self.timeout = timeout
+        self.fallback = fallback
+        self.requests = 0
+        self.replayed = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._responses = _index_responses(conversations)
+
+    @classmethod
+    def from_pickle(cls, pickle_file_path: str, **kwargs) -> "ReplayClient":
+        with open(pickle_file_path, "rb") as conversation_file:
+            conversations = pickle.load(conversation_file)
+        return cls(conversations, **kwargs)
+
+    def generate(self, messages: Conversation, max_tokens: int = 500) -> str:
+        with self._lock:
+            self.requests += 1
+            delay = self.latency(self._rng) if self.latency is not None else 0.0
+            failure = self._rng.random()
+        if failure < self.timeout_rate:
+            time.sleep(self.timeout)
+            raise TimeoutError("Request timed out (injected by ReplayClient)")
+        time.sleep(delay)
+        if failure < self.timeout_rate + self.rate_limit_rate:
+            raise InjectedHTTPError(429, self.retry_after)
+
+        question_number, question = _last_question(messages)
+        response = self._lookup(messages, question_number, question)
+        if response is None:
+            return self.fallback.replace("{i}", str(question_number))
+        with self._lock:
+            self.replayed += 1
+        return response
+
+    def _lookup(self, messages, question_number, question):
+        candidates = self._responses.get((question_number, question))
+        if not candidates:
+            return None
+        if len(candidates) > 1:
+            contents = {message["content"] for message in messages}
+            for context, response in candidates:
+                if context in contents:
+                    return response
+        return candidates[0][1]
+
+
+def _index_responses(conversations):
+    responses = {}
+    for ch in conversations.values():
+        context = ch.context
+        question_number = 0
+        for message in ch.turns:
+            if message["role"] != "user":
+                continue
+            match = QUESTION_PATTERN.search(message["content"])
+            if match is None or question_number >= len(ch.full_answers):
+                continue
+            key = (int(match.group(1)), match.group(2))
+            responses.setdefault(key, []).append(
+                (context, ch.full_answers[question_number])
+            )
+            question_number += 1
+    return responses
+
+def _last_question(messages):
+    for message in reversed(messages):
+        if message["role"] != "user":
+            continue
+        matches = QUESTION_PATTERN.findall(message["content"])
+        if matches:
+            question_number, question = matches[-1]
+            return int(question_number), question
+        break
+    return 0, None
+
+
+class ReplayServer:
+    """A local HTTP server that speaks the chat completion protocol.
+
+    POST requests to any path (e.g. "/v1/chat/completions") are answered
+    by the given client, so the full HTTP stack of a real `Client` can
+    be exercised offline by pointing it at `url`:
+        server = ReplayServer(ReplayClient.from_pickle(path)).start()
+        client = Client(server.url, token="unused")
+
+    Failures injected by a `ReplayClient` are returned as the matching
+    HTTP errors. Streamed requests are answered with server-sent
+    events, one whitespace-delimited piece of the response at a time.
+
+    Args:
+        client: The client used to generate responses.
+        host (str): The host to listen on.
+        port (int): The port to listen on. 0 picks a free port.
+        token_latency (float): The time in seconds to wait between
+            streamed pieces, to simulate generation speed.
+    """
+
+    def __init__(
+        self,
+        client,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        token_latency: float = 0.0,
+    ):
+        self.client = client
+        self._server = ThreadingHTTPServer(
+            (host, port), _make_handler(client, token_latency)
+        )
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "ReplayServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def _make_handler(client, token_latency):
+    class ChatCompletionHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            try:
+                content = client.generate(
+                    request["messages"], max_tokens=request.get("max_tokens", 500)
+                )
+            except InjectedHTTPError as e:
+                self._send_json(
+                    e.response.status_code, {"error": str(e)}, e.response.headers
+                )
+                return
+            except TimeoutError as e:
+                self._send_json(504, {"error": str(e)})
+                return
+            for stop in request.get("stop") or []:
+                if stop in content:
+                    content = content[:content.index(stop)]
+            if request.get("stream"):
+                self._send_stream(request, content)
+            else:
+                self._send_json(200, _completion(request, content))
+
+        def _send_stream(self, request, content):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            try:
+                for piece in re.findall(r"\s*\S+|\s+", content):
+                    time.sleep(token_latency)
+                    chunk = json.dumps(_completion_chunk(request, piece))
+                    self.wfile.write(f"data: {chunk}\n\n".encode())
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # The client stopped reading the stream early
+                pass
+
+        def _send_json(self, status, body, headers=None):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ChatCompletionHandler
+
+def _completion(request, content):
+    prompt_tokens = sum(len(m["content"]) for m in request["messages"]) // 4
+    completion_tokens = len(content) // 4
+    return {
+        "id": "replay",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "replay"),
+        "system_fingerprint": "replay",
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "logprobs": None,
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+def _completion_chunk(request, piece):
+    return {
+        "id": "replay",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": request.get("model", "replay"),
+        "system_fingerprint": "replay",
+        "choices": [
+            {
+                "index": 0,
+                "delta": {"role": "assistant", "content": piece},
+                "logprobs": None,
+                "finish_reason": None,
+            }
+        ],
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Serve the responses from a pickled run over HTTP."
+    )
+    parser.add_argument("pickle_file_path")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="median response latency in seconds")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    replay_client = ReplayClient.from_pickle(
+        args.pickle_file_path,
+        latency=lognormal_latency(args.latency, 0.5) if args.latency else None,
+        rate_limit_rate=args.rate_limit_rate,
+        timeout_rate=args.timeout_rate,
+    )
+    server = ReplayServer(replay_client, args.host, args.port)
+    print(f"Serving on {server.url}")
+    server.serve_forever()
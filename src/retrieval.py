@@ -0,0 +1,273 @@
+import math
+import re
+from collections import Counter
+from typing import List, NamedTuple, Sequence, Set
+
+from utils import Literal, Program, parse_answer, parse_arg
+
+TABLE_PATTERN = re.compile(r"(<table[^>]*>)(.*?)(</table>)", re.DOTALL)
+ROW_PATTERN = re.compile(r"<tr>.*?</tr>", re.DOTALL)
+CELL_PATTERN = re.compile(r"<t[dh][^>]*>(.*?)</t[dh]>", re.DOTALL)
+# Sentences in the dataset end with " . ", and in encoded contexts with
+# ". " or a new line
+SENTENCE_END = re.compile(r"(?<=\.)\s+|\n+")
+WORD_PATTERN = re.compile(r"[a-z]+|\d[\d,]*(?:\.\d+)?")
+NUMBER_PATTERN = re.compile(r"-?\$?\s?\d[\d,]*(?:\.\d+)?\s?%?")
+
+# A few very common words that say nothing about which span is relevant
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in",
+    "is", "it", "of", "on", "or", "that", "the", "then", "this", "to",
+    "was", "were", "what", "which", "with",
+}
+
+class Span(NamedTuple):
+    """A sentence or table row in a context.
+
+    Attributes:
+        text (str): The text of the span, as it appears in the context.
+        table (int): The index of the table the span is a row of, or -1
+            for a sentence.
+        header (bool): Whether the span is the header row of a table.
+    """
+    text: str
+    table: int
+    header: bool
+
+
+class ContextRetriever:
+    """A per-entry index of a context, for retrieving the parts of it
+    that are relevant to a question.
+
+    The context is split into sentences and table rows, which are
+    scored against each question with BM25. The `k` best spans are
+    kept, along with every span kept for an earlier question in the
+    conversation (follow-up questions often rely on them) and every
+    span containing a number used in an earlier answer. Table rows are
+    always sent with their table's header row, and small tables are
+    sent whole if their header row or the sentence introducing them is
+    retrieved, as the question is then most likely about one of their
+    rows. The spans are sent in the order they appear in the context.
+
+    If no span scores at least `min_score`, the question probably
+    doesn't share enough words with the context to retrieve reliably,
+    so the full context is used instead.
+
+    Args:
+        context (str): The context to index, either a processed context
+            with HTML tables or an encoded one with pipe tables.
+        k (int): The number of spans to retrieve for each question.
+        max_table_rows (int): The number of rows up to which a table is
+            sent whole.
+        min_score (float): The BM25 score below which the full context
+            is used.
+        k1 (float): The BM25 term frequency saturation.
+        b (float): The BM25 length normalisation.
+
+    Attributes:
+        spans (List[Span]): The sentences and table rows of the context.
+        selected (Set[int]): The spans retrieved so far.
+        fallbacks (int): The number of questions for which the full
+            context was used.
+    """
+
+    def __init__(
+        self,
+        context: str,
+        k: int = 4,
+        max_table_rows: int = 12,
+        min_score: float = 1.0,
+        k1: float = 1.5,
+        b: float = 0.75,
+    ):
+        self.context = context
+        self.k = k
+        self.max_table_rows = max_table_rows
+        self.min_score = min_score
+        self.k1 = k1
+        self.b = b
+        self.spans, self._tables = split_context(context)
+        self.selected = set()
+        self.fallbacks = 0
+
+        self._terms = [Counter(tokenize(span.text)) for span in self.spans]
+        self._lengths = [sum(terms.values()) for terms in self._terms]
+        self._mean_length = sum(self._lengths) / len(self._lengths) if self.spans else 0
+        document_frequency = Counter(term for terms in self._terms for term in terms)
+        n = len(self.spans)
+        self._idf = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for term, df in document_frequency.items()
+        }
+        self._numbers = [numbers_in(span.text) for span in self.spans]
+
+    def scores(self, question: str) -> List[float]:
+        """The BM25 score of each span for the question."""
+        query = set(tokenize(question))
+        scores = []
+        for terms, length in zip(self._terms, self._lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / (self._mean_length or 1))
+            for term in query:
+                tf = terms.get(term, 0)
+                if tf:
+                    score += self._idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            scores.append(score)
+        return scores
+
+    def retrieve(self, question: str, answers: Sequence[str] = ()) -> str:
+        """Get the context to send with a question.
+
+        Args:
+            question (str): The question being asked.
+            answers (Sequence[str]): The extracted answers to the earlier
+                questions in the conversation.
+
+        Returns:
+            context (str): The relevant spans of the context, or the full
+                context if the retrieval isn't confident.
+        """
+        if not self.spans:
+            return self.context
+        scores = self.scores(question)
+        if max(scores) < self.min_score:
+            self.fallbacks += 1
+            return self.context
+
+        best = sorted(range(len(scores)), key=lambda i: -scores[i])[:self.k]
+        best = [i for i in best if scores[i] > 0]
+        self.selected.update(best)
+        for i in best:
+            self.selected.update(self._whole_table(i))
+        self.select_referenced(answers)
+        return self.render(self.selected)
+
+    def select_referenced(self, answers: Sequence[str]):
+        """Select the spans containing numbers that the answers refer to.
+
+        Args:
+            answers (Sequence[str]): The extracted answers to the earlier
+                questions in the conversation.
+        """
+        referenced = _referenced_numbers(answers)
+        if referenced:
+            self.selected.update(
+                i for i, numbers in enumerate(self._numbers) if numbers & referenced
+            )
+
+    def _whole_table(self, i):
+        # The rows of the small table that span i is the header of, or
+        # the sentence just before
+        if self.spans[i].table < 0 and i + 1 < len(self.spans) and self.spans[i + 1].header:
+            i += 1
+        if not self.spans[i].header:
+            return []
+        rows = [j for j, span in enumerate(self.spans) if span.table == self.spans[i].table]
+        return rows if len(rows) <= self.max_table_rows else []
+
+    def render(self, selected: Set[int]) -> str:
+        """Render the given spans in context order, with table headers."""
+        selected = set(selected)
+        selected.update(
+            i for i, span in enumerate(self.spans)
+            if span.header and any(self.spans[j].table == span.table for j in selected)
+        )
+        parts = []
+        rows = []
+        for i in sorted(selected):
+            span = self.spans[i]
+            if rows and span.table != self.spans[rows[-1]].table:
+                parts.append(self._render_rows(rows))
+                rows = []
+            if span.table >= 0:
+                rows.append(i)
+            else:
+                parts.append(span.text)
+        if rows:
+            parts.append(self._render_rows(rows))
+        return "\n".join(parts)
+
+    def _render_rows(self, rows):
+        tags = self._tables[self.spans[rows[0]].table]
+        if tags is None:
+            return "\n".join(self.spans[i].text for i in rows)
+        return tags[0] + "".join(self.spans[i].text for i in rows) + tags[1]
+
+
+def split_context(context: str):
+    """Split a context into sentences and table rows.
+
+    Returns:
+        spans (List[Span]): The spans, in context order.
+        tables (List[Optional[Tuple[str, str]]]): The opening and closing
+            tags of each HTML table, or None for pipe tables.
+    """
+    spans = []
+    tables = []
+    end = 0
+    for match in TABLE_PATTERN.finditer(context):
+        _split_text(context[end:match.start()], spans, tables)
+        table = len(tables)
+        tables.append((match.group(1), match.group(3)))
+        for i, row in enumerate(ROW_PATTERN.findall(match.group(2))):
+            spans.append(Span(row, table, i == 0))
+        end = match.end()
+    _split_text(context[end:], spans, tables)
+    return spans, tables
+
+def tokenize(text: str) -> List[str]:
+    text = CELL_PATTERN.sub(r" \1 ", text.lower())
+    return [word.replace(",", "") for word in WORD_PATTERN.findall(text) if word not in STOP_WORDS]
+
+def _split_text(text, spans, tables):
+    # Lines with pipes are rows of an encoded table, and anything else
+    # is split into sentences
+    table = None
+    for line in text.split("\n"):
+        if "|" in line:
+            if table is None:
+                table = len(tables)
+                tables.append(None)
+                spans.append(Span(line, table, True))
+            else:
+                spans.append(Span(line, table, False))
+            continue
+        table = None
+        for sentence in SENTENCE_END.split(line):
+            if sentence.strip():
+                spans.append(Span(sentence.strip(), -1, False))
+
+def numbers_in(text: str) -> Set[float]:
+    """The numbers written in some text, rounded for comparison."""
+    numbers = set()
+    for match in NUMBER_PATTERN.findall(CELL_PATTERN.sub(r" \1 ", text)):
+        try:
+            numbers.add(_key(parse_arg(match).value))
+        except Exception:
+            continue
+    return numbers
+
+def literal_numbers(answer: str) -> Set[float]:
+    """The numbers written in an answer, rounded for comparison."""
+    try:
+        parsed = parse_answer(answer)
+    except Exception:
+        return set()
+    if isinstance(parsed, Literal):
+        return {_key(parsed.value)}
+    if isinstance(parsed, Program):
+        return {
+            _key(arg.value) for step in parsed.steps for arg in step.args
+            if isinstance(arg, Literal)
+        }
+    return set()
+
+def _referenced_numbers(answers):
+    # The numbers in earlier answers, which were most likely retrieved
+    # from the context. Small numbers (e.g. 2 or 100) are too common to
+    # be informative
+    numbers = set().union(*(literal_numbers(answer) for answer in answers))
+    return {number for number in numbers if abs(number) >= 10 or number != round(number)}
+
+def _key(value):
+    return round(value, 6)
@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+from client import Client
+from conversation_handler import ConversationHandler
+from _extra_typing import Entries, EntryKey
+
+class RunStore:
+    """An append-only record of the answered questions in a run.
+
+    Each answered question is written to a JSON Lines file as soon as
+    it completes, so a run can be resumed after a crash without losing
+    anything but the question in flight. Each line contains:
+        * `entry_id`: the key of the entry
+        * `question_number`: the index of the question in the entry
+        * `full_answer`: the raw response from the LLM
+        * `answer`: the extracted answer
+        * `exe_answer`: the executed answer
+        * `error`: the error message, or null if there was no error
+        * `elapsed`: the time taken to answer the question in seconds
+
+    Args:
+        file_path (str): The path to the JSON Lines file. It will be
+            created if it doesn't exist.
+        sync (bool): Whether to fsync after every record, so that
+            records also survive the machine crashing rather than just
+            the process.
+    """
+
+    def __init__(self, file_path: str, sync: bool = True):
+        self.file_path = file_path
+        self.sync = sync
+        self._lock = threading.Lock()
+
+    def append(
+        self,
+        entry_id: EntryKey,
+        question_number: int,
+        ch: ConversationHandler,
+        error: Optional[str],
+        elapsed: float,
+        answer_index: int = -1,
+    ):
+        """Record the latest answer in a conversation.
+
+        Args:
+            entry_id (EntryKey): The key of the entry being answered.
+            question_number (int): The index of the question answered.
+            ch (ConversationHandler): The conversation that the question
+                was just asked in.
+            error (Optional[str]): The error message returned by the
+                conversation handler, if any.
+            elapsed (float): The time taken to answer the question.
+            answer_index (int): The index of the answer in the
+                conversation, if it isn't the latest one, e.g. when
+                several questions were answered at once.
+        """
+        record = {
+            "entry_id": entry_id,
+            "question_number": question_number,
+            "full_answer": ch.full_answers[answer_index],
+            "answer": ch.answers[answer_index],
+            "exe_answer": ch.exe_answers[answer_index],
+            "error": error,
+            "elapsed": elapsed,
+        }
+        line = (json.dumps(record) + "\n").encode()
+        with self._lock:
+            with open(self.file_path, "ab+") as out:
+                # If a previous run crashed part way through writing a
+                # line, start a new line so this record isn't lost
+                out.seek(0, os.SEEK_END)
+                if out.tell() > 0:
+                    out.seek(-1, os.SEEK_END)
+                    if out.read(1) != b"\n":
+                        line = b"\n" + line
+                out.write(line)
+                out.flush()
+                if self.sync:
+                    os.fsync(out.fileno())
+
+    def load(self) -> Dict[EntryKey, List[Dict[str, Any]]]:
+        """Load the records for each entry.
+
+        Only the records for the questions answered in order from the
+        first question are kept for each entry, so that each entry can
+        be resumed from its next unanswered question. A partially
+        written final line from a crash is ignored.
+
+        Returns:
+            records (Dict[EntryKey, List[Dict[str, Any]]]): The records
+                for each entry in the order that the entries were first
+                seen, indexed by question number.
+        """
+        by_entry = {}
+        if not os.path.exists(self.file_path):
+            return by_entry
+        with open(self.file_path) as in_file:
+            for line in in_file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                questions = by_entry.setdefault(record["entry_id"], {})
+                questions.setdefault(record["question_number"], record)
+
+        records = {}
+        for entry_id, questions in by_entry.items():
+            records[entry_id] = []
+            while len(records[entry_id]) in questions:
+                records[entry_id].append(questions[len(records[entry_id])])
+        return records
+
+    def conversations(
+        self,
+        entries: Entries,
+        client: Optional[Client] = None,
+    ) -> Dict[EntryKey, ConversationHandler]:
+        """Rebuild the conversation handlers from the stored records.
+
+        The raw answers are replayed through each handler, so the
+        extracted and executed answers reflect the current answer
+        processing code.
+
+        Args:
+            entries (Entries): The entries that were run, used for their
+                contexts and questions.
+            client (Optional[Client]): The client to give each handler,
+                if the conversations are to be continued.
+
+        Returns:
+            conversations (Dict[EntryKey, ConversationHandler]): The
+                conversation handler for each entry in the store, in the
+                same order as `entries`.
+        """
+        records = self.load()
+        conversations = {}
+        for entry_id in entries:
+            if entry_id in records:
+                conversations[entry_id] = replay_conversation(
+                    entries[entry_id], records[entry_id], client
+                )
+        return conversations
+
+
+def replay_conversation(
+    entry, records, client=None, context=None, retriever=None, history_window=None
+):
+    # The context defaults to the entry's, but may have been encoded
+    ch = ConversationHandler(
+        client, entry.context if context is None else context, retriever,
+        history_window,
+    )
+    for record, question in zip(records, entry.questions):
+        ch.replay(question, record["full_answer"])
+    return ch
@@ -0,0 +1,307 @@
+import asyncio
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import metrics
+from client import Client, agenerate
+from _extra_typing import Conversation
+
+# Status codes worth retrying: rate limiting and server-side errors
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """A thread-safe token bucket that refills continuously.
+
+    Args:
+        per_minute (float): The number of tokens added to the bucket
+            each minute.
+        capacity (Optional[float]): The maximum number of tokens that
+            the bucket can hold. Defaults to `per_minute`, allowing a
+            full minute's worth of burst.
+    """
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60
+        self.capacity = per_minute if capacity is None else capacity
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+        self._async_lock = None
+        self._async_lock_loop = None
+
+    def acquire(self, amount: float = 1) -> float:
+        """Take tokens from the bucket, waiting until enough are available.
+
+        Requests for more than the capacity of the bucket are capped at
+        the capacity, so they wait for a full bucket rather than
+        forever.
+
+        Args:
+            amount (float): The number of tokens to take.
+
+        Returns:
+            waited (float): The number of seconds spent waiting.
+        """
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            delay = self._take(amount)
+            if delay is None:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    async def aacquire(self, amount: float = 1) -> float:
+        """Take tokens from the bucket in the same way as `acquire`, but
+        wait with `asyncio.sleep` rather than blocking a thread.
+
+        Tasks in the same event loop wait in turn, in the order they
+        started waiting.
+        """
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        async with self._get_async_lock():
+            while True:
+                delay = self._take(amount)
+                if delay is None:
+                    return waited
+                await asyncio.sleep(delay)
+                waited += delay
+
+    def _take(self, amount):
+        # Take the tokens if there are enough, or return the time until
+        # there will be
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return None
+            return (amount - self._tokens) / self.rate
+
+    def _get_async_lock(self):
+        # An asyncio lock can only be used in the event loop it was first
+        # used in
+        loop = asyncio.get_running_loop()
+        if self._async_lock_loop is not loop:
+            self._async_lock = asyncio.Lock()
+            self._async_lock_loop = loop
+        return self._async_lock
+
+    def drain(self):
+        """Empty the bucket, e.g. after the server reports a rate limit."""
+        with self._lock:
+            self._tokens = 0
+            self._last = time.monotonic()
+
+
+class ScheduledClient:
+    """A rate-limited, retrying wrapper around a client.
+
+    Requests are throttled by a requests-per-minute and/or a
+    tokens-per-minute bucket before they are sent. If a request fails
+    with a rate limit (429) or server (5xx) error it is retried after
+    an exponential backoff with full jitter, or after the server's
+    Retry-After time if one is given. While one request is backing off
+    after a rate limit, all other requests sharing the scheduler are
+    paused too, so a run settles at the highest rate the server allows
+    instead of failing the conversation in flight.
+
+    This can be used anywhere a `Client` is expected.
+
+    Args:
+        client (Client): The client used to send requests.
+        requests_per_minute (Optional[float]): The maximum number of
+            requests to send per minute, or None for no limit.
+        tokens_per_minute (Optional[float]): The maximum number of
+            tokens (prompt plus completion budget) to send per minute,
+            or None for no limit.
+        max_retries (int): The maximum number of times to retry a
+            failed request before raising the error.
+        base_delay (float): The backoff in seconds before the first
+            retry. This doubles on each subsequent retry.
+        max_delay (float): The maximum backoff in seconds.
+
+    Attributes:
+        client (Client): The client used to send requests.
+        request_bucket (Optional[TokenBucket]): The requests-per-minute
+            limiter.
+        token_bucket (Optional[TokenBucket]): The tokens-per-minute
+            limiter.
+        retries (int): The total number of retries so far.
+    """
+
+    def __init__(
+        self,
+        client: Client,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_retries: int = 8,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ):
+        self.client = client
+        self.request_bucket = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.token_bucket = (
+            TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        )
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def generate(self, messages: Conversation, max_tokens: int = 500) -> str:
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            self._wait_for_capacity(messages, max_tokens)
+            metrics.add(queue_wait=time.perf_counter() - start)
+            try:
+                return self.client.generate(messages, max_tokens=max_tokens)
+            except Exception as e:
+                status = get_status_code(e)
+                if status not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                if status == 429:
+                    self._pause(delay)
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                metrics.add(retries=1)
+                time.sleep(delay)
+
+    async def agenerate(self, messages: Conversation, max_tokens: int = 500) -> str:
+        """Generate a response asynchronously, with the same rate limits
+        and retries as `generate`.
+        """
+        attempt = 0
+        while True:
+            await self._await_capacity(messages, max_tokens)
+            try:
+                return await agenerate(self.client, messages, max_tokens=max_tokens)
+            except Exception as e:
+                status = get_status_code(e)
+                if status not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                if status == 429:
+                    self._pause(delay)
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                metrics.add(retries=1)
+                await asyncio.sleep(delay)
+
+    async def aclose(self):
+        aclose = getattr(self.client, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+    async def __aenter__(self) -> "ScheduledClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def _await_capacity(self, messages, max_tokens):
+        start = time.perf_counter()
+        while True:
+            with self._lock:
+                pause = self._paused_until - time.monotonic()
+            if pause <= 0:
+                break
+            await asyncio.sleep(pause)
+        if self.request_bucket is not None:
+            await self.request_bucket.aacquire(1)
+        if self.token_bucket is not None:
+            await self.token_bucket.aacquire(estimate_tokens(messages) + max_tokens)
+        metrics.add(queue_wait=time.perf_counter() - start)
+
+    def _wait_for_capacity(self, messages, max_tokens):
+        while True:
+            with self._lock:
+                pause = self._paused_until - time.monotonic()
+            if pause <= 0:
+                break
+            time.sleep(pause)
+        if self.request_bucket is not None:
+            self.request_bucket.acquire(1)
+        if self.token_bucket is not None:
+            self.token_bucket.acquire(estimate_tokens(messages) + max_tokens)
+
+    def _backoff(self, attempt, error):
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            # A small amount of jitter stops every waiting worker from
+            # retrying at exactly the same moment
+            return retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _pause(self, delay):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        for bucket in (self.request_bucket, self.token_bucket):
+            if bucket is not None:
+                bucket.drain()
+
+
+def estimate_tokens(messages: Conversation) -> int:
+    """Roughly estimate the number of tokens in a list of messages.
+
+    Uses the common rule of thumb of four characters per token, which
+    is close enough for rate limiting without needing a tokenizer.
+    """
+    return sum(len(message["content"]) for message in messages) // 4
+
+def get_status_code(error: Exception) -> Optional[int]:
+    """Get the HTTP status code from an error raised by a client, if any."""
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is not None:
+        return status
+    # aiohttp's ClientResponseError and urllib's HTTPError, e.g. from an
+    # OpenAI-compatible backend
+    for attribute in ("status", "code"):
+        code = getattr(error, attribute, None)
+        if isinstance(code, int) and 100 <= code < 600:
+            return code
+    # Fall back to the message, e.g. "429 Client Error: Too Many Requests"
+    match = re.search(r"\b([45]\d\d) (?:Client|Server) Error", str(error))
+    if match:
+        return int(match.group(1))
+    return None
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Get the Retry-After time in seconds from an error, if any.
+
+    The header can either be a number of seconds or an HTTP date.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
@@ -1,7 +1,15 @@
-from typing import Optional
+import asyncio
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from typing import Callable, Optional
 
+import metrics
 from conversation_handler import ConversationHandler
 from client import Client
+from evaluation import answer_matches
+from progress import ProgressReporter
+from retrieval import ContextRetriever
+from run_store import RunStore, replay_conversation
 from _extra_typing import Entries, EntryKeyCollection
 
 class Tester:
@@ -13,6 +21,25 @@ class Tester:
         entries (Entries): A collection of entries to be tested, with a
             unique key for each that can be used access a specific
             entry.
+        context_encoder (Optional[Callable[[str], str]]): A function
+            applied to each entry's context before it is sent to the
+            LLM, e.g. `context_encoder.encode_context` to send fewer
+            tokens.
+        retriever (Optional[Callable[[str], ContextRetriever]]): A
+            function that builds a retriever for each entry's context,
+            e.g. `ContextRetriever` or `functools.partial(
+            ContextRetriever, k=2)`, so that each question is sent with
+            only the relevant parts of the context.
+        history_window (Optional[int]): The number of most recent
+            questions and answers to send in full, with earlier ones
+            summarised in a ledger. See `ConversationHandler`.
+        batch (bool): Whether to ask all of an entry's questions in a
+            single request, using `ConversationHandler.ask_all`, rather
+            than one request per question. Questions whose answers
+            can't be used are asked again on their own.
+        progress (Optional[ProgressReporter]): A reporter for the
+            progress of each run. Defaults to one that draws a progress
+            line on stdout.
 
     Attributes:
         client (Client): A client that handles sending and
@@ -24,12 +51,31 @@ class Tester:
             conversation handler for each entry, indexed by the entry's
             unique key.
     """
-    def __init__(self, client: Client, entries: Entries):
+    def __init__(
+        self,
+        client: Client,
+        entries: Entries,
+        context_encoder: Optional[Callable[[str], str]] = None,
+        retriever: Optional[Callable[[str], ContextRetriever]] = None,
+        history_window: Optional[int] = None,
+        batch: bool = False,
+        progress: Optional[ProgressReporter] = None,
+    ):
         self.client = client
         self.entries = entries
+        self.context_encoder = context_encoder
+        self.retriever = retriever
+        self.history_window = history_window
+        self.batch = batch
+        self.progress = progress if progress is not None else ProgressReporter()
         self.conversations = {}
 
-    def run(self, indices: Optional[EntryKeyCollection] = None):
+    def run(
+        self,
+        indices: Optional[EntryKeyCollection] = None,
+        max_workers: int = 1,
+        store: Optional[RunStore] = None,
+    ):
         """Generate responses for each entry specified.
         
         Will run through each key provided to access the correct entry
@@ -38,33 +84,233 @@ class Tester:
         initialisation, and attempt to answer each question.
         The results will be stored in the `conversations` attribute.
 
+        Entries are independent of each other, so up to `max_workers`
+        of them can be run at the same time. Questions within an entry
+        are always asked in order, and the conversations are added to
+        the `conversations` attribute in the order of `indices`,
+        regardless of the order in which they finish.
+
+        If a run store is given, each answered question is appended to
+        it as soon as it completes. Any questions already in the store
+        are replayed rather than asked again, so an interrupted run can
+        be resumed by calling `run` again with the same store.
+
+        Args:
+            indices (Optional[EntryKeyCollection]): An iterable
+                containing keys of the entries that you would like to
+                generate responses for.
+            max_workers (int): The maximum number of entries to run
+                concurrently. The default of 1 runs the entries one
+                after the other.
+            store (Optional[RunStore]): A run store to resume from and
+                record answers to.
+        """
+        if indices is None:
+            indices = list(self.entries.keys())
+        indices = list(indices)
+
+        records = store.load() if store is not None else {}
+
+        self._start_progress(indices, records)
+        try:
+            if max_workers <= 1:
+                for entry_id in indices:
+                    ch = self._new_conversation(entry_id, records)
+                    self.conversations[entry_id] = ch
+                    self._run_entry(ch, entry_id, store)
+            else:
+                self._run_concurrently(indices, max_workers, store, records)
+        finally:
+            self.progress.finish()
+
+    def _run_concurrently(self, indices, max_workers, store, records):
+        def run_entry(entry_id):
+            ch = self._new_conversation(entry_id, records)
+            self._run_entry(ch, entry_id, store)
+            return ch
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = [executor.submit(run_entry, entry_id) for entry_id in indices]
+        try:
+            # Stop waiting as soon as an entry fails
+            wait(futures, return_when=FIRST_EXCEPTION)
+            for future in futures:
+                if future.done():
+                    future.result()
+        except BaseException:
+            # Don't start any more entries if one of them failed (e.g.
+            # the client raised), but let the ones in flight finish
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        finally:
+            executor.shutdown(wait=True)
+            # Keep every entry that finished, even if another failed, in
+            # the order of the indices rather than the order they
+            # finished in
+            for entry_id, future in zip(indices, futures):
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    self.conversations[entry_id] = future.result()
+
+    def _new_conversation(self, entry_id, records):
+        entry = self.entries[entry_id]
+        context = entry.context
+        if self.context_encoder is not None:
+            context = self.context_encoder(context)
+        retriever = self.retriever(context) if self.retriever is not None else None
+        if entry_id in records:
+            return replay_conversation(
+                entry, records[entry_id], self.client, context, retriever,
+                self.history_window,
+            )
+        return ConversationHandler(self.client, context, retriever, self.history_window)
+
+    def _start_progress(self, indices, records):
+        # Questions replayed from the run store aren't counted
+        questions = sum(
+            max(0, len(self.entries[i].questions) - len(records.get(i, ())))
+            for i in indices
+        )
+        self.progress.start(len(indices), questions)
+
+    def _run_entry(self, ch, entry_id, store):
+        entry = self.entries[entry_id]
+        if self.batch:
+            # Skip any questions replayed from the run store
+            first = ch.question_count
+            questions = entry.questions[first:]
+            if questions:
+                start = time.perf_counter()
+                with metrics.labels(entry_id=entry_id, question_number=first):
+                    results = ch.ask_all(questions)
+                self._record_batch(store, entry_id, ch, first, results, time.perf_counter() - start)
+        else:
+            for question_number, question in enumerate(entry.questions):
+                # Skip any questions replayed from the run store
+                if question_number < ch.question_count:
+                    continue
+                start = time.perf_counter()
+                with metrics.labels(entry_id=entry_id, question_number=question_number):
+                    _, err = ch.ask(question)
+                self._record(store, entry_id, question_number, ch, err, time.perf_counter() - start)
+        self.progress.entry_done()
+
+    async def arun(
+        self,
+        indices: Optional[EntryKeyCollection] = None,
+        max_concurrency: int = 100,
+        store: Optional[RunStore] = None,
+    ):
+        """Generate responses for each entry specified asynchronously.
+
+        Works in the same way as `run`, but the entries are run as tasks
+        in the event loop rather than in threads, so that many more of
+        them can be in flight at once. Clients with an `agenerate` method
+        (e.g. `Client`) are called asynchronously, and any others are
+        run in a thread. The client isn't closed afterwards, so that its
+        session can be reused by later runs. For example:
+            async def main():
+                async with Client(model, token) as client:
+                    await Tester(client, entries).arun(max_concurrency=200)
+            asyncio.run(main())
+
         Args:
             indices (Optional[EntryKeyCollection]): An iterable
                 containing keys of the entries that you would like to
                 generate responses for.
+            max_concurrency (int): The maximum number of entries to run
+                at once.
+            store (Optional[RunStore]): A run store to resume from and
+                record answers to.
         """
         if indices is None:
             indices = list(self.entries.keys())
+        indices = list(indices)
 
-        for entry_number, entry_id in enumerate(indices):
-            entry = self.entries[entry_id]
-            ch = ConversationHandler(self.client, entry.context)
-            self.conversations[entry_id] = ch
+        records = store.load() if store is not None else {}
+        semaphore = asyncio.Semaphore(max_concurrency)
+        failed = False
+
+        async def run_entry(entry_id):
+            async with semaphore:
+                # Don't start any more entries if one of them failed
+                if failed:
+                    return None
+                ch = self._new_conversation(entry_id, records)
+                await self._arun_entry(ch, entry_id, store)
+                return ch
+
+        self._start_progress(indices, records)
+        tasks = [asyncio.ensure_future(run_entry(entry_id)) for entry_id in indices]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Let the entries in flight finish
+            failed = True
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            self.progress.finish()
+            # Keep every entry that finished, even if another failed, in
+            # the order of the indices
+            for entry_id, task in zip(indices, tasks):
+                if task.done() and not task.cancelled() and task.exception() is None:
+                    ch = task.result()
+                    if ch is not None:
+                        self.conversations[entry_id] = ch
+
+    async def _arun_entry(self, ch, entry_id, store):
+        entry = self.entries[entry_id]
+        if self.batch:
+            first = ch.question_count
+            questions = entry.questions[first:]
+            if questions:
+                start = time.perf_counter()
+                with metrics.labels(entry_id=entry_id, question_number=first):
+                    results = await ch.aask_all(questions)
+                await asyncio.to_thread(
+                    self._record_batch, store, entry_id, ch, first, results,
+                    time.perf_counter() - start,
+                )
+        else:
             for question_number, question in enumerate(entry.questions):
-                print(
-                    (
-                        f"Processing Entry {entry_number+1}/{len(indices)} "
-                        f"(id: {entry_id}) - "
-                        f"Question {question_number+1}/{len(entry.questions)}"
-                        "                 "
-                    ),
-                    end="\r",
+                if question_number < ch.question_count:
+                    continue
+                start = time.perf_counter()
+                with metrics.labels(entry_id=entry_id, question_number=question_number):
+                    _, err = await ch.aask(question)
+                # Writing to the store may wait for the disk, so don't hold
+                # up the event loop
+                await asyncio.to_thread(
+                    self._record, store, entry_id, question_number, ch, err,
+                    time.perf_counter() - start,
                 )
-                _, err = ch.ask(question)
-                if err is not None:
-                    print(
-                        f"Found an error processing entry {entry_id}, "
-                        f"question {question_number+1}. "
-                        "Skipping to the next one..."
-                    )
-        print(f"Done                                                    ")
+        self.progress.entry_done()
+
+    def _record(self, store, entry_id, question_number, ch, err, elapsed, answer_index=-1):
+        if store is not None:
+            store.append(
+                entry_id, question_number, ch, err, elapsed,
+                answer_index=answer_index,
+            )
+        if err is not None:
+            self.progress.log(
+                f"Found an error processing entry {entry_id}, "
+                f"question {question_number+1}. "
+                "Skipping to the next one..."
+            )
+        # Entries without expected answers, e.g. from a test set, aren't
+        # counted towards the accuracy
+        entry = self.entries[entry_id]
+        correct = None
+        if question_number in entry.text_answers or question_number < len(entry.exe_answers):
+            correct = answer_matches(
+                entry.exe_answer(question_number),
+                ch.exe_answers[answer_index],
+            )
+        self.progress.question_done(elapsed, err, correct)
+
+    def _record_batch(self, store, entry_id, ch, first, results, elapsed):
+        # The time taken is shared between the questions answered
+        elapsed /= len(results)
+        for i, (_, err) in enumerate(results):
+            self._record(store, entry_id, first + i, ch, err, elapsed, answer_index=first + i)
@@ -1,22 +1,58 @@
 import math
 import numbers
-from typing import List
+from functools import lru_cache
+from typing import List, NamedTuple, Tuple, Union
 
 from _consts import OP_MAP
 
+# The maximum number of distinct answers to keep parsed programs for
+PROGRAM_CACHE_SIZE = 2 ** 16
+
+class Literal(NamedTuple):
+    """A number written in an answer, e.g. 12, $1,000 or 9.11%."""
+    value: float
+
+class Ref(NamedTuple):
+    """A reference to a previous answer, e.g. ANS2."""
+    index: int
+
+class StepRef(NamedTuple):
+    """A reference to an earlier step in the same program, e.g. #0."""
+    index: int
+
+class Step(NamedTuple):
+    """An operation with two arguments, e.g. subtract(ANS0, 40987)."""
+    op: str
+    args: Tuple[Union[Literal, Ref, StepRef], Union[Literal, Ref, StepRef]]
+
+class Program(NamedTuple):
+    """A flat list of steps, separated by ";" in an answer.
+
+    Each step can refer to the results of the steps before it, e.g.
+        add(35, 33);divide(#0, 2)
+    and the result of the program is the result of its last step.
+    """
+    steps: Tuple[Step, ...]
+
 def is_operation(answer):
     return "(" in answer
 
 def equivalent_operation(program1, program2, exe_answers, rel_tol, abs_tol):
     try:
-        op_1, arg1_1, arg2_1 = split_operation(program1)
-        op_2, arg1_2, arg2_2 = split_operation(program2)
-        arg1_1 = process_arg(arg1_1, exe_answers)
-        arg2_1 = process_arg(arg2_1, exe_answers)
-        arg1_2 = process_arg(arg1_2, exe_answers)
-        arg2_2 = process_arg(arg2_2, exe_answers)
+        steps_1 = _resolve_steps(program1, exe_answers)
+        steps_2 = _resolve_steps(program2, exe_answers)
     except Exception as e:
         return False
+    if len(steps_1) != len(steps_2):
+        return False
+    return all(
+        _equivalent_step(step_1, step_2, rel_tol, abs_tol)
+        for step_1, step_2 in zip(steps_1, steps_2)
+    )
+
+def _equivalent_step(step_1, step_2, rel_tol, abs_tol):
+    op_1, (arg1_1, arg2_1) = step_1
+    op_2, (arg1_2, arg2_2) = step_2
     if op_1 != op_2:
         return False
     if op_1 in ["subtract", "divide", "exp", "greater"]:
@@ -24,27 +60,57 @@ def equivalent_operation(program1, program2, exe_answers, rel_tol, abs_tol):
     elif op_1 in ["add", "multiply"]:
         return (
             (equivalent_val(arg1_1, arg1_2, rel_tol, abs_tol) and equivalent_val(arg2_1, arg2_2, rel_tol, abs_tol))
-            or (equivalent_val(arg1_1, arg2_2, rel_tol, abs_tol) and equivalent_val(arg1_1, arg2_2, rel_tol, abs_tol))
+            or (equivalent_val(arg1_1, arg2_2, rel_tol, abs_tol) and equivalent_val(arg2_1, arg1_2, rel_tol, abs_tol))
         )
     else:
         raise AssertionError("should be unreachable")
 
 def backward_subtraction(program1, program2, exe_answers, rel_tol, abs_tol):
+    """Check whether program2 is program1 with its subtractions reversed.
+
+    For multi-step programs, every subtraction step must have its
+    arguments reversed and every other step must be equivalent.
+    """
     try:
-        op_1, arg1_1, arg2_1 = split_operation(program1)
-        op_2, arg1_2, arg2_2 = split_operation(program2)
-        arg1_1 = process_arg(arg1_1, exe_answers)
-        arg2_1 = process_arg(arg2_1, exe_answers)
-        arg1_2 = process_arg(arg1_2, exe_answers)
-        arg2_2 = process_arg(arg2_2, exe_answers)
+        steps_1 = _resolve_steps(program1, exe_answers)
+        steps_2 = _resolve_steps(program2, exe_answers)
     except Exception as e:
         return False
-    if op_1 != op_2:
+    if len(steps_1) != len(steps_2):
         return False
-    if op_1 == "subtract":
-        return equivalent_val(arg1_1, arg2_2, rel_tol, abs_tol) and equivalent_val(arg2_1, arg1_2, rel_tol, abs_tol)
-    else:
+    if all(op != "subtract" for op, _ in steps_1):
         raise AssertionError("should be unreachable")
+    for step_1, step_2 in zip(steps_1, steps_2):
+        op_1, (arg1_1, arg2_1) = step_1
+        op_2, (arg1_2, arg2_2) = step_2
+        if op_1 != op_2:
+            return False
+        if op_1 == "subtract":
+            if not (
+                equivalent_val(arg1_1, arg2_2, rel_tol, abs_tol)
+                and equivalent_val(arg2_1, arg1_2, rel_tol, abs_tol)
+            ):
+                return False
+        elif not _equivalent_step(step_1, step_2, rel_tol, abs_tol):
+            return False
+    return True
+
+def _resolve_steps(answer, exe_answers):
+    # References to other answers are resolved to their values, but
+    # references to earlier steps are left as they are, so that steps
+    # are compared structurally rather than by their (possibly wrong)
+    # intermediate results
+    program = parse_answer(answer)
+    if not isinstance(program, Program):
+        raise FormatException(f"Expected an operation but got {answer}")
+    steps = []
+    for op, args in program.steps:
+        args = [
+            arg if isinstance(arg, StepRef) else evaluate_arg(arg, exe_answers)
+            for arg in args
+        ]
+        steps.append((op, args))
+    return steps
 
 def equivalent_val(expected, got, rel_tol=0.01, abs_tol=0):
     if isinstance(expected, numbers.Number) and isinstance(got, numbers.Number):
@@ -66,7 +132,7 @@ def extract_raw_answer(answer: str) -> str:
 
 def execute_answer(answer: str, exe_answers: List[float]) -> float:
     """Execute the operation in the answer.
-    
+
     The answer from the LLM should either be a float already that
     was extracted from the context, or an operation with two args.
     We first try to convert the answer to a float, and if not, we
@@ -77,23 +143,67 @@ def execute_answer(answer: str, exe_answers: List[float]) -> float:
         operation(arg1, arg2)
     so this method will check that "(", ")" and "," characters are
     present, and process the arguments to get the final answer.
+    Several operations can be chained with ";", where "#k" refers to
+    the result of the k-th operation, e.g.
+        add(35, 33);divide(#0, 2)
+    """
+    program = parse_answer(answer)
+    if not isinstance(program, Program):
+        return evaluate_arg(program, exe_answers)
+    return execute_program(program, exe_answers)
+
+def execute_program(program: Program, exe_answers: List[float]) -> float:
+    """Execute each step of a parsed program in order."""
+    results = []
+    for op, args in program.steps:
+        arg1, arg2 = (
+            results[arg.index] if isinstance(arg, StepRef) else evaluate_arg(arg, exe_answers)
+            for arg in args
+        )
+        try:
+            results.append(OP_MAP[op](arg1, arg2))
+        except Exception as e:
+            raise OperationException(
+                f"Error handling the operation of {op}({arg1}, {arg2}): {e}"
+            )
+    return results[-1]
+
+def parse_answer(answer: str) -> Union[Literal, Ref, Program]:
+    """Parse an answer into a number, reference or program.
+
+    Parsing only depends on the answer string, so parsed answers are
+    cached and the same answer is only ever parsed once, however many
+    times it is executed or compared. The same exceptions are raised as
+    when executing an answer that can't be parsed.
     """
+    parsed = _parse_answer(answer)
+    if isinstance(parsed, _ParseError):
+        raise parsed.exception_type(parsed.message)
+    return parsed
+
+def clear_program_cache():
+    _parse_answer.cache_clear()
+
+class _ParseError(NamedTuple):
+    exception_type: type
+    message: str
+
+@lru_cache(maxsize=PROGRAM_CACHE_SIZE)
+def _parse_answer(answer):
+    # Errors are returned rather than raised so that they are cached too
     try:
-        return process_arg(answer, exe_answers)
+        return parse_arg(answer)
     except ArgumentException:
         pass
-
-    op, arg1, arg2 = split_operation(answer)
-    arg1, arg2 = process_arg(arg1, exe_answers), process_arg(arg2, exe_answers)
-
     try:
-        exe_answer = OP_MAP[op](arg1, arg2)
-    except Exception as e:
-        raise OperationException(
-            f"Error handling the operation of {op}({arg1}, {arg2}): {e}"
-        )
-
-    return exe_answer
+        steps = []
+        for step in answer.split(";"):
+            op, arg1, arg2 = split_operation(step.strip())
+            args = (parse_arg(arg1, len(steps)), parse_arg(arg2, len(steps)))
+            steps.append(Step(op, args))
+        return Program(tuple(steps))
+    except AnswerException as e:
+        return _ParseError(type(e), e.message)
 
 def split_operation(answer: str):
     if "(" not in answer:
@@ -125,41 +235,70 @@ def split_operation(answer: str):
         raise FormatException(
             "Non-float answer should be an operation but found no \",\""
         )
-    arg1, arg2 = args.split(",")
+    args = args.split(",")
+    if len(args) != 2:
+        raise FormatException(
+            f"Operation should have two arguments, but got {len(args)}"
+        )
+    arg1, arg2 = args
     return op, arg1, arg2
 
-def process_arg(arg: str, exe_answers: List[float]):
-    """Process the provided argument.
+def parse_arg(arg: str, step_count: int = 0) -> Union[Literal, Ref, StepRef]:
+    """Parse the provided argument.
 
     First remove all spaces, and then check if the argument is a
     reference to another answer (in which case, it starts with
-    "ANS"), or is a numerical value. If it is a percentage, we
-    have to also divide by 100.
+    "ANS"), a reference to one of the `step_count` earlier steps in the
+    same program (in which case, it starts with "#"), or is a numerical
+    value. If it is a percentage, we have to also divide by 100.
     """
     arg = arg.replace(" ", "")
     try:
         if arg.startswith("ANS"):
-            answer_index = int(arg[3:])
-            processed_arg = exe_answers[answer_index]
-            if math.isnan(processed_arg):
-                raise ArgumentException(
-                    "Operation requires use of nan value"
-                )
-        else:
-            arg = arg.replace(",", "")
-            arg = arg.replace("$", "")
-            if arg.endswith("%"):
-                processed_arg = float(arg[:-1]) / 100
-            else:
-                processed_arg = float(arg)
-    except ArgumentException as e:
-        raise e
+            return Ref(int(arg[3:]))
+        if arg.startswith("#"):
+            step_index = int(arg[1:])
+            if not 0 <= step_index < step_count:
+                raise ValueError("it should refer to an earlier step")
+            return StepRef(step_index)
+        arg = arg.replace(",", "")
+        arg = arg.replace("$", "")
+        if arg.endswith("%"):
+            return Literal(float(arg[:-1]) / 100)
+        return Literal(float(arg))
     except Exception as e:
         raise ArgumentException(
             f"Error processing the argument \"{arg}\": {e}"
         )
+
+def evaluate_arg(arg: Union[Literal, Ref], exe_answers: List[float]):
+    """Get the value of a parsed argument.
+
+    References are looked up in the executed answers so far, and must
+    not refer to an answer that couldn't be executed.
+    """
+    if isinstance(arg, Literal):
+        return arg.value
+    try:
+        processed_arg = exe_answers[arg.index]
+        is_nan = math.isnan(processed_arg)
+    except Exception as e:
+        raise ArgumentException(
+            f"Error processing the argument \"ANS{arg.index}\": {e}"
+        )
+    if is_nan:
+        raise ArgumentException(
+            "Operation requires use of nan value"
+        )
     return processed_arg
-    
+
+def process_arg(arg: str, exe_answers: List[float]):
+    """Process the provided argument.
+
+    Equivalent to parsing the argument and then evaluating it.
+    """
+    return evaluate_arg(parse_arg(arg), exe_answers)
+
 
 class AnswerException(Exception):
     def __init__(self, message):
@@ -176,4 +315,4 @@ class OperationException(AnswerException):
 
 class ArgumentException(AnswerException):
     def __init__(self, message):
-        super().__init__(message)
\ No newline at end of file
+        super().__init__(message)
@@ -0,0 +1,85 @@
+import os
+import pickle
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from analyser import Analyser
+from conversation_handler import ConversationHandler
+from data import load_data
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), "..", "data", "processed", "train3.json")
+
+REL_TOLS = [0.0, 1e-4, 1e-3, 0.01, 0.05]
+ABS_TOLS = [0.0, 0.5]
+
+@pytest.fixture
+def analyser(tmp_path):
+    entries = load_data(DATA_PATH)
+    conversations = {}
+    for key, entry in entries.items():
+        ch = ConversationHandler(None, entry.context)
+        for i, (question, answer) in enumerate(zip(entry.questions, entry.exe_answers)):
+            # Answers that are off by varying amounts, so that the
+            # accuracy changes across the tolerances
+            ch.replay(question, f"ANS{i} = {answer * (1 + 0.002 * (i + key % 5))}")
+        conversations[key] = ch
+    path = tmp_path / "run.pickle"
+    with open(path, "wb") as out:
+        pickle.dump(conversations, out)
+    return Analyser(entries, pickle_file_path=str(path))
+
+
+def test_sweep_matches_computational_accuracy(analyser):
+    sweep = analyser.computational_accuracy_sweep(REL_TOLS, ABS_TOLS)
+    for abs_tol in ABS_TOLS:
+        for rel_tol in REL_TOLS:
+            assert sweep.accuracy(rel_tol, abs_tol) == analyser.computational_accuracy(
+                rel_tol=rel_tol, abs_tol=abs_tol
+            )
+
+def test_sweep_by_question_number_matches(analyser):
+    sweep = analyser.computational_accuracy_sweep_by_question_number(REL_TOLS, ABS_TOLS)
+    for abs_tol in ABS_TOLS:
+        for rel_tol in REL_TOLS:
+            expected = analyser.computational_accuracy_by_question_number(
+                rel_tol=rel_tol, abs_tol=abs_tol
+            )
+            assert sweep.groups == list(range(len(expected)))
+            for question_number, accuracy in enumerate(expected):
+                assert sweep.accuracy(rel_tol, abs_tol, question_number) == accuracy
+
+def test_sweep_by_operation_matches(analyser):
+    sweep = analyser.computational_accuracy_sweep_by_operation(REL_TOLS, ABS_TOLS)
+    for abs_tol in ABS_TOLS:
+        for rel_tol in REL_TOLS:
+            expected = analyser.computational_accuracy_by_operation(
+                rel_tol=rel_tol, abs_tol=abs_tol
+            )
+            for op, accuracy in expected.items():
+                assert sweep.accuracy(rel_tol, abs_tol, op) == accuracy
+
+def test_cache_notices_changed_conversations(analyser):
+    key = next(iter(analyser.conversations))
+    entry = analyser.entries[key]
+    before = analyser.computational_accuracy()
+
+    correct = ConversationHandler(None, entry.context)
+    for i, (question, answer) in enumerate(zip(entry.questions, entry.exe_answers)):
+        correct.replay(question, f"ANS{i} = {answer}")
+    analyser.conversations[key] = correct
+    replaced = analyser.computational_accuracy()
+    assert replaced.score > before.score
+
+    del analyser.conversations[key]
+    assert analyser.computational_accuracy().total == before.total - len(entry.questions)
+
+    # Asking more questions is noticed too
+    partial = ConversationHandler(None, entry.context)
+    analyser.conversations[key] = partial
+    analyser.computational_accuracy()
+    for i, (question, answer) in enumerate(zip(entry.questions, entry.exe_answers)):
+        partial.replay(question, f"ANS{i} = {answer}")
+    assert analyser.computational_accuracy() == replaced
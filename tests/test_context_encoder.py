@@ -0,0 +1,14 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from context_encoder import normalise
+
+def test_repeated_numbers_are_dropped():
+    assert normalise("fell by -9 ( 9 ) in 2008") == "fell by -9 in 2008"
+    assert normalise("a rise of 9% ( 9 % ) .") == "a rise of 9%."
+
+def test_different_numbers_in_brackets_are_kept():
+    assert normalise("-12.5 ( 3.2 )") == "-12.5 (3.2)"
+    assert normalise("10% ( 7 % )") == "10% (7%)"
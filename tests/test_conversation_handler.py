@@ -0,0 +1,96 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from conversation_handler import ConversationHandler
+from retrieval import ContextRetriever
+
+class ScriptedClient:
+    """A client that gives a prepared response to each request in turn,
+    and keeps the messages it was sent.
+    """
+
+    def __init__(self, responses):
+        self.responses = iter(responses)
+        self.requests = []
+
+    def generate(self, messages, max_tokens=500):
+        self.requests.append(messages)
+        return next(self.responses)
+
+
+def test_negative_history_window_is_rejected():
+    with pytest.raises(ValueError):
+        ConversationHandler(ScriptedClient([]), "context", history_window=-1)
+
+def test_history_window_of_zero_sends_only_the_ledger_and_question():
+    client = ScriptedClient(["ANS0 = 35", "ANS1 = subtract(ANS0, 2)"])
+    ch = ConversationHandler(client, "context", history_window=0)
+    ch.ask("what was the total in 2014?")
+    ch.ask("and the change?")
+
+    assert ch.exe_answers == [35.0, 33.0]
+    last = client.requests[-1]
+    assert last[-1]["role"] == "user"
+    assert "Earlier questions and answers:\nQ0: what was the total in 2014? ANS0 = 35.0" in last[-1]["content"]
+    assert "Q1: and the change?" in last[-1]["content"]
+    assert last[-2]["role"] == "assistant"
+
+def test_history_window_of_zero_in_a_resumed_batch():
+    client = ScriptedClient(["ANS1 = 33\nANS2 = subtract(ANS0, ANS1)"])
+    ch = ConversationHandler(client, "context", history_window=0)
+    # Resume from a stored run, then ask the rest in one batch
+    ch.replay("what was the total in 2014?", "ANS0 = 35")
+    results = ch.ask_all(["and in 2013?", "what was the change?"])
+
+    assert results == [(33.0, None), (2.0, None)]
+    messages = client.requests[0]
+    roles = [message["role"] for message in messages]
+    assert all(a != b for a, b in zip(roles, roles[1:]))
+    assert messages[-1]["content"].startswith(
+        "Earlier questions and answers:\nQ0: what was the total in 2014? ANS0 = 35.0\n"
+    )
+    assert "Q1: and in 2013?" in messages[-1]["content"]
+    assert "Q2: what was the change?" in messages[-1]["content"]
+
+def test_batch_leaves_the_retriever_as_replaying_does():
+    context = (
+        "Revenue in 2014 was 120 million. Revenue in 2013 was 100 million. "
+        "Costs in 2014 were 35 million. The office moved to Leeds."
+    )
+    questions = ["what was revenue in 2014?", "and after costs?", "and in 2013?"]
+    response = "ANS0 = 120\nANS1 = subtract(ANS0, 35)\nANS2 = 100"
+    ch = ConversationHandler(
+        ScriptedClient([response]), context, ContextRetriever(context, k=1)
+    )
+    ch.ask_all(questions)
+
+    replayed = ConversationHandler(None, context, ContextRetriever(context, k=1))
+    for question, answer in zip(questions, response.split("\n")):
+        replayed.replay(question, answer)
+
+    assert ch.exe_answers == replayed.exe_answers == [120.0, 85.0, 100.0]
+    assert ch.retriever.selected == replayed.retriever.selected
+    assert ch.retriever.fallbacks == replayed.retriever.fallbacks
+
+def test_only_the_stable_prefix_is_cacheable():
+    context = (
+        "Revenue in 2014 was 120 million. Costs in 2013 were 35 million. "
+        "The office moved to Leeds. Staff numbers grew to 900."
+    )
+    client = ScriptedClient(["ANS0 = 120"])
+    ch = ConversationHandler(client, context)
+    ch.ask("what was revenue in 2014?")
+    assert client.requests[0].cacheable == len(ch.prefix) + 2
+
+    # The retrieved context changes from question to question, so it
+    # comes after the cacheable prefix
+    client = ScriptedClient(["ANS0 = 120"])
+    ch = ConversationHandler(client, context, ContextRetriever(context, k=1))
+    ch.ask("what was revenue in 2014?")
+    messages = client.requests[0]
+    assert messages.cacheable == messages.shared == len(ch.prefix)
+    assert messages[messages.cacheable]["content"] == "Revenue in 2014 was 120 million."
@@ -0,0 +1,25 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import metrics
+
+def test_prometheus_sink_writes_counters_and_histograms(tmp_path):
+    path = tmp_path / "metrics.prom"
+    sink = metrics.PrometheusSink(str(path), interval=3600, buckets=(0.1, 1))
+    for latency in (0.05, 0.1, 0.5, 2.0):
+        sink.emit(metrics.CallRecord(metrics.ASK, latency=latency, prompt_tokens=10))
+    sink.emit(metrics.CallRecord(metrics.ASK, latency=0.5, error="FormatException"))
+    sink.close()
+
+    lines = set(path.read_text().splitlines())
+    assert 'convfinqa_calls_total{kind="ask"} 5' in lines
+    assert 'convfinqa_errors_total{kind="ask",error="FormatException"} 1' in lines
+    assert 'convfinqa_latency_seconds_bucket{kind="ask",le="0.1"} 2' in lines
+    assert 'convfinqa_latency_seconds_bucket{kind="ask",le="1"} 4' in lines
+    assert 'convfinqa_latency_seconds_bucket{kind="ask",le="+Inf"} 5' in lines
+    assert 'convfinqa_latency_seconds_sum{kind="ask"} 3.15' in lines
+    assert 'convfinqa_latency_seconds_count{kind="ask"} 5' in lines
+    assert 'convfinqa_queue_wait_seconds_bucket{kind="ask",le="0.1"} 5' in lines
+    assert 'convfinqa_prompt_tokens_total{kind="ask"} 40' in lines
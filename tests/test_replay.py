@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from conversation_handler import ConversationHandler
+from replay import ReplayClient
+
+class ScriptedClient:
+    """A client that gives a prepared response to each request in turn."""
+
+    def __init__(self, responses):
+        self.responses = iter(responses)
+
+    def generate(self, messages, max_tokens=500):
+        return next(self.responses)
+
+
+def test_replays_the_question_after_a_ledger():
+    questions = ["what was the total in 2014?", "and in 2013?", "what was the change?"]
+    answers = ["ANS0 = 35", "ANS1 = 33", "ANS2 = subtract(ANS0, ANS1)"]
+    recorded = ConversationHandler(ScriptedClient(answers), "context")
+    for question in questions:
+        recorded.ask(question)
+
+    # Earlier questions are sent in a ledger ahead of the one being asked
+    client = ReplayClient({"entry": recorded}, fallback="ANS{i} = 0")
+    ch = ConversationHandler(client, "context", history_window=0)
+    for question in questions:
+        ch.ask(question)
+
+    assert ch.full_answers == answers
+    assert client.replayed == 3
@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from data import load_data
+from progress import ProgressReporter
+import tester
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), "..", "data", "processed", "train3.json")
+
+class FailingClient:
+    """A client that answers every question with "ANS{i} = 0", except
+    for the questions about one context, which fail after a delay.
+    """
+
+    def __init__(self, failing_context):
+        self.failing_context = failing_context
+
+    def generate(self, messages, max_tokens=500):
+        if any(message["content"] == self.failing_context for message in messages):
+            time.sleep(0.2)
+            raise RuntimeError("boom")
+        return "ANS0 = 0"
+
+
+@pytest.mark.parametrize("max_workers", [1, 32])
+def test_finished_entries_are_kept_when_one_fails(max_workers):
+    entries = load_data(DATA_PATH)
+    keys = list(entries)
+    failing = keys[1]
+    with open(os.devnull, "w") as devnull:
+        runner = tester.Tester(
+            FailingClient(entries[failing].context), entries,
+            progress=ProgressReporter(out=devnull),
+        )
+        with pytest.raises(RuntimeError):
+            runner.run(max_workers=max_workers)
+
+    finished = [key for key in runner.conversations if key != failing]
+    if max_workers == 1:
+        # The entries after the failure are never started
+        assert finished == keys[:1]
+    else:
+        assert finished == [key for key in keys if key != failing]
+    for key in finished:
+        assert runner.conversations[key].question_count == len(entries[key].questions)